@@ -0,0 +1,413 @@
+"""Alerts evaluated on the readings as they arrive.
+
+Rules are checked per data source against rolling windows that take
+constant time to update, so alerts fire within the polling cycle that
+brought the reading and without reading the RRD. A rule fires once when its
+condition has held for for-cycles readings and resolves once it no longer
+holds beyond the hysteresis, so noisy readings do not flood the sinks.
+Notifications are sent from a background thread.
+"""
+
+import collections
+import json
+import logging as log
+import math
+import os
+import queue
+import subprocess
+import threading
+import requests
+
+ALERT_QUEUE_SIZE = 1000
+COMMAND_TIMEOUT_SECONDS = 30
+WEBHOOK_TIMEOUT_SECONDS = 10
+DEFAULT_MIN_SAMPLES = 30
+# How far ahead of the wall clock pushed readings can be timestamped
+MAX_CLOCK_SKEW_SECONDS = 300
+
+
+class RollingWindow:
+    """Values of the last seconds seconds with their running sum and sum of
+    squares, so that adding a value and getting the mean and standard
+    deviation take constant amortized time.
+
+    >>> window = RollingWindow(60)
+    >>> for timestamp, value in [(0, 1.0), (30, 2.0), (60, 3.0), (90, 4.0)]:
+    ...     window.add(timestamp, value)
+    >>> len(window), window.get_mean_std()
+    (2, (3.5, 0.5))
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.values = collections.deque()
+        self.sum = 0.0
+        self.sum_of_squares = 0.0
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, timestamp, value):
+        self.values.append((timestamp, value))
+        self.sum += value
+        self.sum_of_squares += value * value
+        while self.values[0][0] <= timestamp - self.seconds:
+            old_timestamp, old_value = self.values.popleft()
+            self.sum -= old_value
+            self.sum_of_squares -= old_value * old_value
+
+    def get_oldest(self):
+        return self.values[0]
+
+    def get_mean_std(self):
+        count = len(self.values)
+        mean = self.sum / count
+        # Rounding of the running sums can make the variance slightly negative
+        variance = max(self.sum_of_squares / count - mean * mean, 0.0)
+        return mean, math.sqrt(variance)
+
+
+class AlertRule:
+    """Common settings of the rules. check() returns whether the condition
+    holds (True), has cleared (False) or is within the hysteresis (None),
+    and a message describing it.
+    """
+
+    def __init__(self, config):
+        self.name = config["name"]
+        self.data_sources = config.get("data-sources")
+        self.for_cycles = max(config.get("for-cycles", 1), 1)
+        self.repeat_seconds = config.get("repeat-seconds")
+        self.hysteresis = config.get("hysteresis", 0)
+
+    def applies_to(self, name):
+        return self.data_sources is None or name in self.data_sources
+
+    def create_window(self):
+        return None
+
+
+class ThresholdRule(AlertRule):
+    """Fires when a value is above "above" or below "below".
+
+    >>> rule = ThresholdRule({"name": "freezer", "above": -15, "hysteresis": 2})
+    >>> [rule.check(None, 0, value)[0] for value in (-14, -16, -18)]
+    [True, None, False]
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.above = config.get("above")
+        self.below = config.get("below")
+        if self.above is None and self.below is None:
+            raise ValueError("Threshold rule '%s' needs above or below" % self.name)
+
+    def check(self, window, timestamp, value):
+        if self.above is not None and value > self.above:
+            return True, "%.2f is above %.2f" % (value, self.above)
+        if self.below is not None and value < self.below:
+            return True, "%.2f is below %.2f" % (value, self.below)
+        if (self.above is None or value <= self.above - self.hysteresis) and \
+                (self.below is None or value >= self.below + self.hysteresis):
+            return False, "%.2f is back within limits" % value
+        return None, None
+
+
+class RateRule(AlertRule):
+    """Fires when a value changes faster than max-change-per-hour, measured
+    over window-seconds.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.max_change = config["max-change-per-hour"]
+        self.window_seconds = config.get("window-seconds", 1800)
+
+    def create_window(self):
+        return RollingWindow(self.window_seconds)
+
+    def check(self, window, timestamp, value):
+        window.add(timestamp, value)
+        oldest_timestamp, oldest_value = window.get_oldest()
+        if oldest_timestamp == timestamp:
+            return None, None
+        rate = (value - oldest_value) / (timestamp - oldest_timestamp) * 3600
+        if abs(rate) > self.max_change:
+            return True, "changing %+.2f per hour" % rate
+        if abs(rate) <= self.max_change - self.hysteresis:
+            return False, "changing %+.2f per hour" % rate
+        return None, None
+
+
+class DeviationRule(AlertRule):
+    """Fires when a value is more than max-deviations standard deviations
+    away from the mean of the previous window-seconds, once the window has
+    min-samples values.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.max_deviations = config["max-deviations"]
+        self.window_seconds = config.get("window-seconds", 86400)
+        self.min_samples = config.get("min-samples", DEFAULT_MIN_SAMPLES)
+
+    def create_window(self):
+        return RollingWindow(self.window_seconds)
+
+    def check(self, window, timestamp, value):
+        result = None, None
+        if len(window) >= self.min_samples:
+            mean, std = window.get_mean_std()
+            deviations = 0.0 if std == 0 else abs(value - mean) / std
+            message = "%.2f is %.1f standard deviations from the mean %.2f" % (
+                value, deviations, mean)
+            if deviations > self.max_deviations:
+                result = True, message
+            elif deviations <= self.max_deviations - self.hysteresis:
+                result = False, message
+        # Added only after the check, so that the value does not pull the
+        # statistics towards itself
+        window.add(timestamp, value)
+        return result
+
+
+class StaleRule(AlertRule):
+    """Fires when a data source that has been seen has had no readings for
+    max-age-seconds.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.max_age = config["max-age-seconds"]
+
+    def check_age(self, age):
+        if age > self.max_age:
+            return True, "no readings for %d seconds" % age
+        return False, "readings arrive again"
+
+
+RULE_TYPES = {
+    "threshold": ThresholdRule,
+    "rate": RateRule,
+    "deviation": DeviationRule,
+    "stale": StaleRule,
+}
+
+
+class AlertState:
+    def __init__(self, window):
+        self.window = window
+        self.firing = False
+        self.pending = 0
+        self.notified = None
+
+
+class AlertEngine:
+    """Evaluates the rules on every batch of readings. Safe to call from
+    several threads.
+    """
+
+    def __init__(self, rules, notifier):
+        self.rules = rules
+        self.notifier = notifier
+        self.states = {}
+        self.last_seen = {}
+        self.now = 0
+        self.lock = threading.Lock()
+
+    def evaluate(self, timestamp, readings, now):
+        """Checks the rules on readings taken at timestamp, and the stale
+        rules on all data sources seen so far at wall clock time now.
+
+        Pushed readings carry the timestamps of the pushing server, so ages
+        are measured against now and readings from too far in the future
+        are ignored.
+        """
+        events = []
+        with self.lock:
+            self.now = now
+            if timestamp > now + MAX_CLOCK_SKEW_SECONDS:
+                log.warning("Not checking alerts on readings from the future (%d > %d)",
+                            timestamp, now)
+                readings = {}
+            for name, value in sorted(readings.items()):
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                if timestamp < self.last_seen.get(name, 0):
+                    # The windows need the readings in time order
+                    continue
+                self.last_seen[name] = timestamp
+                for rule in self.rules:
+                    if isinstance(rule, StaleRule) or not rule.applies_to(name):
+                        continue
+                    state = self.get_state(rule, name)
+                    condition, message = rule.check(state.window, timestamp, value)
+                    self.update(rule, name, state, condition, message, value, events)
+
+            for rule in self.rules:
+                if not isinstance(rule, StaleRule):
+                    continue
+                for name, seen in sorted(self.last_seen.items()):
+                    if rule.applies_to(name):
+                        condition, message = rule.check_age(self.now - seen)
+                        self.update(rule, name, self.get_state(rule, name), condition,
+                                    message, None, events)
+        for event in events:
+            self.notifier.notify(event)
+
+    def get_state(self, rule, name):
+        state = self.states.get((rule.name, name))
+        if state is None:
+            state = self.states[(rule.name, name)] = AlertState(rule.create_window())
+        return state
+
+    def update(self, rule, name, state, condition, message, value, events):
+        """Applies for-cycles, hysteresis and deduplication to a check
+        result, adding an event if the alert fires, resolves or is due to
+        be repeated.
+        """
+        if condition is None or condition == state.firing:
+            state.pending = 0
+            if state.firing and rule.repeat_seconds is not None and \
+                    self.now - state.notified >= rule.repeat_seconds:
+                events.append(self.create_event(rule, name, "firing", message, value))
+                state.notified = self.now
+            return
+
+        state.pending += 1
+        if condition and state.pending < rule.for_cycles:
+            return
+        state.pending = 0
+        state.firing = condition
+        state.notified = self.now
+        events.append(self.create_event(rule, name, "firing" if condition else "resolved",
+                                        message, value))
+
+    def create_event(self, rule, name, state, message, value):
+        log.warning("Alert '%s' %s for '%s': %s", rule.name, state, name, message)
+        return {"alert": rule.name, "data_source": name, "state": state,
+                "message": message, "value": value, "timestamp": self.now}
+
+    def close(self):
+        self.notifier.close()
+
+
+class AlertNotifier:
+    """Sends alert events to the sinks from a background thread, so that a
+    slow sink does not delay polling.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.queue = queue.Queue(maxsize=ALERT_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, name="alert-notifier")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def notify(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            log.error("Alert queue is full, dropping alert '%s' for '%s'",
+                      event["alert"], event["data_source"])
+
+    def run(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            for sink in self.sinks:
+                try:
+                    sink.send(event)
+                except Exception:
+                    log.exception("Could not send alert to %s", type(sink).__name__)
+
+    def close(self):
+        """Sends the queued events and stops."""
+        try:
+            self.queue.put(None, timeout=COMMAND_TIMEOUT_SECONDS)
+        except queue.Full:
+            log.error("Alert queue is full, not waiting for the queued alerts")
+            return
+        self.thread.join(COMMAND_TIMEOUT_SECONDS)
+
+
+class FileSink:
+    """Appends events to a file as JSON lines."""
+
+    def __init__(self, config):
+        self.filename = config["path"]
+
+    def send(self, event):
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(event, sort_keys=True) + "\n")
+
+
+class CommandSink:
+    """Runs a command with the event as JSON on its standard input and the
+    main fields in ALERT_* environment variables.
+    """
+
+    def __init__(self, config):
+        self.command = config["command"]
+
+    def send(self, event):
+        env = dict(os.environ, ALERT_NAME=event["alert"], ALERT_STATE=event["state"],
+                   ALERT_DATA_SOURCE=event["data_source"],
+                   ALERT_MESSAGE=event["message"] or "")
+        process = subprocess.Popen(self.command, stdin=subprocess.PIPE, env=env)
+        try:
+            process.communicate(json.dumps(event).encode("utf-8"),
+                                timeout=COMMAND_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            log.error("Alert command %s timed out", self.command)
+            return
+        if process.returncode != 0:
+            log.error("Alert command %s returned: %d", self.command, process.returncode)
+
+
+class WebhookSink:
+    """POSTs events as JSON to a URL."""
+
+    def __init__(self, config):
+        self.url = config["url"]
+
+    def send(self, event):
+        r = requests.post(self.url, data=json.dumps(event),
+                          headers={"Content-Type": "application/json"},
+                          timeout=WEBHOOK_TIMEOUT_SECONDS)
+        if r.status_code >= 300:
+            log.error("Alert webhook '%s' returned error: %d", self.url, r.status_code)
+
+
+SINK_TYPES = {
+    "file": FileSink,
+    "command": CommandSink,
+    "webhook": WebhookSink,
+}
+
+
+def create_alert_engine(config):
+    """Returns the engine of the alerts config, or None if there is none.
+    Raises ValueError or KeyError for invalid rules or sinks.
+    """
+    alerts = config.get("alerts")
+    if alerts is None:
+        return None
+    rules = [create_component(RULE_TYPES, rule, "rule") for rule in alerts["rules"]]
+    if len(set(rule.name for rule in rules)) < len(rules):
+        raise ValueError("Alert rule names must be unique")
+    sinks = [create_component(SINK_TYPES, sink, "sink") for sink in alerts.get("sinks", [])]
+    log.info("Evaluating %d alert rule(s) with %d sink(s)", len(rules), len(sinks))
+    return AlertEngine(rules, AlertNotifier(sinks))
+
+
+def create_component(types, config, kind):
+    component_class = types.get(config.get("type"))
+    if component_class is None:
+        raise ValueError("Unknown alert %s type '%s'" % (kind, config.get("type")))
+    return component_class(config)
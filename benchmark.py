@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+
+import json
+import argparse
+import logging as log
+import os
+import os.path
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import datetime
+import requests
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+import monitoring
+import create_graphs
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+STUB_SERVER = os.path.join(THIS_DIR, "stub_temperature_server.py")
+STUB_BASE_PORT = 15001
+WEB_SERVER_PORT = 12399
+BENCHMARK_PASSWORD = "benchmark"
+
+
+def main():
+    args = parse_args()
+    init_logging(args.log_level)
+    config_dict = json.load(args.config_filename)
+
+    if args.work_dir is not None:
+        results = run_benchmarks(config_dict, args, args.work_dir)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_benchmarks(config_dict, args, work_dir)
+
+    metadata = get_metadata()
+    for result in results:
+        result.update(metadata)
+    if args.output is None:
+        write_results(sys.stdout, results)
+    else:
+        with open(args.output, "a") as output:
+            write_results(output, results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log-level", dest="log_level", default="WARNING",
+                        help="Log level (DEBUG, INFO, WARNING or ERROR)")
+    parser.add_argument("-w", "--work-dir", dest="work_dir", default=None,
+                        help="Directory for generated files (default: temporary directory)")
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="Append the results as JSON lines to this file "
+                        "(default: standard output)")
+    parser.add_argument("config_filename",
+                        metavar="CONFIG-FILENAME",
+                        type=argparse.FileType('r'))
+
+    subparsers = parser.add_subparsers(dest="benchmark_name")
+    subparsers.required = True
+
+    poll = subparsers.add_parser(
+        "poll", help="Latency of polling cycles against local stub temperature servers")
+    poll.add_argument("--servers", dest="servers", type=parse_counts, default=[1, 10, 50],
+                      help="Comma separated numbers of stub servers (default: 1,10,50)")
+    poll.add_argument("--cycles", dest="cycles", type=int, default=20,
+                      help="Number of polling cycles to measure")
+    poll.set_defaults(benchmarks=[benchmark_poll])
+
+    update = subparsers.add_parser(
+        "update", help="Cost of single sample RRD updates")
+    add_data_source_counts_argument(update)
+    update.add_argument("--updates", dest="updates", type=int, default=200,
+                        help="Number of updates to measure")
+    update.set_defaults(benchmarks=[benchmark_update])
+
+    add_data_sources = subparsers.add_parser(
+        "add-data-sources",
+        help="Wall time and peak memory of adding data sources to a full size RRD")
+    add_data_source_counts_argument(add_data_sources)
+    add_data_sources.add_argument("--added", dest="added", type=int, default=1,
+                                  help="Number of data sources to add")
+    add_data_sources.set_defaults(benchmarks=[benchmark_add_data_sources])
+
+    render = subparsers.add_parser(
+        "render", help="Total time of rendering all graphs")
+    add_data_source_counts_argument(render)
+    add_jobs_argument(render)
+    render.set_defaults(benchmarks=[benchmark_render])
+
+    http = subparsers.add_parser(
+        "http", help="Requests per second of the web server routes")
+    add_data_source_counts_argument(http, default=[10])
+    http.add_argument("--requests", dest="requests", type=int, default=200,
+                      help="Number of requests per route")
+    http.add_argument("--concurrency", dest="concurrency", type=int, default=4,
+                      help="Number of concurrent clients")
+    http.set_defaults(benchmarks=[benchmark_http])
+
+    all_benchmarks = subparsers.add_parser(
+        "all", help="Run every benchmark with its default parameters")
+    all_benchmarks.set_defaults(benchmarks=[benchmark_poll, benchmark_update,
+                                            benchmark_add_data_sources,
+                                            benchmark_render, benchmark_http],
+                                servers=[1, 10, 50], cycles=20,
+                                data_sources=[1, 10, 50, 200], updates=200, added=1,
+                                jobs=os.cpu_count() or 1, requests=200, concurrency=4)
+
+    return parser.parse_args()
+
+
+def add_data_source_counts_argument(parser, default=[1, 10, 50, 200]):
+    parser.add_argument("--data-sources", dest="data_sources", type=parse_counts,
+                        default=default,
+                        help="Comma separated numbers of data sources in the RRD "
+                        "(default: %s)" % ",".join(str(c) for c in default))
+
+
+def add_jobs_argument(parser):
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of graphs rendered in parallel (default: CPU count)")
+
+
+def parse_counts(value):
+    """
+    >>> parse_counts("1,10,200")
+    [1, 10, 200]
+    """
+    return [int(count) for count in value.split(",")]
+
+
+def init_logging(log_level):
+    log.basicConfig(level=log_level,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+def run_benchmarks(config, args, work_dir):
+    results = []
+    for benchmark in args.benchmarks:
+        log.info("Running %s", benchmark.__name__)
+        results.extend(benchmark(config, args, work_dir))
+    return results
+
+
+def get_metadata():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=THIS_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def write_results(output, results):
+    for result in results:
+        output.write(json.dumps(result, sort_keys=True) + "\n")
+    output.flush()
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "min": samples[0],
+        "median": statistics.median(samples),
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "max": samples[-1],
+        "mean": statistics.mean(samples),
+    }
+
+
+def benchmark_poll(config, args, work_dir):
+    results = []
+    for server_count in args.servers:
+        ports = [STUB_BASE_PORT + i for i in range(server_count)]
+        stubs = start_stub_servers(ports)
+        try:
+            poll_config = {"servers": [{"hostname": "127.0.0.1", "port": port}
+                                       for port in ports]}
+            workers = monitoring.get_polling_worker_count(poll_config)
+            session = monitoring.create_http_session(workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                durations = []
+                for i in range(args.cycles):
+                    start = time.monotonic()
+                    monitoring.loop_temperature_servers(poll_config, session, executor)
+                    durations.append(time.monotonic() - start)
+        finally:
+            stop_processes(stubs)
+
+        results.append({"benchmark": "poll", "servers": server_count,
+                        "cycle_seconds": summarize(durations)})
+    return results
+
+
+def start_stub_servers(ports):
+    stubs = [subprocess.Popen([sys.executable, STUB_SERVER, "--port", str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+             for port in ports]
+    try:
+        for port in ports:
+            wait_for_url("http://127.0.0.1:%d/temperatures" % port)
+    except Exception:
+        stop_processes(stubs)
+        raise
+    return stubs
+
+
+def wait_for_url(url, timeout=30, auth=None):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            requests.get(url, timeout=1, auth=auth)
+            return
+        except requests.exceptions.ConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def stop_processes(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def benchmark_update(config, args, work_dir):
+    results = []
+    for count in args.data_sources:
+        filename = os.path.join(work_dir, "update-%d.rrd" % count)
+        names = get_data_source_names(count)
+        rras = monitoring.get_rras(config)
+        start = create_benchmark_rrd(filename, rras, names)
+        database = monitoring.RRDDatabase(filename, rras)
+
+        durations = []
+        for i, (timestamp, data) in enumerate(generate_datapoints(names, start,
+                                                                  args.updates)):
+            update_start = time.monotonic()
+            database.update_many([(timestamp, data)])
+            durations.append(time.monotonic() - update_start)
+
+        results.append({"benchmark": "update", "data_sources": count,
+                        "update_seconds": summarize(durations)})
+    return results
+
+
+def benchmark_add_data_sources(config, args, work_dir):
+    results = []
+    for count in args.data_sources:
+        # Each measurement runs in a fresh process so that the peak memory
+        # use is not inherited from earlier measurements.
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results.append(executor.submit(measure_add_data_sources,
+                                           monitoring.get_rras(config), work_dir, count,
+                                           args.added).result())
+    return results
+
+
+def measure_add_data_sources(rras, work_dir, count, added):
+    filename = os.path.join(work_dir, "add-data-sources-%d.rrd" % count)
+    names = get_data_source_names(count)
+    added_names = get_data_source_names(added, prefix="added")
+
+    # RRAs are preallocated, so a freshly created file already has the size
+    # of one that has been collecting data for the whole retention period.
+    monitoring.create_rrd_database(filename, rras, names)
+    rrd_bytes = os.path.getsize(filename)
+
+    log.info("Adding %d data sources to %s (%d bytes)", added, filename, rrd_bytes)
+    start = time.monotonic()
+    monitoring.add_data_sources_to_rrd(filename, added_names)
+    wall_seconds = time.monotonic() - start
+
+    return {
+        "benchmark": "add-data-sources",
+        "data_sources": count,
+        "added": added,
+        "rrd_bytes": rrd_bytes,
+        "rrd_bytes_after": os.path.getsize(filename),
+        "wall_seconds": wall_seconds,
+        "peak_rss_kib": get_peak_rss_kib(resource.RUSAGE_SELF),
+        "peak_child_rss_kib": get_peak_rss_kib(resource.RUSAGE_CHILDREN),
+    }
+
+
+def benchmark_render(config, args, work_dir):
+    results = []
+    for count in args.data_sources:
+        filename = os.path.join(work_dir, "render-%d.rrd" % count)
+        names = get_data_source_names(count)
+        fill_benchmark_rrd(filename, monitoring.get_rras(config), names)
+        output_dir = os.path.join(work_dir, "images-%d" % count)
+
+        start = time.monotonic()
+        failures = create_graphs.output_graphs({"temperature-rrd": filename}, output_dir,
+                                               args.jobs)
+        wall_seconds = time.monotonic() - start
+
+        results.append({"benchmark": "render", "data_sources": count, "jobs": args.jobs,
+                        "graphs": len(create_graphs.IMAGE_NAMES_MAPPING) * (count + 1),
+                        "failures": len(failures), "wall_seconds": wall_seconds})
+    return results
+
+
+def benchmark_http(config, args, work_dir):
+    results = []
+    for count in args.data_sources:
+        filename = os.path.join(work_dir, "http-%d.rrd" % count)
+        names = get_data_source_names(count)
+        fill_benchmark_rrd(filename, monitoring.get_rras(config), names)
+        server = start_web_server(work_dir, filename)
+        try:
+            base_url = "http://127.0.0.1:%d" % WEB_SERVER_PORT
+            auth = ("viewer", BENCHMARK_PASSWORD)
+            wait_for_url(base_url + "/", auth=auth)
+            for route in ["/", "/static/monitoring.js", "/api/series/%s" % names[0],
+                          "/graph/%s/day.png" % names[0]]:
+                result = measure_requests_per_second(base_url + route, auth,
+                                                     args.requests, args.concurrency)
+                result.update({"benchmark": "http", "data_sources": count,
+                               "route": route, "concurrency": args.concurrency})
+                results.append(result)
+        finally:
+            stop_processes([server])
+    return results
+
+
+def start_web_server(work_dir, rrd_filename):
+    """Starts the native web server without TLS in a child process, using a
+    configuration and password of its own.
+    """
+    from passlib.hash import sha256_crypt
+    password_filename = os.path.join(work_dir, "password")
+    with open(password_filename, "w") as f:
+        f.write(sha256_crypt.encrypt(BENCHMARK_PASSWORD))
+    config_filename = os.path.join(work_dir, "server-config.json")
+    with open(config_filename, "w") as f:
+        json.dump({"temperature-rrd": rrd_filename}, f)
+
+    environment = dict(os.environ, MONITORING_PASSWORD_FILE=password_filename,
+                       MONITORING_CONFIG_FILE=config_filename)
+    code = ("import server\n"
+            "server.create_application().listen(%d, address='127.0.0.1')\n"
+            "server.IOLoop.instance().start()\n" % WEB_SERVER_PORT)
+    return subprocess.Popen([sys.executable, "-c", code], cwd=THIS_DIR, env=environment,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def measure_requests_per_second(url, auth, request_count, concurrency):
+    def client(count):
+        session = requests.Session()
+        session.auth = auth
+        failures = 0
+        for i in range(count):
+            if session.get(url).status_code != 200:
+                failures += 1
+        return failures
+
+    counts = [request_count // concurrency] * concurrency
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        failures = sum(executor.map(client, counts))
+    wall_seconds = time.monotonic() - start
+    return {"requests": sum(counts), "failures": failures,
+            "wall_seconds": wall_seconds,
+            "requests_per_second": sum(counts) / wall_seconds}
+
+
+def create_benchmark_rrd(filename, rras, names):
+    """Creates an empty RRD and returns the time of its first update slot."""
+    start = int(time.time()) - int(time.time()) % monitoring.STEP_SECONDS - 10 * 24 * 60 * 60
+    monitoring.create_rrd_database(filename, rras, names, start - 1)
+    return start
+
+
+def fill_benchmark_rrd(filename, rras, names):
+    """Creates an RRD with ten days of random walk data, up to now."""
+    start = create_benchmark_rrd(filename, rras, names)
+    database = monitoring.RRDDatabase(filename, rras)
+    count = (int(time.time()) - start) // monitoring.STEP_SECONDS
+    database.update_many(list(generate_datapoints(names, start, count)))
+
+
+def generate_datapoints(names, start, count):
+    values = {name: random.uniform(15, 25) for name in names}
+    for i in range(count):
+        for name in names:
+            values[name] += random.uniform(-0.2, 0.2)
+        yield start + i * monitoring.STEP_SECONDS, dict(values)
+
+
+def get_data_source_names(count, prefix="temp"):
+    return ["%s%d" % (prefix, i) for i in range(count)]
+
+
+def get_peak_rss_kib(who):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss
+
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,20 @@ import logging as log
 import argparse
 import rrdtool
 import RRDtool
+import os
 import os.path
+import re
+import sys
 import json
+import time
+import signal
+import collections
 import monitoring
+from concurrent.futures import ProcessPoolExecutor
 
 IMAGE_WIDTH = 800
 IMAGE_HEIGHT = 400
+UNIT_LABEL = "Degrees (C)"
 IMAGE_NAMES_MAPPING = {
     "hour.png": "-6h",
     "day.png": "-1d",
@@ -17,13 +25,39 @@ IMAGE_NAMES_MAPPING = {
     "month.png": "-1m",
     "year.png": "-1y",
 }
+# Approximate lengths of time units used in graph start times, in seconds
+TIME_UNIT_SECONDS = {
+    "s": 1,
+    "min": 60,
+    "h": 60 * 60,
+    "d": 24 * 60 * 60,
+    "w": 7 * 24 * 60 * 60,
+    "m": 31 * 24 * 60 * 60,
+    "y": 366 * 24 * 60 * 60,
+}
+MANIFEST_FILENAME = "graphs-manifest.json"
+DAEMON_CHECK_INTERVAL_SECONDS = 1
+DEFAULT_DAEMON_INTERVAL_SECONDS = 300
+COLORS = ["#FF531A", "#4D79FF", "#1C800F", "#999999", "#FFCC00"]
+
+# Arguments of draw_graph()
+GraphJob = collections.namedtuple("GraphJob", ["rrd_filenames", "filepath", "start", "label",
+                                               "width", "height", "defs", "lines", "texts"])
+GraphResult = collections.namedtuple("GraphResult", ["filepath", "seconds", "error"])
 
 
 def main():
     args = parse_args()
     init_logging(args.log_level)
     config_dict = json.load(args.config_filename)
-    output_graphs(config_dict, args.output_dir)
+    if args.daemon:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        GraphDaemon(config_dict, args.output_dir, args.jobs, args.interval).run()
+        return
+
+    failures = output_graphs(config_dict, args.output_dir, args.jobs, args.incremental)
+    if len(failures) > 0:
+        sys.exit(1)
 
 
 def parse_args():
@@ -32,6 +66,17 @@ def parse_args():
                         help="Log level (DEBUG, INFO, WARNING or ERROR)")
     parser.add_argument("-o", "--output-dir", dest="output_dir", required=True,
                         help="Directory where output images are put")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of graphs rendered in parallel (default: CPU count)")
+    parser.add_argument("--incremental", dest="incremental", action="store_true",
+                        help="Only render graphs whose data has changed since the last run")
+    parser.add_argument("--daemon", dest="daemon", action="store_true",
+                        help="Keep running and render changed graphs whenever the data "
+                        "collection server has updated the RRD")
+    parser.add_argument("--interval", dest="interval", type=float,
+                        default=DEFAULT_DAEMON_INTERVAL_SECONDS,
+                        help="In daemon mode, the longest time between renders in seconds "
+                        "(default: %d)" % DEFAULT_DAEMON_INTERVAL_SECONDS)
     parser.add_argument("config_filename",
                         metavar="CONFIG-FILENAME",
                         type=argparse.FileType('r'))
@@ -43,61 +88,384 @@ def init_logging(log_level):
                     format="%(asctime)s - %(levelname)s - %(message)s")
 
 
-def output_graphs(config, output_dir):
+def output_graphs(config, output_dir, jobs=1, incremental=False):
+    """Renders all graphs and returns the results of the failed ones.
+
+    In incremental mode a graph is only rendered if the RRA it is drawn from
+    has gained rows since the previous run, according to the manifest file
+    written in output_dir.
+    """
+    create_output_dir(output_dir)
+    rrd_infos = read_rrd_infos(monitoring.get_rrd_filenames(config))
+    graph_jobs = get_all_graph_jobs(output_dir, rrd_infos)
+    manifest = {}
+    if incremental:
+        manifest = read_manifest(output_dir)
+    return render_graph_jobs(graph_jobs, rrd_infos, output_dir, manifest, incremental, jobs)
+
+
+class GraphDaemon:
+    """Renders graphs over and over from one long-running process.
+
+    The RRD infos and the argument lists of all graphs are kept between
+    renders and only rebuilt when an RRD file has been replaced or shards
+    have come or gone, which is when the data sources can change. A render
+    is started when the status file of the data collection server (or, if
+    there is none, an RRD file) changes, or when interval seconds have
+    passed. Only graphs whose data has changed are rendered. After every
+    render the last update time of the rendered status is written to the
+    rendered file of the status file, for the web server to tell dashboards
+    when the new graphs are ready.
+    """
+
+    def __init__(self, config, output_dir, jobs=1, interval=DEFAULT_DAEMON_INTERVAL_SECONDS):
+        self.config = config
+        self.output_dir = output_dir
+        self.jobs = jobs
+        self.interval = interval
+        self.schema_key = None
+        self.rrd_infos = None
+        self.graph_jobs = []
+        self.manifest = {}
+
+    def run(self):
+        create_output_dir(self.output_dir)
+        self.manifest = read_manifest(self.output_dir)
+        executor = None
+        if self.jobs > 1:
+            executor = ProcessPoolExecutor(max_workers=self.jobs)
+        try:
+            trigger = None
+            next_render = time.monotonic()
+            while True:
+                new_trigger = self.get_trigger()
+                if new_trigger != trigger or time.monotonic() >= next_render:
+                    trigger = new_trigger
+                    next_render = time.monotonic() + self.interval
+                    self.render(executor)
+                time.sleep(DAEMON_CHECK_INTERVAL_SECONDS)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def get_trigger(self):
+        """Returns a value that changes when the RRDs have been updated."""
+        if "status-file" in self.config:
+            return monitoring.get_file_signature(self.config["status-file"])
+        return [monitoring.get_file_signature(f)
+                for f in monitoring.get_rrd_filenames(self.config)]
+
+    def render(self, executor):
+        status_filename = self.config.get("status-file")
+        last_update = None
+        if status_filename is not None:
+            last_update = read_status_last_update(status_filename)
+        try:
+            self.reload_if_changed()
+            # Only the last update time changes between schema changes
+            rrd_infos = collections.OrderedDict()
+            for rrd_filename, rrd_info in self.rrd_infos.items():
+                rrd_infos[rrd_filename] = dict(rrd_info,
+                                               last_update=rrdtool.last(rrd_filename))
+            render_graph_jobs(self.graph_jobs, rrd_infos, self.output_dir, self.manifest,
+                              True, self.jobs, executor)
+            if last_update is not None:
+                write_rendered_status(get_rendered_filename(status_filename), last_update)
+        except Exception:
+            log.exception("Rendering graphs failed")
+
+    def reload_if_changed(self):
+        rrd_filenames = monitoring.get_rrd_filenames(self.config)
+        schema_key = []
+        for rrd_filename in rrd_filenames:
+            signature = monitoring.get_file_signature(rrd_filename)
+            if signature is not None:
+                # Adding data sources replaces the file, so the inode changes
+                schema_key.append((rrd_filename, signature[:2]))
+        if schema_key == self.schema_key:
+            return
+
+        log.info("Loading RRD schemas of %d files", len(rrd_filenames))
+        self.rrd_infos = read_rrd_infos(rrd_filenames)
+        self.graph_jobs = get_all_graph_jobs(self.output_dir, self.rrd_infos)
+        self.schema_key = schema_key
+
+
+def create_output_dir(output_dir):
     if not os.path.isdir(output_dir):
         log.info("Creating output directory: %s", output_dir)
         os.makedirs(output_dir)
 
-    unit_label = "Degrees (C)"
-    draw_graphs(config, output_dir, unit_label)
-
-    rrd_filename = config["temperature-rrd"]
-    rrd_info = RRDtool.RRD(rrd_filename).info()
-    ds_names = monitoring.get_data_source_names_from_info(rrd_info)
-
-    for name in ds_names:
-        for image_name, time_range in IMAGE_NAMES_MAPPING.items():
-            draw_detailed_graph_for_dataset(output_dir, name, rrd_filename, name,
-                                            image_name, time_range, unit_label)
-
-
-def draw_graphs(config, output_dir, label):
-    log.debug("Drawing graphs")
-    rrd_filename = config["temperature-rrd"]
-    rrd_info = RRDtool.RRD(rrd_filename).info()
-    ds_names = monitoring.get_data_source_names_from_info(rrd_info)
-    defs = get_defs(rrd_filename, ds_names)
-    colors = ["#FF531A", "#4D79FF", "#1C800F", "#999999", "#FFCC00"]
-    lines = get_lines(rrd_filename, ds_names, colors)
-    texts = get_texts(rrd_filename, ds_names)
-
-    for image, start in IMAGE_NAMES_MAPPING.items():
-        draw_graph(rrd_filename, os.path.join(output_dir, image), start, label,
-                   IMAGE_WIDTH, IMAGE_HEIGHT, defs, lines, texts)
 
-
-def draw_detailed_graph_for_dataset(output_dir, name, rrd_filename, dataset_name,
-                                    image_filename, start, unit_label):
-    defs = get_defs(rrd_filename, [dataset_name])
-    colors = ["#FF531A", "#4D79FF", "#1C800F", "#999999", "#FFCC00"]
-    lines = get_lines(rrd_filename, [dataset_name], colors)
-    texts = get_texts(rrd_filename, [dataset_name])
-    images_dir = os.path.join(output_dir, "detailed")
-
-    image_filepath = os.path.join(images_dir, dataset_name, image_filename)
-    draw_graph(rrd_filename, image_filepath, start, unit_label,
-               IMAGE_WIDTH, IMAGE_HEIGHT, defs, lines, texts)
-
-
-def draw_graph(rrd_filename, filepath, start, label, width, height,
+def read_rrd_infos(rrd_filenames):
+    rrd_infos = collections.OrderedDict()
+    for rrd_filename in rrd_filenames:
+        rrd_infos[rrd_filename] = RRDtool.RRD(rrd_filename).info()
+    return rrd_infos
+
+
+def get_all_graph_jobs(output_dir, rrd_infos):
+    """Returns the jobs of the combined graphs and the detailed graphs of
+    every data source.
+    """
+    unit_label = UNIT_LABEL
+    rrd_files = monitoring.get_data_source_files(rrd_infos)
+    if len(rrd_files) == 0:
+        log.warning("No data sources to draw")
+        return []
+
+    graph_jobs = get_graph_jobs(output_dir, rrd_files, unit_label)
+    for name, rrd_filename in rrd_files.items():
+        graph_jobs.extend(get_detailed_graph_jobs(output_dir, rrd_files, name, unit_label,
+                                                  has_min_max_rras(rrd_infos[rrd_filename])))
+    return graph_jobs
+
+
+def has_min_max_rras(rrd_info):
+    cfs = set(rra["cf"] for rra in monitoring.get_rras_from_info(rrd_info))
+    return "MIN" in cfs and "MAX" in cfs
+
+
+def render_graph_jobs(graph_jobs, rrd_infos, output_dir, manifest, incremental, jobs,
+                      executor=None):
+    """Renders the graph jobs, or in incremental mode those that have changed
+    according to manifest, and updates and writes the manifest. Returns the
+    results of the failed jobs.
+    """
+    signatures = {}
+    for job in graph_jobs:
+        signatures[os.path.relpath(job.filepath, output_dir)] = get_graph_signature(rrd_infos,
+                                                                                    job)
+
+    if incremental:
+        graph_jobs = [job for job in graph_jobs
+                      if needs_rendering(job, output_dir, manifest, signatures)]
+        log.info("%d graphs need to be rendered", len(graph_jobs))
+        if len(graph_jobs) == 0:
+            return []
+
+    failures = render_graphs(graph_jobs, jobs, executor)
+
+    for job in graph_jobs:
+        name = os.path.relpath(job.filepath, output_dir)
+        manifest[name] = signatures[name]
+    for failure in failures:
+        manifest.pop(os.path.relpath(failure.filepath, output_dir), None)
+    write_manifest(output_dir, manifest)
+
+    return failures
+
+
+def get_graph_signature(rrd_infos, job):
+    """Returns a value that changes whenever the graph drawn by the job
+    could change: when its arguments change or when an RRA the graph is
+    drawn from gets a new row.
+
+    Rows of an RRA are aligned to multiples of its resolution, so the number
+    of rows written since the epoch identifies the newest row. Unlike cur_row
+    it does not repeat when the RRA wraps around.
+    """
+    seconds = get_time_range_seconds(job.start)
+    rows = []
+    for rrd_filename in job.rrd_filenames:
+        rrd_info = rrd_infos[rrd_filename]
+        rra = get_backing_rra(rrd_info, seconds, job.width)
+        resolution = rrd_info["step"] * rra["pdp_per_row"]
+        rows.append([rra["index"], rrd_info["last_update"] // resolution])
+    return [rows, job.start, job.label, job.width, job.height,
+            job.defs, job.lines, job.texts]
+
+
+def needs_rendering(job, output_dir, manifest, signatures):
+    name = os.path.relpath(job.filepath, output_dir)
+    if not os.path.exists(job.filepath):
+        return True
+    return manifest.get(name) != signatures[name]
+
+
+def read_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILENAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        log.info("Could not read graph manifest, rendering all graphs: %s", e)
+        return {}
+
+
+def write_manifest(output_dir, manifest):
+    filename = os.path.join(output_dir, MANIFEST_FILENAME)
+    with open(filename + ".tmp", "w") as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(filename + ".tmp", filename)
+
+
+def get_rendered_filename(status_filename):
+    """Returns the file where the graph daemon records the last update time
+    of the status whose data it has rendered.
+
+    >>> get_rendered_filename("/var/lib/monitoring/status.json")
+    '/var/lib/monitoring/status.json.rendered'
+    """
+    return status_filename + ".rendered"
+
+
+def read_status_last_update(filename):
+    """Returns the last update time of a status or rendered file, or None
+    if it can not be read.
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)["last_update"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_rendered_status(filename, last_update):
+    with open(filename + ".tmp", "w") as f:
+        json.dump({"last_update": last_update}, f)
+    os.replace(filename + ".tmp", filename)
+
+
+def get_time_range_seconds(start):
+    """Returns the length in seconds of a graph with a relative start time.
+
+    >>> get_time_range_seconds("-6h")
+    21600
+    >>> get_time_range_seconds("-1m")
+    2678400
+    """
+    match = re.match(r"^-(\d+)([a-z]+)$", start)
+    if match is None or match.group(2) not in TIME_UNIT_SECONDS:
+        raise ValueError("Unsupported start time: %s" % start)
+    return int(match.group(1)) * TIME_UNIT_SECONDS[match.group(2)]
+
+
+def get_backing_rra(rrd_info, seconds, width, cf="AVERAGE"):
+    """Returns the RRA rrdtool reads when drawing a graph of the given time
+    range and width.
+
+    This follows the selection done by rrd_fetch: the wanted resolution is
+    the time covered by one pixel. Among the RRAs that reach back far enough
+    the one closest to that resolution wins, otherwise the one covering most
+    of the range.
+    """
+    step = rrd_info["step"]
+    last_update = rrd_info["last_update"]
+    wanted_resolution = seconds / width
+    start = last_update - seconds
+
+    best_full = None
+    best_partial = None
+    for rra in monitoring.get_rras_from_info(rrd_info):
+        if rra["cf"] != cf:
+            continue
+        resolution = step * rra["pdp_per_row"]
+        rra_end = last_update - last_update % resolution
+        rra_start = rra_end - resolution * rra["rows"]
+        if rra_start <= start:
+            difference = abs(wanted_resolution - resolution)
+            if best_full is None or difference < best_full[0]:
+                best_full = (difference, rra)
+        else:
+            coverage = rra_end - rra_start
+            if best_partial is None or coverage > best_partial[0]:
+                best_partial = (coverage, rra)
+
+    if best_full is not None:
+        return best_full[1]
+    if best_partial is not None:
+        return best_partial[1]
+    raise ValueError("RRD has no %s RRAs" % cf)
+
+
+def get_graph_jobs(output_dir, rrd_files, label):
+    defs = get_defs(rrd_files)
+    lines = get_lines(rrd_files, COLORS)
+    texts = get_texts(rrd_files)
+    rrd_filenames = get_rrd_filenames(rrd_files)
+
+    return [GraphJob(rrd_filenames, os.path.join(output_dir, image), start, label,
+                     IMAGE_WIDTH, IMAGE_HEIGHT, defs, lines, texts)
+            for image, start in IMAGE_NAMES_MAPPING.items()]
+
+
+def get_detailed_graph_jobs(output_dir, rrd_files, dataset_name, unit_label, min_max=False):
+    """Returns the jobs of the graphs of a single data source. With min_max
+    the range between the MIN and MAX RRAs is drawn around the average.
+    """
+    images_dir = os.path.join(output_dir, "detailed", dataset_name)
+    rrd_files = select_data_sources(rrd_files, [dataset_name])
+    if not min_max:
+        return get_graph_jobs(images_dir, rrd_files, unit_label)
+
+    defs = get_detailed_defs(rrd_files)
+    lines = get_detailed_lines(rrd_files)
+    texts = get_detailed_texts(rrd_files)
+    return [GraphJob(get_rrd_filenames(rrd_files), os.path.join(images_dir, image), start,
+                     unit_label, IMAGE_WIDTH, IMAGE_HEIGHT, defs, lines, texts)
+            for image, start in IMAGE_NAMES_MAPPING.items()]
+
+
+def select_data_sources(rrd_files, ds_names):
+    """Returns the part of a data source name to RRD file mapping that
+    contains the given data sources, raising KeyError for unknown ones.
+    """
+    return collections.OrderedDict((name, rrd_files[name]) for name in ds_names)
+
+
+def get_rrd_filenames(rrd_files):
+    """
+    >>> get_rrd_filenames({"a": "x.rrd", "b": "x.rrd"})
+    ['x.rrd']
+    """
+    return sorted(set(rrd_files.values()))
+
+
+def render_graphs(graph_jobs, jobs, executor=None):
+    log.debug("Rendering %d graphs with %d jobs", len(graph_jobs), jobs)
+    start = time.monotonic()
+    if executor is not None:
+        results = list(executor.map(render_graph_job, graph_jobs))
+    elif jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(render_graph_job, graph_jobs))
+    else:
+        results = [render_graph_job(job) for job in graph_jobs]
+
+    failures = []
+    for result in results:
+        if result.error is not None:
+            log.error("Drawing graph '%s' failed: %s", result.filepath, result.error)
+            failures.append(result)
+        else:
+            log.debug("Drew graph '%s' in %.3f s", result.filepath, result.seconds)
+
+    log.info("Rendered %d graphs (%d failed) in %.3f s", len(results), len(failures),
+             time.monotonic() - start)
+    return failures
+
+
+def render_graph_job(job):
+    start = time.monotonic()
+    error = None
+    try:
+        draw_graph(*job)
+    except Exception as e:
+        error = str(e)
+    return GraphResult(job.filepath, time.monotonic() - start, error)
+
+
+def draw_graph(rrd_filenames, filepath, start, label, width, height,
                defs, lines, texts):
-    log.debug("Drawing graph '%s' for '%s'", filepath, rrd_filename)
+    log.debug("Drawing graph '%s' for %s", filepath, rrd_filenames)
 
     directory = os.path.dirname(filepath)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    os.makedirs(directory, exist_ok=True)
 
-    rrdtool.graph(filepath, "--start", start,
+    # Render next to the final file and move it in place, so that the web
+    # server never sees a partially written image.
+    tmp_filepath = filepath + ".tmp"
+    rrdtool.graph(tmp_filepath, "--start", start,
                   "--vertical-label", label,
                   "--width", str(width),
                   "--height", str(height),
@@ -107,36 +475,42 @@ def draw_graph(rrd_filename, filepath, start, label, width, height,
                   defs,
                   lines,
                   texts)
+    os.replace(tmp_filepath, filepath)
 
 
-def get_defs(rrd_filename, ds_names):
+def get_defs(rrd_files):
+    """Returns DEFs for the data sources of a mapping from data source names
+    to RRD files, which may be spread over several files.
+    """
     defs = []
-    log.debug("Getting DEFs for '%s'", rrd_filename)
-    for name in ds_names:
+    log.debug("Getting DEFs for %s", get_rrd_filenames(rrd_files))
+    for name, rrd_filename in rrd_files.items():
         defs.append("DEF:%s=%s:%s:AVERAGE" % (name, rrd_filename, name))
 
     log.debug("DEFs: %s", defs)
     return defs
 
 
-def get_detailed_defs(rrd_filename, ds_names):
+def get_detailed_defs(rrd_files):
+    """Returns DEFs reading the AVERAGE, MIN and MAX RRAs of the data
+    sources, so that the extremes come from pre-consolidated rows.
+    """
     defs = []
-    log.debug("Getting detailed DEFs for '%s'", rrd_filename)
-    for name in ds_names:
+    log.debug("Getting detailed DEFs for %s", get_rrd_filenames(rrd_files))
+    for name, rrd_filename in rrd_files.items():
         defs.append("DEF:%s=%s:%s:AVERAGE" % (name, rrd_filename, name))
-        defs.append("VDEF:%s_min=%s,MINIMUM" % (name, name))
-        defs.append("VDEF:%s_max=%s,MAXIMUM" % (name, name))
-        defs.append("VDEF:%s_last=%s,LAST" % (name, name))
-        defs.append("VDEF:%s_average=%s,AVERAGE" % (name, name))
+        defs.append("DEF:%s_min=%s:%s:MIN" % (name, rrd_filename, name))
+        defs.append("DEF:%s_max=%s:%s:MAX" % (name, rrd_filename, name))
+        defs.append("CDEF:%s_range=%s_max,%s_min,-" % (name, name, name))
 
     log.debug("Detailed DEFs: %s", defs)
     return defs
 
 
-def get_lines(rrd_filename, ds_names, colors):
+def get_lines(rrd_files, colors):
     lines = []
-    log.debug("Getting LINEs for '%s'", rrd_filename)
-    for name, color in zip(ds_names, colors):
+    log.debug("Getting LINEs for %s", get_rrd_filenames(rrd_files))
+    for name, color in zip(rrd_files, colors):
         # TODO label
         lines.append("LINE2:%s%s:%s" % (name, color, name))
 
@@ -144,27 +518,27 @@ def get_lines(rrd_filename, ds_names, colors):
     return lines
 
 
-def get_detailed_lines(rrd_filename, ds_names):
+def get_detailed_lines(rrd_files):
     lines = []
-    log.debug("Getting detailed LINEs for '%s'", rrd_filename)
-    for name in ds_names:
-        lines.append("LINE1:%s#444444:Actual" % name)
-        lines.append("LINE1:%s_min#0000FF:Minimum" % name)
-        lines.append("LINE1:%s_average#00FF00:Average" % name)
-        lines.append("LINE1:%s_max#FF0000" % name)
-        lines.append("LINE1:%s_average#00FF00" % name)
+    log.debug("Getting detailed LINEs for %s", get_rrd_filenames(rrd_files))
+    for name in rrd_files:
+        lines.append("LINE1:%s_min#4D79FF:Minimum" % name)
+        # Stacked on the minimum, the area fills the range up to the maximum
+        lines.append("AREA:%s_range#4D79FF40::STACK" % name)
+        lines.append("LINE1:%s_max#FF531A:Maximum" % name)
+        lines.append("LINE2:%s#444444:Average" % name)
 
     log.debug("Detailed LINEs: %s", lines)
     return lines
 
 
-def get_texts(rrd_filename, ds_names):
+def get_texts(rrd_files):
     texts = []
-    log.debug("Getting texts for '%s'", rrd_filename)
+    log.debug("Getting texts for %s", get_rrd_filenames(rrd_files))
     # TODO label
-    longest_label_length = max(len(name) for name in ds_names)
+    longest_label_length = max(len(name) for name in rrd_files)
 
-    for name in ds_names:
+    for name in rrd_files:
         # TODO label
         label_length = len(name)
         padding = " " * (longest_label_length - label_length)
@@ -179,5 +553,18 @@ def get_texts(rrd_filename, ds_names):
     return texts
 
 
+def get_detailed_texts(rrd_files):
+    texts = []
+    log.debug("Getting detailed texts for %s", get_rrd_filenames(rrd_files))
+    for name in rrd_files:
+        texts.append("GPRINT:%s:LAST:current\\: %%3.2lf" % name)
+        texts.append("GPRINT:%s_min:MIN: min\\: %%3.2lf" % name)
+        texts.append("GPRINT:%s_max:MAX: max\\: %%3.2lf" % name)
+        texts.append("GPRINT:%s:AVERAGE: average\\: %%3.2lf\\n" % name)
+
+    log.debug("Detailed texts: %s", texts)
+    return texts
+
+
 if __name__ == "__main__":
     main()
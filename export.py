@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""Streams the history of data sources out of the RRD files.
+
+The time range is fetched from rrdtool a chunk of rows at a time and each
+chunk is encoded and written before the next one is fetched, so memory use
+does not depend on the length of the range.
+
+Formats:
+
+    csv     timestamp and one column per data source, empty when unknown
+    ndjson  one {"timestamp": ..., "readings": {...}} object per line, null
+            when unknown
+    binary  little endian header, data source names and float32 values
+
+Binary layout:
+
+    header  magic, version, column count, step, first timestamp, row count
+    names   per column a length byte and the UTF-8 name
+    values  row count * column count float32, row by row, NaN for unknown
+
+Row i is for first timestamp + i * step.
+"""
+
+import argparse
+import collections
+import json
+import logging as log
+import math
+import struct
+import sys
+import numpy
+import rrdtool
+import monitoring
+import create_graphs
+import series
+
+CHUNK_ROWS = 1024
+MAGIC = b"RRDEXPRT"
+VERSION = 1
+# magic, version, column count, step, first timestamp, row count
+BINARY_HEADER = struct.Struct("<8sHHIqQ")
+
+ExportPlan = collections.namedtuple("ExportPlan", ["rrd_files", "cf", "step", "start",
+                                                   "rows"])
+
+
+class CsvEncoder:
+    content_type = "text/csv; charset=utf-8"
+    extension = "csv"
+
+    def __init__(self, plan):
+        self.plan = plan
+
+    def get_header(self):
+        return ("timestamp," + ",".join(self.plan.rrd_files) + "\n").encode("utf-8")
+
+    def encode(self, timestamps, values):
+        lines = []
+        for timestamp, row in zip(timestamps.tolist(), values.tolist()):
+            lines.append("%d,%s\n" % (timestamp, ",".join(format_csv_value(v) for v in row)))
+        return "".join(lines).encode("utf-8")
+
+
+class NdjsonEncoder:
+    content_type = "application/x-ndjson"
+    extension = "ndjson"
+
+    def __init__(self, plan):
+        self.names = list(plan.rrd_files)
+
+    def get_header(self):
+        return b""
+
+    def encode(self, timestamps, values):
+        lines = []
+        for timestamp, row in zip(timestamps.tolist(), values.tolist()):
+            readings = {name: None if math.isnan(v) else v for name, v in zip(self.names, row)}
+            lines.append(json.dumps({"timestamp": timestamp, "readings": readings}) + "\n")
+        return "".join(lines).encode("utf-8")
+
+
+class BinaryEncoder:
+    content_type = "application/octet-stream"
+    extension = "bin"
+
+    def __init__(self, plan):
+        self.plan = plan
+
+    def get_header(self):
+        plan = self.plan
+        header = [BINARY_HEADER.pack(MAGIC, VERSION, len(plan.rrd_files), plan.step,
+                                     plan.start + plan.step, plan.rows)]
+        for name in plan.rrd_files:
+            encoded = name.encode("utf-8")
+            header.append(struct.pack("<B", len(encoded)) + encoded)
+        return b"".join(header)
+
+    def encode(self, timestamps, values):
+        return values.astype("<f4").tobytes()
+
+
+ENCODERS = {
+    "csv": CsvEncoder,
+    "ndjson": NdjsonEncoder,
+    "binary": BinaryEncoder,
+}
+
+
+def main():
+    args = parse_args()
+    init_logging(args.log_level)
+    config = json.load(args.config_filename)
+
+    rrd_files = series.get_data_source_files(monitoring.get_rrd_filenames(config))
+    names = None if args.names is None else args.names.split(",")
+    try:
+        plan = plan_export(rrd_files, names, args.start, args.end, args.cf, args.resolution)
+    except KeyError as e:
+        log.error("Unknown data source: %s", e)
+        sys.exit(1)
+    except ValueError as e:
+        log.error("%s", e)
+        sys.exit(1)
+
+    log.info("Exporting %d rows of %d data sources at %d s resolution",
+             plan.rows, len(plan.rrd_files), plan.step)
+    output = sys.stdout.buffer if args.output is None else open(args.output, "wb")
+    with output:
+        for chunk in iter_export(plan, ENCODERS[args.format](plan)):
+            output.write(chunk)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log-level", dest="log_level", default="WARNING",
+                        help="Log level (DEBUG, INFO, WARNING or ERROR)")
+    parser.add_argument("--names", dest="names", default=None,
+                        help="Comma separated data sources to export (default: all)")
+    parser.add_argument("--start", dest="start", default="-1d",
+                        help="Start time, as seconds since the epoch or relative to the "
+                        "last update, e.g. -1y (default: %(default)s)")
+    parser.add_argument("--end", dest="end", default="last",
+                        help="End time, as seconds since the epoch, relative to the last "
+                        "update, or last (default: %(default)s)")
+    parser.add_argument("--cf", dest="cf", default="AVERAGE",
+                        choices=monitoring.CONSOLIDATION_FUNCTIONS,
+                        help="Consolidation function to export (default: %(default)s)")
+    parser.add_argument("--resolution", dest="resolution", type=int, default=0,
+                        help="Wanted resolution in seconds (default: the finest RRA "
+                        "covering the range)")
+    parser.add_argument("--format", dest="format", choices=sorted(ENCODERS), default="csv",
+                        help="Output format (default: %(default)s)")
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="Output file (default: standard output)")
+    parser.add_argument("config_filename",
+                        metavar="CONFIG-FILENAME",
+                        type=argparse.FileType('r'))
+    return parser.parse_args()
+
+
+def init_logging(log_level):
+    log.basicConfig(level=log_level,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+def plan_export(rrd_files, names, start, end, cf="AVERAGE", resolution=0):
+    """Returns the rows to export of the given data sources, or of all of
+    them if names is None. The RRA is selected like for the series API: the
+    coarsest one covering the range with at least the given resolution.
+
+    Raises KeyError for unknown data sources and ValueError for invalid
+    ranges.
+    """
+    if names is not None:
+        rrd_files = create_graphs.select_data_sources(rrd_files, names)
+    if len(rrd_files) == 0:
+        raise KeyError("No data sources")
+    if cf not in monitoring.CONSOLIDATION_FUNCTIONS:
+        raise ValueError("Unknown consolidation function '%s'" % cf)
+
+    rrd_filenames = create_graphs.get_rrd_filenames(rrd_files)
+    last_update = max(series.get_last_update(filename) for filename in rrd_filenames)
+    start = parse_time(start, last_update)
+    end = min(parse_time(end, last_update), last_update)
+    if start > end:
+        raise ValueError("Start time is after end time")
+
+    # The shards of a sharded layout share the same RRAs
+    schema = series.get_rrd_schema(rrd_filenames[0])
+    rra = series.select_rra(schema, last_update, last_update - start, resolution, cf)
+    step = schema["step"] * rra["pdp_per_row"]
+    start -= start % step
+    end -= end % step
+    return ExportPlan(rrd_files, cf, step, start, (end - start) // step)
+
+
+def parse_time(value, last_update):
+    """
+    >>> parse_time("-1d", 1000000), parse_time("1437480467", 1000000)
+    (913600, 1437480467)
+    >>> parse_time("last", 1000000)
+    1000000
+    """
+    if value == "last":
+        return last_update
+    if value.startswith("-"):
+        return last_update - create_graphs.get_time_range_seconds(value)
+    return int(value)
+
+
+def iter_export(plan, encoder):
+    """Yields the encoded export in chunks."""
+    yield encoder.get_header()
+    for timestamps, values in iter_chunks(plan):
+        yield encoder.encode(timestamps, values)
+
+
+def iter_chunks(plan, chunk_rows=CHUNK_ROWS):
+    """Yields the timestamps and the values, one column per data source, of
+    at most chunk_rows rows at a time.
+    """
+    file_columns = collections.OrderedDict()
+    for column, (name, rrd_filename) in enumerate(plan.rrd_files.items()):
+        file_columns.setdefault(rrd_filename, []).append((column, name))
+
+    for first_row in range(0, plan.rows, chunk_rows):
+        count = min(chunk_rows, plan.rows - first_row)
+        start = plan.start + first_row * plan.step
+        values = numpy.full((count, len(plan.rrd_files)), numpy.nan)
+        for rrd_filename, columns in file_columns.items():
+            fetch_columns(values, rrd_filename, columns, plan, start)
+        timestamps = start + plan.step * numpy.arange(1, count + 1, dtype="i8")
+        yield timestamps, values
+
+
+def fetch_columns(values, rrd_filename, columns, plan, start):
+    end = start + len(values) * plan.step
+    (fetch_start, fetch_end, step), names, rows = rrdtool.fetch(
+        rrd_filename, plan.cf, "--resolution", str(plan.step),
+        "--start", str(start), "--end", str(end))
+    if fetch_start != start or step != plan.step:
+        # rrdtool reads other RRAs for rows older than the selected RRA
+        # reaches, those rows are left unknown to keep the step constant
+        log.debug("'%s' returned rows from %d every %d s for %d, leaving them unknown",
+                  rrd_filename, fetch_start, step, start)
+        return
+    rows = numpy.array(rows[:len(values)], dtype=float)
+    if len(rows) == 0:
+        return
+    for column, name in columns:
+        values[:len(rows), column] = rows[:, names.index(name)]
+
+
+def format_csv_value(value):
+    """
+    >>> format_csv_value(21.5), format_csv_value(float("nan"))
+    ('21.5', '')
+    """
+    if math.isnan(value):
+        return ""
+    return repr(value)
+
+
+if __name__ == "__main__":
+    main()
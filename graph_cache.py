@@ -0,0 +1,65 @@
+import threading
+import time
+import collections
+from concurrent.futures import Future
+
+
+class RenderCache:
+    """Bounded LRU cache for rendered content with per entry expiry times.
+
+    Concurrent requests for a key that is already being rendered wait for
+    that render to finish instead of starting their own.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.rendering = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, render):
+        """Returns the content cached for key and the number of seconds it
+        stays valid, calling render() on a miss.
+
+        render() returns a (content, ttl_seconds) pair with bytes content.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, content = entry
+                remaining = expires - time.monotonic()
+                if remaining > 0:
+                    self.entries.move_to_end(key)
+                    return content, remaining
+                self.remove(key)
+
+            future = self.rendering.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.rendering[key] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            content, ttl = render()
+        except Exception as e:
+            with self.lock:
+                del self.rendering[key]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.rendering[key]
+            self.entries[key] = (time.monotonic() + ttl, content)
+            self.size += len(content)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                self.remove(next(iter(self.entries)))
+        future.set_result((content, ttl))
+        return content, ttl
+
+    def remove(self, key):
+        expires, content = self.entries.pop(key)
+        self.size -= len(content)
@@ -0,0 +1,306 @@
+import cProfile
+import io
+import logging as log
+import pstats
+import threading
+import time
+import contextlib
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+PROFILE_DEFAULT_SECONDS = 60
+PROFILE_MAX_WAIT_SECONDS = 600
+PROFILE_STATS_LINES = 60
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get_lines(self):
+        lines = ["# HELP %s %s" % (self.name, self.help_text),
+                 "# TYPE %s counter" % self.name]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append("%s%s %s" % (self.name,
+                                          format_labels(self.label_names, label_values),
+                                          format_value(value)))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket and +Inf, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, *label_values)
+
+    def get_lines(self):
+        lines = ["# HELP %s %s" % (self.name, self.help_text),
+                 "# TYPE %s histogram" % self.name]
+        with self.lock:
+            values = sorted((k, (list(v[0]), v[1])) for k, v in self.values.items())
+        label_names = self.label_names + ("le",)
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = format_labels(label_names, label_values + (format_value(bound),))
+                lines.append("%s_bucket%s %d" % (self.name, labels, cumulative))
+            labels = format_labels(self.label_names, label_values)
+            lines.append("%s_sum%s %s" % (self.name, labels, format_value(total)))
+            lines.append("%s_count%s %d" % (self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def format(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.get_lines())
+        return "\n".join(lines) + "\n"
+
+
+class Profiler:
+    """Runs cProfile over calls made through runcall() while a capture has
+    been requested with capture().
+
+    Up to Python 3.11 cProfile only sees the thread it is enabled in, so
+    every call made through runcall() during a capture gets a profile of its
+    own, in whichever thread it runs, and the profiles are merged at the end.
+    From Python 3.12 on only one profile can be enabled in the process at a
+    time, and calls made while another one is enabled are not profiled.
+    Profiling never makes the profiled calls fail.
+    """
+
+    def __init__(self):
+        self.capturing = None
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.local = threading.local()
+
+    def capture(self, seconds, sort="cumulative", timeout=None):
+        """Profiles for at least seconds and at least one call, and returns
+        the statistics as text, or None if another capture is running or no
+        call was profiled within timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        capture = {"profiles": [], "running": 0}
+        with self.lock:
+            if self.capturing is not None:
+                return None
+            self.capturing = capture
+        log.info("Starting a %d second profile", seconds)
+        time.sleep(seconds)
+        with self.lock:
+            self.changed.wait_for(lambda: len(capture["profiles"]) > 0,
+                                  get_remaining_seconds(deadline))
+            self.capturing = None
+            # The calls still running are part of the capture
+            self.changed.wait_for(lambda: capture["running"] == 0,
+                                  get_remaining_seconds(deadline))
+            profiles = list(capture["profiles"])
+        return format_profile(profiles, sort)
+
+    def runcall(self, function, *args):
+        capture = self.capturing
+        if capture is None or getattr(self.local, "profiling", False):
+            # A thread can only run one profile at a time, nested calls are
+            # covered by the outer one
+            return function(*args)
+
+        profile = self.start_profile(capture)
+        if profile is None:
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            self.stop_profile(capture, profile)
+
+    def start_profile(self, capture):
+        """Returns a profile enabled in the calling thread, or None if it
+        could not be enabled.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except Exception as e:
+            # Python 3.12 and later raise ValueError while another profile
+            # is enabled
+            log.debug("Not profiling call in %s: %s", threading.current_thread().name, e)
+            return None
+        self.local.profiling = True
+        with self.lock:
+            capture["running"] += 1
+        return profile
+
+    def stop_profile(self, capture, profile):
+        try:
+            profile.disable()
+        except Exception:
+            log.exception("Could not stop profiling")
+        self.local.profiling = False
+        with self.lock:
+            capture["profiles"].append(profile)
+            capture["running"] -= 1
+            self.changed.notify_all()
+
+
+class MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves /metrics and /profile?seconds=N&sort=KEY."""
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/metrics":
+            self.send_text(200, self.server.registry.format(),
+                           "text/plain; version=0.0.4; charset=utf-8")
+        elif url.path == "/profile" and self.server.profiler is not None:
+            self.get_profile(urllib.parse.parse_qs(url.query))
+        else:
+            self.send_text(404, "Not found\n")
+
+    def get_profile(self, query):
+        try:
+            seconds = float(query.get("seconds", [PROFILE_DEFAULT_SECONDS])[0])
+        except ValueError:
+            self.send_text(400, "Invalid seconds\n")
+            return
+        sort = query.get("sort", ["cumulative"])[0]
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            self.send_text(400, "Invalid sort key\n")
+            return
+
+        stats = self.server.profiler.capture(seconds, sort,
+                                             timeout=seconds + PROFILE_MAX_WAIT_SECONDS)
+        if stats is None:
+            self.send_text(503, "Profiler is busy or no profiled code ran\n")
+        else:
+            self.send_text(200, stats)
+
+    def send_text(self, status, text, content_type="text/plain; charset=utf-8"):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("Metrics request: " + format, *args)
+
+
+def start_metrics_server(registry, profiler, port, address="127.0.0.1"):
+    """Serves the metrics of registry and profiles of profiler over HTTP from
+    a background thread.
+    """
+    server = MetricsHTTPServer((address, port), MetricsRequestHandler)
+    server.registry = registry
+    server.profiler = profiler
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server")
+    thread.daemon = True
+    thread.start()
+    log.info("Serving metrics on %s:%d", address, port)
+    return server
+
+
+def format_profile(profiles, sort):
+    """Returns the merged statistics of profiles as text, or None if none
+    of them recorded anything.
+    """
+    for profile in profiles:
+        profile.create_stats()
+    # pstats refuses to load profiles without statistics
+    profiles = [profile for profile in profiles if len(profile.stats) > 0]
+    if len(profiles) == 0:
+        return None
+    output = io.StringIO()
+    stats = pstats.Stats(*profiles, stream=output)
+    stats.sort_stats(sort).print_stats(PROFILE_STATS_LINES)
+    return output.getvalue()
+
+
+def get_remaining_seconds(deadline):
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+def format_labels(label_names, label_values):
+    """
+    >>> format_labels(("server", "le"), ("a:80", "0.5"))
+    '{server="a:80",le="0.5"}'
+    >>> format_labels((), ())
+    ''
+    """
+    if len(label_names) == 0:
+        return ""
+    labels = ['%s="%s"' % (name, escape_label_value(str(value)))
+              for name, value in zip(label_names, label_values)]
+    return "{" + ",".join(labels) + "}"
+
+
+def escape_label_value(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_value(value):
+    """
+    >>> format_value(float("inf")), format_value(2), format_value(0.25)
+    ('+Inf', '2', '0.25')
+    """
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value)
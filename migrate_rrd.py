@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import json
+import argparse
+import logging as log
+import os
+import os.path
+import collections
+import stat
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import RRDtool
+import monitoring
+
+RESHAPE_ATTEMPTS = 5
+
+
+def main():
+    args = parse_args()
+    init_logging(args.log_level)
+    config_dict = json.load(args.config_filename)
+    args.command(config_dict, args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log-level", dest="log_level", default="INFO",
+                        help="Log level (DEBUG, INFO, WARNING or ERROR)")
+    parser.add_argument("config_filename",
+                        metavar="CONFIG-FILENAME",
+                        type=argparse.FileType('r'))
+
+    subparsers = parser.add_subparsers(dest="command_name")
+    subparsers.required = True
+
+    split = subparsers.add_parser(
+        "split", help="Split the combined RRD into the shards of the sharded layout "
+        "configured with rrd-layout and rrd-directory")
+    split.add_argument("--source", dest="source", default=None,
+                       help="Combined RRD to split (default: temperature-rrd of the config)")
+    split.set_defaults(command=split_command)
+
+    reshape = subparsers.add_parser(
+        "reshape", help="Change the RRAs of the existing RRD files to those of the config "
+        "(rras or retention) while keeping their data")
+    reshape.add_argument("--no-backup", dest="backup", action="store_false",
+                         help="Do not keep the original files as <file>.bak")
+    reshape.set_defaults(command=reshape_command)
+
+    return parser.parse_args()
+
+
+def init_logging(log_level):
+    log.basicConfig(level=log_level,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+def split_command(config, args):
+    layout = config.get("rrd-layout", "single")
+    if layout == "single":
+        log.error("Set rrd-layout to a sharded layout (per-source or per-server) "
+                  "and rrd-directory in the config first")
+        sys.exit(1)
+
+    source = args.source or config["temperature-rrd"]
+    rrd_info = RRDtool.RRD(source).info()
+    ds_names = monitoring.get_data_source_names_from_info(rrd_info)
+
+    servers = {}
+    if layout == "per-server":
+        servers = get_data_source_servers(config)
+    shards = get_shards(ds_names, servers)
+
+    directory = config["rrd-directory"]
+    os.makedirs(directory, exist_ok=True)
+    for shard_name, names in shards.items():
+        filename = os.path.join(directory, shard_name + ".rrd")
+        if os.path.exists(filename):
+            log.error("RRD shard '%s' already exists", filename)
+            sys.exit(1)
+        log.info("Creating '%s' with data sources %s", filename, names)
+        create_rrd_from_source(filename, source, monitoring.get_rras(config), names,
+                               rrd_info["last_update"])
+
+    log.info("Split %d data sources into %d shards in '%s'. '%s' was left in place.",
+             len(ds_names), len(shards), directory, source)
+
+
+def reshape_command(config, args):
+    rras = monitoring.get_rras(config)
+    log.info("Target RRAs: %s", monitoring.get_rra_string(rras))
+    for filename in monitoring.get_rrd_filenames(config):
+        reshape_rrd(filename, rras, args.backup)
+
+
+def reshape_rrd(filename, rras, backup=True):
+    """Replaces an RRD with one that has the given RRAs and the data of the
+    original, converted by rrdtool from the existing RRAs.
+
+    The data collection server can keep running: the new file is built next
+    to the original and moved in place, and if the original was updated in
+    the meantime the new file is built again. The server opens the new file
+    on its next update.
+    """
+    for attempt in range(RESHAPE_ATTEMPTS):
+        signature = monitoring.get_file_signature(filename)
+        rrd_info = RRDtool.RRD(filename).info()
+        ds_names = monitoring.get_data_source_names_from_info(rrd_info)
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_rrd = tempfile.mkstemp(dir=directory, prefix=".", suffix=".rrd")
+        os.close(fd)
+        try:
+            log.info("Reshaping '%s' (%d data sources)", filename, len(ds_names))
+            run_rrdtool_create(tmp_rrd, filename, rras, ds_names, rrd_info["last_update"])
+            if monitoring.get_file_signature(filename) != signature:
+                log.info("'%s' was updated while reshaping, starting over", filename)
+                continue
+            if backup:
+                if os.path.exists(filename + ".bak"):
+                    os.remove(filename + ".bak")
+                os.link(filename, filename + ".bak")
+            # mkstemp creates the file readable by the owner only
+            os.chmod(tmp_rrd, stat.S_IMODE(os.stat(filename).st_mode))
+            os.replace(tmp_rrd, filename)
+            return
+        finally:
+            if os.path.exists(tmp_rrd):
+                os.remove(tmp_rrd)
+    log.error("'%s' kept changing while reshaping, giving up", filename)
+    sys.exit(1)
+
+
+def get_data_source_servers(config):
+    """Polls every server once to find out which data sources it reports."""
+    workers = monitoring.get_polling_worker_count(config)
+    session = monitoring.create_http_session(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        server_datas = monitoring.poll_temperature_servers(config, session, executor)
+
+    servers = {}
+    for label, data in server_datas:
+        if len(data) == 0:
+            log.warning("Server '%s' did not report any data sources", label)
+        for name in data:
+            servers.setdefault(name, label)
+    return servers
+
+
+def get_shards(ds_names, servers):
+    """Groups data sources by shard the same way ShardedRRDDatabase does.
+    Data sources without a known server get a shard of their own.
+
+    >>> list(get_shards(["a", "b", "c"], {"a": "host:5001", "c": "host:5001"}).items())
+    [('host_5001', ['a', 'c']), ('b', ['b'])]
+    """
+    shards = collections.OrderedDict()
+    for name in ds_names:
+        shard_name = monitoring.get_shard_name(servers.get(name, name))
+        shards.setdefault(shard_name, []).append(name)
+    return shards
+
+
+def create_rrd_from_source(filename, source, rras, ds_names, start):
+    """Creates an RRD with the given data sources and RRAs and fills it with
+    the data of the same named data sources of the source RRD.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_rrd = tempfile.mkstemp(dir=directory, prefix=".", suffix=".rrd")
+    os.close(fd)
+    try:
+        run_rrdtool_create(tmp_rrd, source, rras, ds_names, start)
+        # mkstemp creates the file readable by the owner only, the new file
+        # gets the permissions of the one it was split from
+        os.chmod(tmp_rrd, stat.S_IMODE(os.stat(source).st_mode))
+        os.replace(tmp_rrd, filename)
+    finally:
+        if os.path.exists(tmp_rrd):
+            os.remove(tmp_rrd)
+
+
+def run_rrdtool_create(filename, source, rras, ds_names, start):
+    # rrdtool copies the data from the source file itself, without going
+    # through an XML dump of the whole file.
+    rval = subprocess.call(["rrdtool", "create", filename,
+                            "--start", str(start),
+                            "--step", str(monitoring.STEP_SECONDS),
+                            "--source", source] +
+                           monitoring.get_dataset_string(ds_names) +
+                           monitoring.get_rra_string(rras))
+    if rval != 0:
+        log.error("rrdtool create returned: %d", rval)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,27 +4,153 @@ import json
 import argparse
 import logging as log
 import os.path
+import re
+import hmac
+import hashlib
+import math
 import RRDtool
 import requests
+import alerts
+import metrics
+import ring_buffer
+import requests.adapters
 import subprocess
 import tempfile
 import sys
 import time
 import datetime
-from lxml import etree as ET
+import collections
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+import tornado.web
+
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 3.05
+DEFAULT_READ_TIMEOUT_SECONDS = 5
+MAX_POLLING_WORKERS = 32
+CIRCUIT_BREAKER_FAILURES = 3
+MAX_BACKOFF_SECONDS = 3600
+CLOCK_RETRY_SECONDS = 10
+WRITE_RETRY_MIN_SECONDS = 1
+WRITE_RETRY_MAX_SECONDS = 60
+WRITE_JOURNAL_SYNC_SECONDS = 10
+DEFAULT_PATH = "/temperatures"
+RRD_LAYOUTS = ["single", "per-source", "per-server"]
+STEP_SECONDS = 300
+CONSOLIDATION_FUNCTIONS = ["AVERAGE", "MIN", "MAX", "LAST"]
+DEFAULT_TIER_CONSOLIDATION_FUNCTIONS = ["AVERAGE", "MIN", "MAX"]
+DEFAULT_XFF = 0.5
+# Readings older than this are unknown in the RRD, so they are not shown as
+# current readings either
+HEARTBEAT_SECONDS = 600
+MAX_PARALLEL_WRITES = 4
+PUSH_MAX_PENDING_SAMPLES = 10000
+PUSH_MAX_BODY_BYTES = 1024 * 1024
+PUSH_MAX_FUTURE_SECONDS = 300
+PUSH_RETRY_AFTER_SECONDS = 10
+DATA_SOURCE_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_]{1,19}$")
+WORKER_MAX_PENDING_SAMPLES = 10000
+WORKER_MAX_FRAME_BYTES = 16 * 1024 * 1024
+WRITER_TIMEOUT_SECONDS = 5
+# Wire format of the samples forwarded by workers, all little endian:
+#   frame    payload length, payload
+#   payload  header, strings, samples
+#   header   magic, version, sample count, string count
+#   strings  per string a length byte and UTF-8, referred to by index
+#   sample   timestamp (0 if the clock was wrong), age in milliseconds,
+#            server count, and per server its label index, reading count
+#            and (name index, value) readings
+# The writer answers every frame with the number of accepted samples, 0 if
+# it is too busy. Frames are not authenticated, so the writer must only
+# listen on loopback or a trusted network.
+WORKER_FRAME_MAGIC = b"TW"
+WORKER_FRAME_VERSION = 1
+# Sample count of a frame is 16 bits
+FRAME_MAX_SAMPLES = 65535
+FRAME_LENGTH = struct.Struct("<I")
+FRAME_HEADER = struct.Struct("<2sBHH")
+STRING_LENGTH = struct.Struct("<B")
+FRAME_MAX_STRING_BYTES = 255
+SAMPLE_HEADER = struct.Struct("<qIH")
+SERVER_HEADER = struct.Struct("<HH")
+READING = struct.Struct("<Hd")
+
+CycleTimings = collections.namedtuple("CycleTimings",
+                                      ["poll_seconds", "write_seconds"])
+
+# timestamp is None for readings taken while the system clock was invalid
+Sample = collections.namedtuple("Sample",
+                                ["timestamp", "monotonic_time", "readings"])
+
+# Readings of a worker's polling cycle, as (server label, readings) pairs
+WorkerSample = collections.namedtuple("WorkerSample",
+                                      ["timestamp", "monotonic_time", "server_datas"])
+
+registry = metrics.Registry()
+profiler = metrics.Profiler()
+cycle_seconds = registry.histogram(
+    "monitoring_cycle_seconds", "Duration of polling cycles by stage (poll, write, total).",
+    ["stage"])
+missed_cycles = registry.counter(
+    "monitoring_missed_cycles_total", "Polling cycles skipped because a cycle overran.")
+bad_clock_cycles = registry.counter(
+    "monitoring_bad_clock_cycles_total",
+    "Polling cycles whose readings were buffered because the clock was wrong.")
+fetch_seconds = registry.histogram(
+    "monitoring_fetch_seconds", "Duration of temperature server queries.", ["server"])
+fetch_failures = registry.counter(
+    "monitoring_fetch_failures_total", "Failed temperature server queries by reason.",
+    ["server", "reason"])
+circuit_open_skips = registry.counter(
+    "monitoring_circuit_open_skips_total",
+    "Polls skipped because the circuit breaker of the server was open.", ["server"])
+worker_samples = registry.counter(
+    "monitoring_worker_samples_total", "Samples accepted from worker processes.")
+forward_failures = registry.counter(
+    "monitoring_forward_failures_total",
+    "Failed attempts of a worker process to forward its samples to the writer.")
+rrd_update_seconds = registry.histogram(
+    "monitoring_rrd_update_seconds", "Duration of RRD update calls.")
+rrd_datapoints = registry.counter(
+    "monitoring_rrd_datapoints_total", "Datapoints written to the RRD.")
+rrd_write_failures = registry.counter(
+    "monitoring_rrd_write_failures_total", "Batches that could not be written to the RRD.")
+pushed_samples = registry.counter(
+    "monitoring_pushed_samples_total", "Samples accepted from push mode servers.",
+    ["server"])
+push_rejections = registry.counter(
+    "monitoring_push_rejections_total", "Rejected push requests by reason.",
+    ["server", "reason"])
+rrd_add_data_sources_seconds = registry.histogram(
+    "monitoring_rrd_add_data_sources_seconds",
+    "Duration of adding data sources to the RRD by stage (dump, restore).", ["stage"])
 
 
 def main():
     args = parse_args()
     init_logging(args.log_level)
     config_dict = json.load(args.config_filename)
-    run_monitoring_server(config_dict)
+    # Make SIGTERM unwind the main loop so that buffered readings get flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if args.worker is not None:
+        run_worker(config_dict, args.worker)
+    else:
+        run_monitoring_server(config_dict)
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--log-level", dest="log_level", default="WARNING",
                         help="Log level (DEBUG, INFO, WARNING or ERROR)")
+    parser.add_argument("--worker", dest="worker", type=int, default=None,
+                        help="Run as worker INDEX of the multi-worker mode: poll its "
+                        "part of the servers and forward the readings to the writer")
     parser.add_argument("config_filename",
                         metavar="CONFIG-FILENAME",
                         type=argparse.FileType('r'))
@@ -39,86 +165,1438 @@ def init_logging(log_level):
 def run_monitoring_server(config):
     log.info("Starting monitoring server")
     interval = config["polling-interval-seconds"]
-    log.info("Polling every %d seconds", interval)
+    if "workers" in config and config.get("rrd-layout", "single") == "single":
+        # Each partition is written separately, and every update of a single
+        # RRD would mark the data sources of the other partitions unknown
+        log.error("Multi-worker mode needs a sharded rrd-layout (per-server or per-source)")
+        sys.exit(1)
+    if "push-port" in config and config.get("rrd-layout", "single") == "single":
+        # Polling cycles move the last update of a single RRD past the
+        # timestamps of delayed pushes, which rrdtool would then refuse
+        # after they were acknowledged
+        log.error("Pushed readings need a sharded rrd-layout (per-server or per-source)")
+        sys.exit(1)
 
+    database = create_database(config)
+    buffer = create_write_buffer(config, database)
+    buffer.start()
+    ring = create_ring_buffer(config)
+    alert_engine = create_alert_engine(config)
+    if "push-port" in config:
+        PushListener(get_push_servers(config), buffer, ring,
+                     config.get("push-address", "0.0.0.0"), config["push-port"],
+                     config.get("push-max-pending-samples", PUSH_MAX_PENDING_SAMPLES),
+                     alert_engine).start()
+    if "metrics-port" in config:
+        metrics.start_metrics_server(registry, profiler, config["metrics-port"],
+                                     config.get("metrics-address", "127.0.0.1"))
+
+    try:
+        if "workers" in config:
+            WorkerListener(buffer, ring, config.get("writer-address", "127.0.0.1"),
+                           config["writer-port"],
+                           config.get("worker-max-pending-samples",
+                                      WORKER_MAX_PENDING_SAMPLES),
+                           alert_engine).start()
+            log.info("Writing the readings of %d workers", config["workers"])
+            while True:
+                time.sleep(interval)
+                if alert_engine is not None and not check_date_correctness():
+                    # Lets stale sensors be noticed without readings arriving
+                    now = int(time.time())
+                    alert_engine.evaluate(now, {}, now)
+
+        log.info("Polling every %d seconds", interval)
+        workers = get_polling_worker_count(config)
+        session = create_http_session(workers)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        healths = create_server_healths(config)
+        run_polling_loop(interval, run_monitoring_cycle, config, session, executor,
+                         buffer, ring, healths, alert_engine)
+    finally:
+        buffer.close()
+        if alert_engine is not None:
+            alert_engine.close()
+
+
+def run_worker(config, index):
+    """Polls the servers of partition index and forwards the readings to the
+    writer, the monitoring server started without --worker.
+    """
+    if not 0 <= index < config.get("workers", 0):
+        log.error("Worker index %d is not below the configured number of workers", index)
+        sys.exit(1)
+    interval = config["polling-interval-seconds"]
+    worker_config = get_worker_config(config, index)
+    log.info("Starting worker %d, polling %d of %d servers every %d seconds", index,
+             len(worker_config["servers"]), len(get_polled_servers(config)), interval)
+
+    workers = get_polling_worker_count(worker_config)
+    session = create_http_session(workers)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    healths = create_server_healths(worker_config)
+    client = WriterClient(config.get("writer-hostname", "localhost"), config["writer-port"],
+                          config.get("writer-timeout-seconds", WRITER_TIMEOUT_SECONDS),
+                          config.get("worker-max-pending-samples",
+                                     WORKER_MAX_PENDING_SAMPLES))
+    if "metrics-port" in config:
+        # Next to the metrics of the writer
+        metrics.start_metrics_server(registry, profiler, config["metrics-port"] + 1 + index,
+                                     config.get("metrics-address", "127.0.0.1"))
+    run_polling_loop(interval, run_worker_cycle, worker_config, session, executor, client,
+                     healths)
+
+
+def run_polling_loop(interval, cycle, *args):
+    """Calls cycle(*args) on every wall clock multiple of interval. cycle
+    returns the CycleTimings of the cycle.
+    """
+    deadline = get_first_deadline(interval, time.time(), time.monotonic())
     while True:
+        sleep_until(deadline)
+
+        timings = profiler.runcall(cycle, *args)
+        cycle_seconds.observe(timings.poll_seconds, "poll")
+        cycle_seconds.observe(timings.write_seconds, "write")
+        cycle_seconds.observe(timings.poll_seconds + timings.write_seconds, "total")
+        log.debug("Update done (polling %.3f s, writing %.3f s)",
+                  timings.poll_seconds, timings.write_seconds)
+
+        deadline, missed = get_next_deadline(deadline, interval, time.monotonic())
+        if missed > 0:
+            missed_cycles.inc(amount=missed)
+            log.warning("Polling cycle overran its deadline, skipping %d cycle(s)",
+                        missed)
+
+
+def run_monitoring_cycle(config, session, executor, buffer, ring=None, healths=None,
+                         alert_engine=None):
+    poll_start = time.monotonic()
+    server_datas = poll_temperature_servers(config, session, executor, healths)
+    buffer.database.set_data_source_servers(server_datas)
+    temperature_datas = merge_server_datas(server_datas)
+    write_start = time.monotonic()
+    if temperature_datas != {}:
+        timestamp = None
         if check_date_correctness():
             # If this is run on Raspberry Pi, the clock might be in date
             # 1st January 1970. We don't want to do any RRD database updates
-            # in that case as it will mess things up. Instead we wait until
-            # NTP updates the time to be correct.
-            log.error("Śkipping data update due to wrong date")
-            time.sleep(interval)
-            continue
+            # in that case as it will mess things up. Instead the readings
+            # are buffered until NTP updates the time to be correct.
+            log.error("Buffering data update due to wrong date")
+            bad_clock_cycles.inc()
+        else:
+            timestamp = int(time.time())
+            if ring is not None:
+                ring.append(timestamp, server_datas)
+        buffer.add(Sample(timestamp, write_start, temperature_datas))
+    if alert_engine is not None and not check_date_correctness():
+        # Also without readings, so that stale sensors are noticed
+        now = int(time.time())
+        alert_engine.evaluate(now, temperature_datas, now)
+    write_end = time.monotonic()
+    return CycleTimings(poll_seconds=write_start - poll_start,
+                        write_seconds=write_end - write_start)
+
+
+def run_worker_cycle(config, session, executor, client, healths=None):
+    poll_start = time.monotonic()
+    server_datas = poll_temperature_servers(config, session, executor, healths)
+    write_start = time.monotonic()
+    if merge_server_datas(server_datas) != {}:
+        timestamp = None
+        if check_date_correctness():
+            # The writer derives the timestamp from the age of the sample
+            log.error("Forwarding readings without timestamp due to wrong date")
+            bad_clock_cycles.inc()
+        else:
+            timestamp = int(time.time())
+        client.add(WorkerSample(timestamp, write_start, server_datas))
+    client.flush()
+    write_end = time.monotonic()
+    return CycleTimings(poll_seconds=write_start - poll_start,
+                        write_seconds=write_end - write_start)
+
+
+def get_first_deadline(interval, wall_time, monotonic_time):
+    """Returns the monotonic time of the next wall clock multiple of interval.
+
+    >>> get_first_deadline(300, 1437480467.5, 1000.0)
+    1132.5
+    """
+    return monotonic_time + interval - (wall_time % interval)
+
+
+def get_next_deadline(deadline, interval, now):
+    """Returns the deadline following the given one and the number of
+    deadlines that have already passed and are skipped.
+
+    >>> get_next_deadline(100.0, 10, 103.0)
+    (110.0, 0)
+    >>> get_next_deadline(100.0, 10, 135.0)
+    (140.0, 3)
+    """
+    next_deadline = deadline + interval
+    if now < next_deadline:
+        return next_deadline, 0
+    missed = int((now - next_deadline) // interval) + 1
+    return next_deadline + missed * interval, missed
+
 
-        temperature_datas = loop_temperature_servers(config)
-        if temperature_datas != {}:
-            update_data_to_rrd(config["temperature-rrd"], config["rras"],
-                               temperature_datas)
-        log.debug("Update done")
-        time.sleep(interval)
+def sleep_until(deadline):
+    delay = deadline - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
 
 
-def loop_temperature_servers(config):
+def get_polling_worker_count(config):
+    server_count = max(len(get_polled_servers(config)), 1)
+    return min(server_count, config.get("max-polling-workers", MAX_POLLING_WORKERS))
+
+
+def create_http_session(pool_size):
+    """Creates a session whose keep-alive connection pool can hold one
+    connection per polling worker.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_server_timeouts(config, server):
+    connect_timeout = server.get("connect-timeout-seconds",
+                                 config.get("connect-timeout-seconds",
+                                            DEFAULT_CONNECT_TIMEOUT_SECONDS))
+    read_timeout = server.get("read-timeout-seconds",
+                              config.get("read-timeout-seconds",
+                                         DEFAULT_READ_TIMEOUT_SECONDS))
+    return (connect_timeout, read_timeout)
+
+
+def loop_temperature_servers(config, session, executor):
+    return merge_server_datas(poll_temperature_servers(config, session, executor))
+
+
+def poll_temperature_servers(config, session, executor, healths=None):
+    """Polls all servers concurrently and returns (server label, readings)
+    pairs in configuration order.
+
+    With the ServerHealth of the servers by label, only the servers that are
+    due are polled. The others report the readings of their previous poll,
+    or nothing while they are failing.
+    """
     log.debug("Reading temperature data from servers")
+    now = time.monotonic()
+    futures = []
+    for server in get_polled_servers(config):
+        timeouts = get_server_timeouts(config, server)
+        path = server.get("path", DEFAULT_PATH)
+        label = get_server_label(server["hostname"], server["port"], path)
+        health = None if healths is None else healths.get(label)
+        if health is not None and not health.is_due(now):
+            if health.is_circuit_open():
+                circuit_open_skips.inc(label)
+            futures.append((label, health, None))
+            continue
+        futures.append((label, health, executor.submit(profiler.runcall,
+                                                       poll_temperature_server, session,
+                                                       server["hostname"], server["port"],
+                                                       timeouts, path)))
+
+    server_datas = []
+    for label, health, future in futures:
+        if future is None:
+            data = health.readings
+        else:
+            data = future.result()
+            if health is not None:
+                health.record_poll(now, data)
+        server_datas.append((label, {} if data is None else data))
+    return server_datas
+
+
+class ServerHealth:
+    """Polling schedule and circuit breaker of one temperature server.
+
+    The server is polled every interval seconds and its readings are
+    reported again on the cycles in between, so that slowly changing
+    sensors can be polled less often without leaving gaps in the RRD.
+
+    After failure_threshold consecutive failed polls the circuit opens: the
+    server is not polled for a backoff that doubles with every further
+    failure, up to max_backoff seconds, and is then probed once. A
+    successful poll closes the circuit. Polls are due when they are less
+    than tolerance seconds away, as the polling cycles do not start exactly
+    on time.
+    """
+
+    def __init__(self, label, interval, failure_threshold=CIRCUIT_BREAKER_FAILURES,
+                 max_backoff=MAX_BACKOFF_SECONDS, tolerance=0):
+        self.label = label
+        self.interval = interval
+        self.failure_threshold = max(failure_threshold, 1)
+        self.max_backoff = max_backoff
+        self.tolerance = tolerance
+        self.failures = 0
+        self.next_poll = None
+        self.readings = {}
+
+    def is_due(self, now):
+        return self.next_poll is None or now + self.tolerance >= self.next_poll
+
+    def is_circuit_open(self):
+        return self.failures >= self.failure_threshold
+
+    def record_poll(self, now, readings):
+        """Records the outcome of a poll started at now, readings being None
+        if it failed.
+        """
+        if readings is not None:
+            if self.is_circuit_open():
+                log.warning("Temperature server (%s) is back, closing its circuit", self.label)
+            self.failures = 0
+            self.readings = readings
+            self.next_poll = now + self.interval
+            return
+
+        self.failures += 1
+        self.readings = {}
+        if not self.is_circuit_open():
+            self.next_poll = now + self.interval
+            return
+        backoff = get_backoff_seconds(self.interval, self.failures - self.failure_threshold,
+                                      self.max_backoff)
+        log.warning("Temperature server (%s) failed %d times in a row, not polling it "
+                    "for %d seconds", self.label, self.failures, backoff)
+        self.next_poll = now + backoff
+
+
+def get_backoff_seconds(interval, retries, max_backoff):
+    """Returns how long to wait before probing a server again after retries
+    failed probes.
+
+    >>> [get_backoff_seconds(10, retries, 60) for retries in range(4)]
+    [20, 40, 60, 60]
+    """
+    return min(interval * 2 ** (retries + 1), max_backoff)
+
+
+def create_server_healths(config):
+    """Returns the ServerHealth of each polled server by label.
+
+    Servers can be polled less often than the main loop runs with their own
+    polling-interval-seconds. circuit-breaker-failures and
+    max-backoff-seconds can be set for all servers or per server.
+    """
+    interval = config["polling-interval-seconds"]
+    healths = {}
+    for server in get_polled_servers(config):
+        label = get_server_label(server["hostname"], server["port"],
+                                 server.get("path", DEFAULT_PATH))
+        healths[label] = ServerHealth(
+            label, max(server.get("polling-interval-seconds", interval), interval),
+            get_server_setting(config, server, "circuit-breaker-failures",
+                               CIRCUIT_BREAKER_FAILURES),
+            get_server_setting(config, server, "max-backoff-seconds", MAX_BACKOFF_SECONDS),
+            tolerance=interval / 2)
+    return healths
+
+
+def get_server_setting(config, server, key, default):
+    return server.get(key, config.get(key, default))
+
+
+def get_polled_servers(config):
+    return [server for server in config["servers"] if not server.get("push", False)]
+
+
+def get_push_servers(config):
+    """Returns the push mode servers of the config by name."""
+    return {server["name"]: server for server in config["servers"]
+            if server.get("push", False)}
+
+
+def get_worker_config(config, index):
+    """Returns the config of worker index, with the polled servers of its
+    partition only.
+    """
+    worker_config = dict(config)
+    worker_config["servers"] = [
+        server for server in get_polled_servers(config)
+        if get_worker_index(get_server_label(server["hostname"], server["port"],
+                                             server.get("path", DEFAULT_PATH)),
+                            config["workers"]) == index]
+    return worker_config
+
+
+def get_worker_index(label, workers):
+    """Returns the worker polling a server, by rendezvous hashing of its
+    label: every worker process computes the same partitions, and adding a
+    worker only moves the servers the new worker takes over.
+
+    >>> [get_worker_index("localhost:%d" % port, 3) for port in range(5001, 5011)]
+    [1, 1, 0, 0, 1, 1, 0, 1, 0, 2]
+    >>> [get_worker_index("localhost:%d" % port, 4) for port in range(5001, 5011)]
+    [1, 1, 0, 3, 1, 1, 3, 1, 3, 3]
+    """
+    def weight(index):
+        key = ("%d:%s" % (index, label)).encode("utf-8")
+        return hashlib.sha1(key).digest()
+    return max(range(workers), key=weight)
+
+
+def merge_server_datas(server_datas):
+    # Results are merged in configuration order so that the outcome does not
+    # depend on which server happened to answer first.
     temperature_datas = {}
-    for server in config["servers"]:
-        hostname = server["hostname"]
-        port = server["port"]
-        try:
-            temperature_datas.update(read_server_temperature_data(hostname, port))
-        except requests.exceptions.ConnectionError as e:
-            log.warning("Could not connect to temperature server (%s:%d): '%s'", hostname, port, e)
+    for label, data in server_datas:
+        temperature_datas.update(data)
     return temperature_datas
 
 
-def read_server_temperature_data(hostname, port):
-    url = "http://" + hostname + ":" + str(port) + "/temperatures"
+def poll_temperature_server(session, hostname, port, timeouts, path=DEFAULT_PATH):
+    """Returns the readings of a server, or None if it could not be read."""
+    server = get_server_label(hostname, port, path)
+    try:
+        with fetch_seconds.time(server):
+            return read_server_temperature_data(session, hostname, port, timeouts, path)
+    except requests.exceptions.Timeout as e:
+        fetch_failures.inc(server, "timeout")
+        log.warning("Temperature server (%s:%d) timed out: '%s'", hostname, port, e)
+    except requests.exceptions.ConnectionError as e:
+        fetch_failures.inc(server, "connection")
+        log.warning("Could not connect to temperature server (%s:%d): '%s'", hostname, port, e)
+    except ValueError as e:
+        # Before RequestException, which newer requests versions also use for
+        # invalid JSON
+        fetch_failures.inc(server, "malformed")
+        log.warning("Temperature server (%s:%d) returned malformed data: '%s'",
+                    hostname, port, e)
+    except requests.exceptions.RequestException as e:
+        fetch_failures.inc(server, "error")
+        log.warning("Querying temperature server (%s:%d) failed: '%s'", hostname, port, e)
+    return None
+
+
+def read_server_temperature_data(session, hostname, port, timeouts, path=DEFAULT_PATH):
+    url = "http://" + hostname + ":" + str(port) + path
     log.debug("Querying temperatures from: %s", url)
-    r = requests.get(url)
+    r = session.get(url, timeout=timeouts)
     if r.status_code != 200:
+        fetch_failures.inc(get_server_label(hostname, port, path), "http")
         log.warning("HTTP query to '%s' returned error: %d", url, r.status_code)
-        return {}
-    return r.json()
+        return None
+    data = r.json()
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object, got %s" % type(data).__name__)
+    return data
 
 
-def update_data_to_rrd(filename, rras, data):
-    log.debug("Updating data to RRD. Data: %s", data)
-    data_source_names = data.keys()
-    rrd = open_or_create_rrd_database_if_not_existing(filename, rras, data_source_names)
-    was_added = add_missing_data_sources(filename, rrd, data_source_names)
-    if was_added:
-        # We need to reopen the RRD database as adding was done by creating new RRD file
-        log.debug("Re-opening RRD after data sources were added")
-        rrd = open_or_create_rrd_database_if_not_existing(filename, rras, data_source_names)
+def get_server_label(hostname, port, path=DEFAULT_PATH):
+    """
+    >>> get_server_label("localhost", 5001)
+    'localhost:5001'
+    >>> get_server_label("localhost", 5001, "/hosts/3/temperatures")
+    'localhost:5001/hosts/3/temperatures'
+    """
+    label = "%s:%d" % (hostname, port)
+    if path != DEFAULT_PATH:
+        label += path
+    return label
+
+
+class RRDDatabase:
+    """Long-lived handle to the RRD file of the monitoring process.
+
+    The ordered data source names of the file are kept in memory and are
+    only re-read when data sources are added or when the file has been
+    replaced or modified by someone else.
+    """
+
+    def __init__(self, filename, rras):
+        self.filename = filename
+        self.rras = rras
+        self.rrd = None
+        self.data_source_names = []
+        self.last_update = 0
+        self.file_signature = None
+
+    def update(self, data):
+        self.update_many([(int(time.time()), data)])
+
+    def set_data_source_servers(self, server_datas):
+        # All data sources are stored in the same file
+        pass
+
+    def update_many(self, datapoints):
+        """Writes a list of (timestamp, data) pairs with a single update call.
+
+        Timestamps must be in ascending order. Datapoints that are not newer
+        than the last update of the RRD are dropped.
+        """
+        data_source_names = []
+        for timestamp, data in datapoints:
+            data_source_names.extend(get_missing_data_source_names(data_source_names,
+                                                                   data.keys()))
+        self.ensure_data_sources(data_source_names, start=datapoints[0][0] - 1)
+
+        new_datapoints = [(timestamp, data) for timestamp, data in datapoints
+                          if timestamp > self.last_update]
+        if len(new_datapoints) < len(datapoints):
+            log.warning("Dropping %d datapoint(s) older than last RRD update (%d)",
+                        len(datapoints) - len(new_datapoints), self.last_update)
+        if len(new_datapoints) == 0:
+            return
+
+        with rrd_update_seconds.time():
+            add_datapoints_to_rrd(self.rrd, self.data_source_names, new_datapoints)
+        rrd_datapoints.inc(amount=len(new_datapoints))
+        self.last_update = new_datapoints[-1][0]
+        self.file_signature = get_file_signature(self.filename)
+
+    def ensure_data_sources(self, data_source_names, start="now"):
+        if self.rrd is None or self.file_signature != get_file_signature(self.filename):
+            self.open(data_source_names, start)
+
+        missing_data_sources = get_missing_data_source_names(self.data_source_names,
+                                                             data_source_names)
+        if len(missing_data_sources) > 0:
+            add_data_sources_to_rrd(self.filename, missing_data_sources)
+            # We need to reopen the RRD database as adding was done by creating new RRD file
+            log.debug("Re-opening RRD after data sources were added")
+            self.open(data_source_names, start)
+
+    def open(self, data_source_names, start="now"):
+        self.rrd = open_or_create_rrd_database_if_not_existing(self.filename, self.rras,
+                                                               data_source_names, start)
+        rrd_info = self.rrd.info()
+        self.data_source_names = get_data_source_names_from_info(rrd_info)
+        self.last_update = rrd_info["last_update"]
+        self.file_signature = get_file_signature(self.filename)
+        log.debug("RRD data sources: %s", self.data_source_names)
+
+
+class ShardedRRDDatabase:
+    """RRD storage split into one file per data source or per temperature
+    server, all in one directory.
+
+    A new data source gets a file of its own (or is added to the small file
+    of its server) instead of forcing a rewrite of one large file, and the
+    shards touched by a batch are updated in parallel. The server of a new
+    data source is learned from set_data_source_servers(); data sources
+    whose server is not known get a file of their own.
+    """
+
+    def __init__(self, directory, rras, layout, max_parallel_writes=MAX_PARALLEL_WRITES):
+        self.directory = directory
+        self.rras = rras
+        self.layout = layout
+        self.shards = {}
+        self.shard_names = {}
+        self.servers = {}
+        self.last_update = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_parallel_writes)
+        os.makedirs(directory, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        for filename in get_shard_filenames(self.directory):
+            shard_name = os.path.splitext(os.path.basename(filename))[0]
+            shard = RRDDatabase(filename, self.rras)
+            shard.open([])
+            for name in shard.data_source_names:
+                self.shard_names.setdefault(name, shard_name)
+            self.shards[shard_name] = shard
+            self.last_update = max(self.last_update, shard.last_update)
+        log.debug("Found %d RRD shards in '%s'", len(self.shards), self.directory)
+
+    def update(self, data):
+        self.update_many([(int(time.time()), data)])
+
+    def set_data_source_servers(self, server_datas):
+        # Called from the polling thread; plain dict updates are atomic
+        for label, data in server_datas:
+            for name in data:
+                self.servers[name] = label
+
+    def update_many(self, datapoints):
+        shard_datapoints = collections.OrderedDict()
+        for timestamp, data in datapoints:
+            for name, value in data.items():
+                shard_data = shard_datapoints.setdefault(self.get_shard(name), {})
+                shard_data.setdefault(timestamp, {})[name] = value
+
+        futures = [self.executor.submit(profiler.runcall, shard.update_many,
+                                        sorted(data.items()))
+                   for shard, data in shard_datapoints.items()]
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+        self.last_update = max([self.last_update] +
+                               [shard.last_update for shard in self.shards.values()])
+        if len(errors) > 0:
+            raise errors[0]
+
+    def get_shard(self, name):
+        shard_name = self.shard_names.get(name)
+        if shard_name is None:
+            if self.layout == "per-server" and name in self.servers:
+                shard_name = get_shard_name(self.servers[name])
+            else:
+                shard_name = get_shard_name(name)
+            log.info("Storing data source '%s' in RRD shard '%s'", name, shard_name)
+            self.shard_names[name] = shard_name
+
+        shard = self.shards.get(shard_name)
+        if shard is None:
+            shard = RRDDatabase(os.path.join(self.directory, shard_name + ".rrd"), self.rras)
+            self.shards[shard_name] = shard
+        return shard
+
+
+class WriteBehindBuffer:
+    """Queues samples and writes them to an RRDDatabase in batches from a
+    background thread, so that polling never waits for the disk.
+
+    A batch is written when max_samples samples are pending, when the oldest
+    one is max_age_seconds old or when the buffer is closed. Pending samples
+    are appended to an optional journal file that is replayed on start, so a
+    crash does not lose them. Samples taken while the clock was invalid are
+    kept until the clock is valid again and then get timestamps derived from
+    the monotonic clock.
+
+    A batch that could not be written is put back in front of the pending
+    samples and retried after a delay that doubles up to
+    WRITE_RETRY_MAX_SECONDS, and stays in the journal until it is written.
+
+    Journal entries are written by the adding thread without holding the
+    buffer lock, and synced to disk at most every journal_sync_seconds
+    seconds, when a write fails and when the buffer is closed. The journal
+    is rewritten and synced after every successful write.
+
+    After every successful write the newest readings are published to an
+    optional status file, which the web server watches for changes.
+    """
+
+    def __init__(self, database, max_samples=1, max_age_seconds=0, journal_filename=None,
+                 status_filename=None, journal_sync_seconds=WRITE_JOURNAL_SYNC_SECONDS):
+        self.database = database
+        self.max_samples = max(max_samples, 1)
+        self.max_age_seconds = max_age_seconds
+        self.journal_filename = journal_filename
+        self.journal = None
+        self.journal_sync_seconds = journal_sync_seconds
+        # Monotonic time by which unsynced journal entries are synced, None
+        # if there are none
+        self.journal_sync_time = None
+        self.journal_lock = threading.Lock()
+        self.status_filename = status_filename
+        self.pending = []
+        self.closed = False
+        self.retry_delay = 0
+        self.retry_time = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="rrd-writer")
+        self.thread.daemon = True
+
+    def start(self):
+        if self.journal_filename is not None:
+            self.pending = read_journal(self.journal_filename)
+            if len(self.pending) > 0:
+                log.info("Replaying %d sample(s) from journal", len(self.pending))
+            self.journal = open(self.journal_filename, "a")
+        self.thread.start()
+
+    def add(self, sample):
+        self.add_many([sample])
+
+    def add_many(self, samples):
+        if not self.thread.is_alive():
+            log.error("RRD writer has stopped")
+            sys.exit(1)
+
+        if self.journal is None:
+            with self.condition:
+                self.pending.extend(samples)
+                self.condition.notify()
+            return
+
+        with self.journal_lock:
+            with self.condition:
+                self.pending.extend(samples)
+                self.condition.notify()
+            # Outside the buffer lock, so that the writer thread does not
+            # wait for the disk
+            write_journal_entries(self.journal, samples)
+            if self.journal_sync_time is None:
+                self.journal_sync_time = time.monotonic() + self.journal_sync_seconds
+            if time.monotonic() >= self.journal_sync_time:
+                self.sync_journal()
+
+    def get_pending_count(self):
+        with self.condition:
+            return len(self.pending)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.journal is not None:
+            with self.journal_lock:
+                self.sync_journal()
+                self.journal.close()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.is_flush_due():
+                    self.condition.wait(self.get_flush_timeout())
+                if len(self.pending) == 0:
+                    return
+                if check_date_correctness():
+                    # Readings without a valid timestamp are kept until the
+                    # clock has been corrected.
+                    if self.closed:
+                        log.error("Discarding %d sample(s) taken with wrong date",
+                                  len(self.pending))
+                        return
+                    self.condition.wait(CLOCK_RETRY_SECONDS)
+                    continue
+                batch = self.pending
+                self.pending = []
+
+            written = profiler.runcall(self.write_batch, batch)
+            if self.journal is not None:
+                with self.journal_lock:
+                    if written:
+                        self.rewrite_journal()
+                    else:
+                        self.sync_journal()
+
+            with self.condition:
+                if written:
+                    self.retry_delay = 0
+                    self.retry_time = None
+                    continue
+
+                # The journal still has the batch, it is only rewritten
+                # after a successful write
+                self.pending[:0] = batch
+                if self.closed:
+                    if self.journal is not None:
+                        log.error("Keeping %d unwritten sample(s) in the journal",
+                                  len(self.pending))
+                    else:
+                        log.error("Discarding %d unwritten sample(s)", len(self.pending))
+                    return
+                self.retry_delay = min(max(self.retry_delay * 2, WRITE_RETRY_MIN_SECONDS),
+                                       WRITE_RETRY_MAX_SECONDS)
+                self.retry_time = time.monotonic() + self.retry_delay
+                log.warning("Retrying the RRD write in %d seconds", self.retry_delay)
+
+    def is_flush_due(self):
+        if self.closed:
+            return True
+        if self.retry_time is not None:
+            return time.monotonic() >= self.retry_time
+        if len(self.pending) >= self.max_samples:
+            return True
+        return len(self.pending) > 0 and self.get_flush_timeout() <= 0
+
+    def get_flush_timeout(self):
+        if len(self.pending) == 0:
+            return None
+        if self.retry_time is not None:
+            return self.retry_time - time.monotonic()
+        age = time.monotonic() - self.pending[0].monotonic_time
+        return self.max_age_seconds - age
+
+    def write_batch(self, batch):
+        """Returns False if the batch could not be written."""
+        datapoints = get_batch_datapoints(batch, time.time(), time.monotonic())
+        log.debug("Writing %d sample(s) to RRD", len(datapoints))
+        start = time.monotonic()
+        try:
+            self.database.update_many(datapoints)
+        except Exception:
+            rrd_write_failures.inc()
+            log.exception("Could not write %d sample(s) to RRD", len(datapoints))
+            return False
+        log.debug("RRD write took %.3f s", time.monotonic() - start)
+
+        if self.status_filename is not None:
+            publish_status(self.status_filename, self.database.last_update, datapoints)
+        return True
+
+    def rewrite_journal(self):
+        """Replaces the journal with the pending samples. Called with the
+        journal lock held.
+        """
+        with self.condition:
+            pending = list(self.pending)
+        self.journal.close()
+        tmp_filename = self.journal_filename + ".tmp"
+        with open(tmp_filename, "w") as journal:
+            write_journal_entries(journal, pending)
+            os.fsync(journal.fileno())
+        os.replace(tmp_filename, self.journal_filename)
+        self.journal = open(self.journal_filename, "a")
+        self.journal_sync_time = None
+
+    def sync_journal(self):
+        """Called with the journal lock held."""
+        if self.journal_sync_time is not None:
+            os.fsync(self.journal.fileno())
+            self.journal_sync_time = None
+
+
+class PushListener:
+    """Receives readings POSTed by push mode servers and feeds them to the
+    same write buffer as the polled readings.
+
+    Runs a Tornado IOLoop in a thread of its own. Requests are refused with
+    503 while the write buffer holds more than max_pending samples, so that
+    pushing servers back off instead of growing the buffer without bound.
+    """
+
+    def __init__(self, servers, buffer, ring, address, port,
+                 max_pending=PUSH_MAX_PENDING_SAMPLES, alert_engine=None):
+        self.servers = servers
+        self.buffer = buffer
+        self.ring = ring
+        self.alert_engine = alert_engine
+        self.address = address
+        self.port = port
+        self.max_pending = max_pending
+        self.thread = threading.Thread(target=self.run, name="push-listener")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        io_loop = IOLoop()
+        io_loop.make_current()
+        application = tornado.web.Application([
+            (r"/push/([^/]+)", PushHandler, {"listener": self}),
+        ])
+        server = HTTPServer(application, max_body_size=PUSH_MAX_BODY_BYTES)
+        server.listen(self.port, self.address)
+        log.info("Accepting pushed readings on %s:%d from %d server(s)",
+                 self.address, self.port, len(self.servers))
+        io_loop.start()
+
+    def submit(self, label, samples):
+        """Queues parsed samples of a server for writing. Returns False
+        without queuing anything if the write buffer is too full.
+        """
+        if self.buffer.get_pending_count() + len(samples) > self.max_pending:
+            return False
+
+        self.buffer.database.set_data_source_servers([(label, readings)
+                                                      for timestamp, readings in samples])
+        wrong_date = check_date_correctness()
+        buffered = []
+        for timestamp, readings in samples:
+            if timestamp is None and not wrong_date:
+                timestamp = int(time.time())
+            if timestamp is not None and self.ring is not None:
+                self.ring.append(timestamp, [(label, readings)])
+            if timestamp is not None and self.alert_engine is not None:
+                self.alert_engine.evaluate(timestamp, readings, int(time.time()))
+            buffered.append(Sample(timestamp, time.monotonic(), readings))
+        self.buffer.add_many(buffered)
+        pushed_samples.inc(label, amount=len(samples))
+        return True
+
+
+class PushHandler(tornado.web.RequestHandler):
+    def initialize(self, listener):
+        self.listener = listener
+
+    def post(self, name):
+        server = self.listener.servers.get(name)
+        if server is None:
+            raise tornado.web.HTTPError(404)
+        label = get_push_server_label(name)
+
+        token = server.get("token")
+        if token is not None:
+            authorization = self.request.headers.get("Authorization", "")
+            if not hmac.compare_digest(authorization.encode("utf-8"),
+                                       ("Bearer " + token).encode("utf-8")):
+                push_rejections.inc(label, "unauthorized")
+                raise tornado.web.HTTPError(401)
+
+        max_timestamp = None
+        if not check_date_correctness():
+            max_timestamp = time.time() + PUSH_MAX_FUTURE_SECONDS
+        try:
+            samples = parse_pushed_samples(self.request.body, max_timestamp)
+        except ValueError as e:
+            push_rejections.inc(label, "invalid")
+            log.warning("Invalid readings pushed by '%s': %s", name, e)
+            self.set_status(400)
+            self.finish({"error": str(e)})
+            return
+
+        if not profiler.runcall(self.listener.submit, label, samples):
+            push_rejections.inc(label, "busy")
+            self.set_status(503)
+            self.set_header("Retry-After", str(PUSH_RETRY_AFTER_SECONDS))
+            self.finish({"error": "Too many pending readings, retry later"})
+            return
+
+        self.set_status(202)
+        self.finish({"accepted": len(samples)})
+
+
+def get_push_server_label(name):
+    return "push/%s" % name
+
+
+def parse_pushed_samples(body, max_timestamp=None):
+    """Parses a push request body into (timestamp, readings) pairs.
+
+    The body is a sample or a list of samples, each an object with the
+    readings as a mapping from data source names to numbers and an optional
+    UNIX timestamp. Raises ValueError if anything in it is not valid.
+
+    >>> parse_pushed_samples(b'{"readings": {"garage": 4.5}}')
+    [(None, {'garage': 4.5})]
+    >>> parse_pushed_samples(b'[{"timestamp": 990, "readings": {"garage": 4}}]', 1000)
+    [(990, {'garage': 4})]
+    >>> parse_pushed_samples(b'{"timestamp": 2000, "readings": {"garage": 4}}', 1000)
+    Traceback (most recent call last):
+        ...
+    ValueError: Timestamp 2000 is in the future
+    """
+    try:
+        document = json.loads(body.decode("utf-8"))
+    except UnicodeDecodeError:
+        raise ValueError("Body is not UTF-8")
+    if isinstance(document, dict):
+        document = [document]
+    if not isinstance(document, list) or len(document) == 0:
+        raise ValueError("Expected a sample or a non-empty list of samples")
+
+    samples = []
+    for entry in document:
+        if not isinstance(entry, dict) or not isinstance(entry.get("readings"), dict):
+            raise ValueError("Sample without readings")
+        timestamp = entry.get("timestamp")
+        if timestamp is not None:
+            if not isinstance(timestamp, int) or isinstance(timestamp, bool) or timestamp <= 0:
+                raise ValueError("Invalid timestamp %r" % (timestamp,))
+            if max_timestamp is not None and timestamp > max_timestamp:
+                raise ValueError("Timestamp %d is in the future" % timestamp)
+        for name, value in entry["readings"].items():
+            if DATA_SOURCE_NAME_PATTERN.match(name) is None:
+                raise ValueError("Invalid data source name %r" % name)
+            if not isinstance(value, (int, float)) or isinstance(value, bool) or \
+                    not math.isfinite(value):
+                raise ValueError("Invalid value %r for '%s'" % (value, name))
+        samples.append((timestamp, entry["readings"]))
+    return samples
+
+
+class WorkerListener:
+    """Receives the samples that worker processes forward over TCP and feeds
+    them to the write buffer, one thread per connected worker.
+
+    Frames are refused while the write buffer holds more than max_pending
+    samples, and the workers keep them until they are accepted.
+    """
+
+    def __init__(self, buffer, ring, address, port, max_pending=WORKER_MAX_PENDING_SAMPLES,
+                 alert_engine=None):
+        self.buffer = buffer
+        self.ring = ring
+        self.alert_engine = alert_engine
+        self.address = address
+        self.port = port
+        self.max_pending = max_pending
+
+    def start(self):
+        server = WorkerTCPServer((self.address, self.port), WorkerRequestHandler)
+        server.listener = self
+        thread = threading.Thread(target=server.serve_forever, name="worker-listener")
+        thread.daemon = True
+        thread.start()
+        log.info("Accepting samples of workers on %s:%d", self.address, self.port)
+
+    def submit(self, samples):
+        """Queues samples for writing. Returns False without queuing
+        anything if the write buffer is too full.
+        """
+        if self.buffer.get_pending_count() + len(samples) > self.max_pending:
+            return False
+
+        buffered = []
+        for sample in samples:
+            self.buffer.database.set_data_source_servers(sample.server_datas)
+            readings = merge_server_datas(sample.server_datas)
+            if sample.timestamp is not None and self.ring is not None:
+                self.ring.append(sample.timestamp, sample.server_datas)
+            if sample.timestamp is not None and self.alert_engine is not None:
+                self.alert_engine.evaluate(sample.timestamp, readings, int(time.time()))
+            buffered.append(Sample(sample.timestamp, sample.monotonic_time, readings))
+        self.buffer.add_many(buffered)
+        worker_samples.inc(amount=len(samples))
+        return True
+
+
+class WorkerTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class WorkerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        worker = "%s:%d" % self.client_address[:2]
+        log.info("Worker connected from %s", worker)
+        listener = self.server.listener
+        while True:
+            header = self.rfile.read(FRAME_LENGTH.size)
+            if len(header) < FRAME_LENGTH.size:
+                break
+            length, = FRAME_LENGTH.unpack(header)
+            if length > WORKER_MAX_FRAME_BYTES:
+                log.warning("Closing connection of worker %s: %d byte frame is too large",
+                            worker, length)
+                break
+            payload = self.rfile.read(length)
+            if len(payload) < length:
+                break
+            try:
+                samples = decode_worker_frame(payload, time.monotonic())
+            except ValueError as e:
+                log.warning("Closing connection of worker %s: invalid frame: %s", worker, e)
+                break
+            accepted = len(samples) if profiler.runcall(listener.submit, samples) else 0
+            self.wfile.write(FRAME_LENGTH.pack(accepted))
+        log.info("Worker %s disconnected", worker)
+
+
+class WriterClient:
+    """Forwards the samples of a worker to the writer.
+
+    Samples that could not be forwarded are kept and sent together with the
+    next ones, up to max_pending samples after which the oldest are dropped.
+    """
+
+    def __init__(self, hostname, port, timeout=WRITER_TIMEOUT_SECONDS,
+                 max_pending=WORKER_MAX_PENDING_SAMPLES):
+        self.hostname = hostname
+        self.port = port
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.pending = []
+        self.socket = None
+
+    def add(self, sample):
+        self.pending.append(get_forwardable_sample(sample))
+        if len(self.pending) > self.max_pending:
+            log.warning("Writer has not accepted samples for too long, dropping the oldest")
+            del self.pending[:len(self.pending) - self.max_pending]
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        samples = self.pending[:FRAME_MAX_SAMPLES]
+        try:
+            if self.socket is None:
+                self.socket = socket.create_connection((self.hostname, self.port),
+                                                       self.timeout)
+            self.socket.sendall(encode_worker_frame(samples, time.monotonic()))
+            accepted, = FRAME_LENGTH.unpack(receive_exactly(self.socket, FRAME_LENGTH.size))
+        except (OSError, ValueError) as e:
+            forward_failures.inc()
+            log.warning("Could not forward %d sample(s) to writer (%s:%d): '%s'",
+                        len(samples), self.hostname, self.port, e)
+            self.close()
+            return
+        if accepted == 0:
+            forward_failures.inc()
+            log.warning("Writer is busy, keeping %d sample(s)", len(self.pending))
+            return
+        del self.pending[:accepted]
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+def receive_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if chunk == b"":
+            raise ConnectionError("Connection closed by writer")
+        data += chunk
+    return data
+
+
+def encode_worker_frame(samples, now):
+    """Encodes samples into a frame, with their ages at monotonic time now.
+    Readings that are not numbers are left out.
+
+    >>> frame = encode_worker_frame([WorkerSample(1437480467, 99.5,
+    ...                                           [("localhost:5001", {"garage": 4.5})])],
+    ...                             100.0)
+    >>> len(frame)
+    61
+    >>> decode_worker_frame(frame[FRAME_LENGTH.size:], 200.0)[0].server_datas
+    [('localhost:5001', {'garage': 4.5})]
+    """
+    strings = collections.OrderedDict()
+    body = []
+    for sample in samples:
+        age = int(max(now - sample.monotonic_time, 0) * 1000)
+        body.append(SAMPLE_HEADER.pack(sample.timestamp or 0, age, len(sample.server_datas)))
+        for label, data in sample.server_datas:
+            readings = get_numeric_readings(data)
+            body.append(SERVER_HEADER.pack(strings.setdefault(label, len(strings)),
+                                           len(readings)))
+            for name, value in readings:
+                body.append(READING.pack(strings.setdefault(name, len(strings)), value))
+
+    payload = [FRAME_HEADER.pack(WORKER_FRAME_MAGIC, WORKER_FRAME_VERSION, len(samples),
+                                 len(strings))]
+    for string in strings:
+        encoded = string.encode("utf-8")
+        if len(encoded) > FRAME_MAX_STRING_BYTES:
+            raise ValueError("Name '%s' is too long to forward" % string)
+        payload.append(STRING_LENGTH.pack(len(encoded)) + encoded)
+    payload = b"".join(payload + body)
+    return FRAME_LENGTH.pack(len(payload)) + payload
+
+
+def get_forwardable_sample(sample):
+    """Returns sample without the servers and readings whose names are too
+    long for a frame, so that they can not keep the others from being
+    forwarded.
+
+    >>> sample = WorkerSample(1437480467, 99.5, [("localhost:5001",
+    ...                                           {"garage": 4.5, "x" * 300: 1.0})])
+    >>> get_forwardable_sample(sample).server_datas
+    [('localhost:5001', {'garage': 4.5})]
+    """
+    server_datas = []
+    for label, data in sample.server_datas:
+        if not is_forwardable_name(label):
+            log.warning("Not forwarding the readings of '%s', the name is too long", label)
+            continue
+        readings = {}
+        for name, value in data.items():
+            if is_forwardable_name(name):
+                readings[name] = value
+            else:
+                log.warning("Not forwarding reading '%s', the name is too long", name)
+        server_datas.append((label, readings))
+    return sample._replace(server_datas=server_datas)
+
+
+def is_forwardable_name(name):
+    return len(name.encode("utf-8")) <= FRAME_MAX_STRING_BYTES
+
+
+def get_numeric_readings(data):
+    readings = []
+    for name, value in data.items():
+        try:
+            readings.append((name, float(value)))
+        except (TypeError, ValueError):
+            log.warning("Not forwarding non-numeric reading of '%s': %r", name, value)
+    return readings
+
+
+def decode_worker_frame(payload, now):
+    """Decodes the payload of a frame into WorkerSamples, with monotonic
+    times relative to now. Raises ValueError if it is not valid.
+    """
+    try:
+        magic, version, sample_count, string_count = FRAME_HEADER.unpack_from(payload)
+        if magic != WORKER_FRAME_MAGIC or version != WORKER_FRAME_VERSION:
+            raise ValueError("Unknown frame format")
+        offset = FRAME_HEADER.size
+        strings = []
+        for i in range(string_count):
+            length, = STRING_LENGTH.unpack_from(payload, offset)
+            offset += STRING_LENGTH.size
+            strings.append(payload[offset:offset + length].decode("utf-8"))
+            offset += length
+
+        samples = []
+        for i in range(sample_count):
+            timestamp, age, server_count = SAMPLE_HEADER.unpack_from(payload, offset)
+            offset += SAMPLE_HEADER.size
+            server_datas = []
+            for j in range(server_count):
+                label, reading_count = SERVER_HEADER.unpack_from(payload, offset)
+                offset += SERVER_HEADER.size
+                data = {}
+                for k in range(reading_count):
+                    name, value = READING.unpack_from(payload, offset)
+                    offset += READING.size
+                    data[strings[name]] = value
+                server_datas.append((strings[label], data))
+            samples.append(WorkerSample(timestamp or None, now - age / 1000, server_datas))
+    except (struct.error, IndexError) as e:
+        raise ValueError("Truncated or corrupted frame: %s" % e)
+    return samples
+
+
+def create_database(config):
+    layout = config.get("rrd-layout", "single")
+    if layout not in RRD_LAYOUTS:
+        log.error("Unknown RRD layout '%s'", layout)
+        sys.exit(1)
+    if layout == "single":
+        return RRDDatabase(config["temperature-rrd"], get_rras(config))
+    return ShardedRRDDatabase(config["rrd-directory"], get_rras(config), layout,
+                              config.get("max-parallel-writes", MAX_PARALLEL_WRITES))
+
+
+def get_rrd_filenames(config):
+    """Returns the RRD files of the configured storage layout."""
+    if config.get("rrd-layout", "single") == "single":
+        return [config["temperature-rrd"]]
+    return get_shard_filenames(config["rrd-directory"])
+
+
+def get_shard_filenames(directory):
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    # Hidden files are temporary files of RRD rewrites
+    return [os.path.join(directory, name) for name in sorted(names)
+            if name.endswith(".rrd") and not name.startswith(".")]
+
+
+def get_shard_name(name):
+    """Returns a file name safe shard name for a data source or server.
+
+    >>> get_shard_name("localhost:5001/hosts/3/temperatures")
+    'localhost_5001_hosts_3_temperatures'
+    """
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name).strip("._") or "_"
+
+
+def create_alert_engine(config):
+    try:
+        return alerts.create_alert_engine(config)
+    except (KeyError, ValueError) as e:
+        log.error("Invalid alerts configuration: %s", e)
+        sys.exit(1)
+
+
+def create_ring_buffer(config):
+    if "ring-buffer" not in config:
+        return None
+    ring = ring_buffer.RingBufferWriter(config["ring-buffer"],
+                                        config.get("ring-buffer-slots",
+                                                   ring_buffer.DEFAULT_SLOTS),
+                                        config.get("ring-buffer-rows",
+                                                   ring_buffer.DEFAULT_ROWS))
+    return ServerReadingsRing(ring)
+
+
+class ServerReadingsRing:
+    """Appends rows with the newest readings of every server to a ring
+    buffer.
+
+    Polled, pushed and forwarded readings arrive separately, but readers
+    take the newest row as the current readings. Every row therefore also
+    has the newest readings of the other servers that are at most
+    stale_seconds older than it.
+    """
+
+    def __init__(self, ring, stale_seconds=HEARTBEAT_SECONDS):
+        self.ring = ring
+        self.stale_seconds = stale_seconds
+        self.server_readings = {}
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, server_datas):
+        """Appends a row for the (server label, readings) pairs received at
+        timestamp.
+        """
+        with self.lock:
+            for label, data in server_datas:
+                previous = self.server_readings.get(label)
+                if previous is None or previous[0] <= timestamp:
+                    self.server_readings[label] = (timestamp, data)
+            readings = {}
+            for label, (data_timestamp, data) in sorted(self.server_readings.items()):
+                if data_timestamp >= timestamp - self.stale_seconds:
+                    readings.update(data)
+            self.ring.append(timestamp, readings)
+
+
+def create_write_buffer(config, database):
+    return WriteBehindBuffer(database,
+                             max_samples=config.get("write-batch-size", 1),
+                             max_age_seconds=config.get("write-batch-max-age-seconds", 0),
+                             journal_filename=config.get("write-journal"),
+                             status_filename=config.get("status-file"),
+                             journal_sync_seconds=config.get("write-journal-sync-seconds",
+                                                             WRITE_JOURNAL_SYNC_SECONDS))
+
+
+def publish_status(filename, last_update, datapoints):
+    """Atomically replaces the status file with the last update time of the
+    RRD and the newest reading of every data source in datapoints.
+    """
+    readings = {}
+    for timestamp, data in datapoints:
+        readings.update(data)
+
+    tmp_filename = filename + ".tmp"
+    try:
+        with open(tmp_filename, "w") as f:
+            json.dump({"last_update": last_update, "readings": readings}, f)
+        os.replace(tmp_filename, filename)
+    except OSError as e:
+        log.warning("Could not write status file '%s': %s", filename, e)
+
+
+def get_batch_datapoints(batch, wall_time, monotonic_time):
+    """Converts samples to (timestamp, data) pairs in ascending time order.
+
+    Samples without a timestamp get one derived from their monotonic time and
+    samples that fall on the same second are merged.
 
-    add_datapoints_to_rrd(rrd, data)
+    >>> batch = [Sample(None, 10.0, {"a": 1}), Sample(1000, 15.2, {"b": 2}),
+    ...          Sample(1000, 15.7, {"a": 3})]
+    >>> get_batch_datapoints(batch, 1010.0, 25.0)
+    [(995, {'a': 1}), (1000, {'b': 2, 'a': 3})]
+    """
+    datapoints = collections.OrderedDict()
+    for sample in batch:
+        timestamp = sample.timestamp
+        if timestamp is None:
+            timestamp = int(wall_time - (monotonic_time - sample.monotonic_time))
+        datapoints.setdefault(timestamp, {}).update(sample.readings)
+    return sorted(datapoints.items(), key=lambda x: x[0])
+
+
+def write_journal_entries(journal, samples):
+    for sample in samples:
+        journal.write(json.dumps({"timestamp": sample.timestamp,
+                                  "readings": sample.readings}) + "\n")
+    journal.flush()
+
+
+def read_journal(filename):
+    samples = []
+    try:
+        with open(filename) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Most likely the last line of a write interrupted by a crash
+                    log.warning("Ignoring corrupted journal line: %r", line)
+                    continue
+                if entry["timestamp"] is None:
+                    log.warning("Dropping journaled sample taken with wrong date")
+                    continue
+                samples.append(Sample(entry["timestamp"], time.monotonic(),
+                                      entry["readings"]))
+    except FileNotFoundError:
+        pass
+    return samples
+
+
+def get_file_signature(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def update_data_to_rrd(database, data):
+    log.debug("Updating data to RRD. Data: %s", data)
+    database.update(data)
 
 
-def open_or_create_rrd_database_if_not_existing(filename, rras, data_source_names):
+def open_or_create_rrd_database_if_not_existing(filename, rras, data_source_names,
+                                                start="now"):
     if not os.path.exists(filename):
-        return create_rrd_database(filename, rras, data_source_names)
+        return create_rrd_database(filename, rras, data_source_names, start)
     else:
         log.debug("Using existing RRD database file: %s", filename)
         return RRDtool.RRD(filename)
 
 
-def create_rrd_database(filename, rras, data_source_names):
+def create_rrd_database(filename, rras, data_source_names, start="now"):
     log.info("Creating empty RRD: %s", filename)
     rra_string = get_rra_string(rras)
     ds_string = get_dataset_string(data_source_names)
 
-    rrd = RRDtool.create(filename, "--start", "now", "--step", "300",
+    rrd = RRDtool.create(filename, "--start", str(start), "--step", str(STEP_SECONDS),
                          rra_string, ds_string)
 
     log.info("RRD created")
     return rrd
 
 
+def get_rras(config):
+    """Returns the RRAs of new RRD files: the rras of the config as such, or
+    those planned from its retention tiers.
+    """
+    if "rras" in config:
+        return config["rras"]
+    return plan_rras(config["retention"], config.get("rra-xff", DEFAULT_XFF))
+
+
+def plan_rras(retention, xff=DEFAULT_XFF, step=STEP_SECONDS):
+    """Turns retention tiers into RRAs.
+
+    A tier keeps rows of resolution-seconds for keep-seconds, with one RRA
+    for each of its consolidation-functions (by default AVERAGE, MIN and
+    MAX), so that long ranges and their extremes can be read from a few
+    pre-consolidated rows.
+
+    >>> rras = plan_rras([{"resolution-seconds": 300, "keep-seconds": 86400,
+    ...                    "consolidation-functions": ["AVERAGE"]},
+    ...                   {"resolution-seconds": 86400, "keep-seconds": 31622400}])
+    >>> [(rra["type"], rra["steps"], rra["rows"]) for rra in rras]
+    [('AVERAGE', 1, 288), ('AVERAGE', 288, 366), ('MIN', 288, 366), ('MAX', 288, 366)]
+    """
+    rras = []
+    for tier in retention:
+        resolution = tier["resolution-seconds"]
+        if resolution % step != 0:
+            raise ValueError("Resolution %d s is not a multiple of the %d s step" %
+                             (resolution, step))
+        rows = -(-tier["keep-seconds"] // resolution)
+        for cf in tier.get("consolidation-functions", DEFAULT_TIER_CONSOLIDATION_FUNCTIONS):
+            rras.append({"type": cf, "xff": xff, "steps": resolution // step, "rows": rows})
+    return rras
+
+
 def get_rra_string(rra_configs):
+    """
+    >>> get_rra_string([{"type": "MAX", "xff": 0.5, "steps": 12, "rows": 168}])
+    ['RRA:MAX:0.5:12:168']
+    """
     rras = []
     for rra in rra_configs:
         log.debug("RRA for '%s'", rra)
+        if rra["type"] not in CONSOLIDATION_FUNCTIONS:
+            raise ValueError("Unknown consolidation function '%s'" % rra["type"])
         rras.append("RRA:%(type)s:%(xff)s:%(steps)s:%(rows)s" % rra)
 
     log.debug("RRAs are: %s", rras)
@@ -130,7 +1608,7 @@ def get_dataset_string(data_source_names):
     for dataset_name in data_source_names:
         log.debug("Creating dataset '%s'", dataset_name)
         dataset = {"name": dataset_name, "type": "GAUGE",
-                   "timeout": 600, "min": -100, "max": 100}
+                   "timeout": HEARTBEAT_SECONDS, "min": -100, "max": 100}
         datasets.append("DS:%(name)s:%(type)s:%(timeout)s:%(min)s:%(max)s"
                         % dataset)
 
@@ -138,17 +1616,21 @@ def get_dataset_string(data_source_names):
     return datasets
 
 
-def add_missing_data_sources(filename, rrd, data_source_names):
-    missing_data_sources = get_missing_data_source_names(rrd, data_source_names)
-    if len(missing_data_sources) > 0:
-        add_data_sources_to_rrd(filename, missing_data_sources)
-        return True
-    return False
+def get_missing_data_source_names(known_data_source_names, data_source_names):
+    known = set(known_data_source_names)
+    return [name for name in data_source_names if name not in known]
 
 
-def get_missing_data_source_names(rrd, data_source_names):
-    rrd_info = rrd.info()
-    return set(data_source_names) - set(get_data_source_names_from_info(rrd_info))
+def get_data_source_files(rrd_infos):
+    """Maps data source names to the RRD files storing them, given the info
+    of each file in a mapping from file names to infos. If several files
+    have a data source with the same name, the first one wins.
+    """
+    data_source_files = collections.OrderedDict()
+    for filename, rrd_info in rrd_infos.items():
+        for name in get_data_source_names_from_info(rrd_info):
+            data_source_files.setdefault(name, filename)
+    return data_source_files
 
 
 def get_data_source_names_from_info(rrd_info):
@@ -222,114 +1704,126 @@ def get_data_source_names_from_info(rrd_info):
     return [n for n, index in sorted(names.items(), key=lambda x: x[1])]
 
 
+def get_rras_from_info(rrd_info):
+    rras = []
+    index = 0
+    while "rra[%d].cf" % index in rrd_info:
+        prefix = "rra[%d]." % index
+        rras.append({"index": index,
+                     "cf": rrd_info[prefix + "cf"],
+                     "pdp_per_row": rrd_info[prefix + "pdp_per_row"],
+                     "rows": rrd_info[prefix + "rows"]})
+        index += 1
+    return rras
+
+
 def add_data_sources_to_rrd(filename, data_sources):
     log.debug("Adding missing data sources to RRD: %s", list(data_sources))
-    tmp_xml = dump_rrd_to_temp_file(filename)
-    tmp_xml = add_data_sources_to_rrd_xml_file(tmp_xml, data_sources)
-    restore_rrd_from_xml(filename, tmp_xml)
+    # The dump is streamed through a filter into a temporary file next to the
+    # RRD so that memory use does not depend on the size of the RRD and the
+    # (possibly large) XML does not end up on a RAM backed /tmp.
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".xml") as tmp_xml:
+        with rrd_add_data_sources_seconds.time("dump"):
+            dump = subprocess.Popen(["rrdtool", "dump", filename], stdout=subprocess.PIPE)
+            add_data_sources_to_rrd_xml_stream(dump.stdout, tmp_xml, data_sources)
+            dump.stdout.close()
+            rval = dump.wait()
+        if rval != 0:
+            log.error("rrdtool dump returned: %d", rval)
+            sys.exit(1)
+
+        tmp_xml.flush()
+        with rrd_add_data_sources_seconds.time("restore"):
+            restore_rrd_from_xml(filename, tmp_xml.name)
     log.debug("Data sources added")
 
 
-def dump_rrd_to_temp_file(rrd_filename):
-    tmp_xml = tempfile.TemporaryFile()
-    rval = subprocess.call(["rrdtool", "dump", rrd_filename], stdout=tmp_xml)
-    if rval != 0:
-        log.error("rrdtool dump returned: %d", rval)
-        sys.exit(1)
-
-    tmp_xml.seek(0)
-    return tmp_xml
-
-
-def restore_rrd_from_xml(rrd_filename, tmp_xml):
+def restore_rrd_from_xml(rrd_filename, xml_filename):
+    """Restores the XML into a temporary RRD and atomically replaces the
+    original file with it, so a crash never leaves a truncated RRD behind.
+    """
     log.debug("Restoring XML back to RRD")
-    rval = subprocess.call(["rrdtool", "restore", "--force-overwrite", tmp_xml.name, rrd_filename])
-    if rval != 0:
-        log.error("rrdtool restore returned: %d", rval)
-        sys.exit(1)
-
-
-def add_data_sources_to_rrd_xml_file(rrd_xml_file, data_sources):
-    log.debug("Parsing RRD XML")
-    xml = ET.parse(rrd_xml_file)
-
-    ds_elems = []
+    directory = os.path.dirname(os.path.abspath(rrd_filename))
+    fd, tmp_rrd = tempfile.mkstemp(dir=directory, prefix=".", suffix=".rrd")
+    os.close(fd)
+    try:
+        rval = subprocess.call(["rrdtool", "restore", "--force-overwrite",
+                                xml_filename, tmp_rrd])
+        if rval != 0:
+            log.error("rrdtool restore returned: %d", rval)
+            sys.exit(1)
+        # mkstemp creates the file readable by the owner only
+        os.chmod(tmp_rrd, stat.S_IMODE(os.stat(rrd_filename).st_mode))
+        os.replace(tmp_rrd, rrd_filename)
+    finally:
+        if os.path.exists(tmp_rrd):
+            os.remove(tmp_rrd)
+
+
+def add_data_sources_to_rrd_xml_stream(rrd_xml, output, data_sources):
+    """Copies an 'rrdtool dump' XML stream line by line to output while
+    adding the given data sources to it.
+
+    The new <ds> definitions are inserted before the first <rra>, and every
+    <cdp_prep> and <row> gets an unknown value for each new data source.
+    """
+    ds_xml = get_data_source_xml(data_sources)
+    cdp_prep_xml = get_cdp_prep_xml(data_sources) + b"</cdp_prep>"
+    row_xml = b"<v>NaN</v>" * len(data_sources) + b"</row>"
+
+    ds_inserted = False
+    for line in rrd_xml:
+        if b"</row>" in line:
+            line = line.replace(b"</row>", row_xml)
+        elif b"</cdp_prep>" in line:
+            line = line.replace(b"</cdp_prep>", cdp_prep_xml)
+        elif not ds_inserted and b"<rra>" in line:
+            line = line.replace(b"<rra>", ds_xml + b"<rra>", 1)
+            ds_inserted = True
+        output.write(line)
+
+
+def get_data_source_xml(data_sources):
+    ds_xml = []
     for data_source_name in data_sources:
-        ds = ET.Element("ds")
-        name = ET.SubElement(ds, "name")
-        ds_type = ET.SubElement(ds, "type")
-        minimal_heartbeat = ET.SubElement(ds, "minimal_heartbeat")
-        ds_min = ET.SubElement(ds, "min")
-        ds_max = ET.SubElement(ds, "max")
-        last_ds = ET.SubElement(ds, "last_ds")
-        value = ET.SubElement(ds, "value")
-        unknown_sec = ET.SubElement(ds, "unknown_sec")
-
-        name.text = data_source_name
-        ds_type.text = "GAUGE"
-        minimal_heartbeat.text = "600"
-        ds_min.text = "-1.0000000000e+02"
-        ds_max.text = "1.0000000000e+02"
-        last_ds.text = "U"
-        value.text = "0.0000000000e+00"
-        unknown_sec.text = "167"
-        ds_elems.append(ds)
-
-    root = xml.getroot()
-    rra_index = root.index(root.find("rra"))
-
-    log.debug("Inserting <ds> elements")
-    for ds_elem in ds_elems:
-        root.insert(rra_index, ds_elem)
-
-    rra_elems = root.findall("rra")
-    for rra_elem in rra_elems:
-        cdp_prep_elem = rra_elem.find("cdp_prep")
-
-        log.debug("Inserting <ds> elements in <cdp_prep>")
-        for data_source_name in data_sources:
-            ds_elem = ET.Element("ds")
-            primary_value = ET.SubElement(ds_elem, "primary_value")
-            secondary_value = ET.SubElement(ds_elem, "secondary_value")
-            value = ET.SubElement(ds_elem, "value")
-            unknown_datapoints = ET.SubElement(ds_elem, "unknown_datapoints")
-
-            primary_value.text = "NaN"
-            secondary_value.text = "NaN"
-            value.text = "NaN"
-            unknown_datapoints.text = "0"
-            cdp_prep_elem.append(ds_elem)
-
-        database_elem = rra_elem.find("database")
-
-        log.debug("Adding <v> elements to database")
-        for row in database_elem.findall("row"):
-            for data_source_name in data_sources:
-                v = ET.Element("v")
-                v.text = "NaN"
-                row.append(v)
-
-    tmp_xml = tempfile.NamedTemporaryFile()
-    xml.write(tmp_xml)
-    tmp_xml.seek(0)
-    return tmp_xml
-
-
-def add_datapoints_to_rrd(rrd, datapoints):
+        ds_xml.append("<ds>"
+                      "<name>%s</name>"
+                      "<type>GAUGE</type>"
+                      "<minimal_heartbeat>600</minimal_heartbeat>"
+                      "<min>-1.0000000000e+02</min>"
+                      "<max>1.0000000000e+02</max>"
+                      "<last_ds>U</last_ds>"
+                      "<value>0.0000000000e+00</value>"
+                      "<unknown_sec>167</unknown_sec>"
+                      "</ds>\n" % data_source_name)
+    return "".join(ds_xml).encode("utf-8")
+
+
+def get_cdp_prep_xml(data_sources):
+    ds_xml = ("<ds>"
+              "<primary_value>NaN</primary_value>"
+              "<secondary_value>NaN</secondary_value>"
+              "<value>NaN</value>"
+              "<unknown_datapoints>0</unknown_datapoints>"
+              "</ds>")
+    return (ds_xml * len(data_sources)).encode("utf-8")
+
+
+def add_datapoints_to_rrd(rrd, ds_names, datapoints):
     log.debug("Adding data '%s' to RRD", datapoints)
-    rrd_info = rrd.info()
-    ds_names = get_data_source_names_from_info(rrd_info)
-
-    values = []
-    for ds_name in ds_names:
-        if ds_name in datapoints:
-            values.append("%s" % datapoints[ds_name])
-        else:
-            values.append("U")
-
-    value_str = "N:" + ":".join(values)
-    log.debug("Updating RRD with Value str: %s", value_str)
-    rrd.update([value_str])
+    value_strs = []
+    for timestamp, data in datapoints:
+        values = []
+        for ds_name in ds_names:
+            if ds_name in data:
+                values.append("%s" % data[ds_name])
+            else:
+                values.append("U")
+        value_strs.append("%d:" % timestamp + ":".join(values))
+
+    log.debug("Updating RRD with Value strs: %s", value_strs)
+    rrd.update(value_strs)
 
 
 def check_date_correctness():
@@ -0,0 +1,334 @@
+"""Fixed size, memory mapped ring buffer of the most recent readings.
+
+monitoring.py appends the readings of every polling cycle and server.py
+maps the same file read-only to answer queries about current values
+without touching the RRD.
+
+File layout, little endian:
+
+    header   magic, version, slot count, row count, sequence, head
+    names    slot count * NAME_BYTES, UTF-8, NUL padded
+    times    row count * int64 timestamps
+    values   row count * slot count float32, NaN for unknown
+
+head counts the rows ever written; row head % rows is written next. The
+writer makes the sequence odd while it modifies the file and even again
+when done, so readers retry when the sequence changed under them.
+"""
+
+import bisect
+import logging as log
+import mmap
+import os
+import os.path
+import struct
+import tempfile
+import threading
+import time
+import numpy
+
+MAGIC = b"TEMPRING"
+VERSION = 1
+# magic, version, slot count, row count, padding
+HEADER = struct.Struct("<8sIII4x")
+SEQUENCE_OFFSET = HEADER.size
+NAMES_OFFSET = 64
+NAME_BYTES = 32
+DEFAULT_SLOTS = 256
+DEFAULT_ROWS = 8640
+READ_RETRIES = 100
+# Readable by a web server running as another user
+FILE_MODE = 0o644
+
+
+class RingBufferLayout:
+    """Numpy views of the sections of a mapped ring buffer file."""
+
+    def __init__(self, buffer, slots, rows):
+        self.slots = slots
+        self.rows = rows
+        self.counters = numpy.ndarray((2,), "<u8", buffer, SEQUENCE_OFFSET)
+        self.names = numpy.ndarray((slots,), "S%d" % NAME_BYTES, buffer, NAMES_OFFSET)
+        times_offset = NAMES_OFFSET + slots * NAME_BYTES
+        self.times = numpy.ndarray((rows,), "<i8", buffer, times_offset)
+        self.values = numpy.ndarray((rows, slots), "<f4", buffer, times_offset + rows * 8)
+
+    @staticmethod
+    def get_file_size(slots, rows):
+        """
+        >>> RingBufferLayout.get_file_size(2, 3)
+        176
+        """
+        return NAMES_OFFSET + slots * NAME_BYTES + rows * 8 + rows * slots * 4
+
+
+class RingBufferWriter:
+    """Appends readings to a ring buffer file, creating it if it does not
+    exist or has a different size. Sensors get the next free slot the first
+    time they are seen; readings of sensors that do not fit are dropped, as
+    are readings of sensors whose names are longer than NAME_BYTES.
+    """
+
+    def __init__(self, filename, slots=DEFAULT_SLOTS, rows=DEFAULT_ROWS):
+        self.filename = filename
+        self.slots = slots
+        self.rows = rows
+        self.file = None
+        self.layout = None
+        self.slot_names = {}
+        self.full_warned = False
+        self.long_names = set()
+        self.lock = threading.Lock()
+        self.open()
+
+    def open(self):
+        if get_geometry(self.filename) != (self.slots, self.rows):
+            log.info("Creating ring buffer '%s' with %d slots and %d rows",
+                     self.filename, self.slots, self.rows)
+            create_ring_buffer_file(self.filename, self.slots, self.rows)
+
+        self.file = open(self.filename, "r+b")
+        buffer = mmap.mmap(self.file.fileno(), 0)
+        self.layout = RingBufferLayout(buffer, self.slots, self.rows)
+        sequence = int(self.layout.counters[0])
+        if sequence % 2 == 1:
+            # A writer died while appending, readers would keep waiting for
+            # it to finish
+            log.warning("Ring buffer '%s' was left in the middle of a write", self.filename)
+            self.layout.counters[0] = sequence + 1
+        self.slot_names = {}
+        for slot, name in enumerate(self.layout.names):
+            if name != b"":
+                self.slot_names[decode_name(name)] = slot
+
+    def append(self, timestamp, readings):
+        """Appends a row, unless it is older than the newest row as readers
+        rely on the rows being in time order.
+        """
+        with self.lock:
+            self.append_row(timestamp, readings)
+
+    def append_row(self, timestamp, readings):
+        layout = self.layout
+        newest = get_row_time(layout, -1)
+        if newest is not None and timestamp < newest:
+            log.debug("Not adding readings of %d to ring buffer, it has newer ones",
+                      timestamp)
+            return
+        new_names = []
+        row = numpy.full(self.slots, numpy.nan, dtype="<f4")
+        for name, value in readings.items():
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                log.warning("Ignoring non-numeric reading of '%s' in ring buffer: %r",
+                            name, value)
+                continue
+            slot = self.slot_names.get(name)
+            if slot is None:
+                if len(name.encode("utf-8")) > NAME_BYTES:
+                    if name not in self.long_names:
+                        log.warning("Not adding '%s' to ring buffer, the name is longer "
+                                    "than %d bytes", name, NAME_BYTES)
+                        self.long_names.add(name)
+                    continue
+                slot = self.get_free_slot(name, len(new_names))
+                if slot is None:
+                    continue
+                new_names.append((slot, name))
+            row[slot] = value
+
+        sequence, head = (int(c) for c in layout.counters)
+        layout.counters[0] = sequence + 1
+        for slot, name in new_names:
+            layout.names[slot] = name.encode("utf-8")
+            self.slot_names[name] = slot
+        index = head % self.rows
+        layout.times[index] = timestamp
+        layout.values[index] = row
+        layout.counters[1] = head + 1
+        layout.counters[0] = sequence + 2
+
+    def get_free_slot(self, name, pending):
+        slot = len(self.slot_names) + pending
+        if slot < self.slots:
+            return slot
+        if not self.full_warned:
+            log.warning("Ring buffer has no free slot for '%s', increase ring-buffer-slots",
+                        name)
+            self.full_warned = True
+        return None
+
+
+class RingBufferReader:
+    """Read-only view of a ring buffer file. The file is mapped again when
+    the writer has replaced it.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file_id = None
+        self.layout = None
+
+    def check(self):
+        """Returns False if the file does not exist or is not valid."""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return False
+        file_id = (stat.st_dev, stat.st_ino)
+        if file_id != self.file_id:
+            geometry = get_geometry(self.filename)
+            if geometry is None:
+                return False
+            with open(self.filename, "rb") as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.layout = RingBufferLayout(buffer, *geometry)
+            self.file_id = file_id
+        return True
+
+    def read(self, function):
+        """Calls function(layout) until it ran without the writer modifying
+        the file at the same time and returns its result.
+        """
+        if not self.check():
+            return None
+        layout = self.layout
+        for i in range(READ_RETRIES):
+            sequence = int(layout.counters[0])
+            if sequence % 2 == 0:
+                result = function(layout)
+                if int(layout.counters[0]) == sequence:
+                    return result
+            time.sleep(0.0001)
+        raise RuntimeError("Could not get a consistent read of '%s'" % self.filename)
+
+    def get_last_update(self):
+        return self.read(lambda layout: get_row_time(layout, -1))
+
+    def get_latest(self):
+        """Returns the time of the newest row and a mapping from sensor names
+        to their values in it, or None if nothing has been written yet.
+        """
+        def latest(layout):
+            head = int(layout.counters[1])
+            if head == 0:
+                return None
+            index = (head - 1) % layout.rows
+            values = layout.values[index]
+            readings = {}
+            for slot, name in enumerate(layout.names):
+                if name != b"":
+                    readings[decode_name(name)] = float(values[slot])
+            return int(layout.times[index]), readings
+        return self.read(latest)
+
+    def get_recent(self, name, seconds):
+        """Returns the timestamps and values of a sensor over the newest
+        seconds seconds, oldest first. Returns None for unknown sensors.
+        """
+        def recent(layout):
+            encoded = name.encode("utf-8")
+            if len(encoded) > NAME_BYTES:
+                return None
+            slots = numpy.flatnonzero(layout.names == encoded)
+            head = int(layout.counters[1])
+            if len(slots) == 0 or head == 0:
+                return None
+            count = min(head, layout.rows)
+            end = int(layout.times[(head - 1) % layout.rows])
+            # Row times are ascending in logical order, so the first row to
+            # return can be found without reading all of them.
+            logical = LogicalTimes(layout, head, count)
+            first = bisect.bisect_left(logical, end - seconds)
+            times = []
+            values = []
+            for start, stop in get_ring_slices(head - count + first, head, layout.rows):
+                times.append(layout.times[start:stop])
+                values.append(layout.values[start:stop, slots[0]])
+            return numpy.concatenate(times), numpy.concatenate(values)
+        return self.read(recent)
+
+
+class LogicalTimes:
+    """Sequence of the row times of a ring buffer, oldest first."""
+
+    def __init__(self, layout, head, count):
+        self.layout = layout
+        self.first = head - count
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return int(self.layout.times[(self.first + i) % self.layout.rows])
+
+
+def create_ring_buffer_file(filename, slots, rows):
+    """Creates an empty ring buffer and moves it in place atomically, so that
+    readers never map a partially written file.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix=".")
+    try:
+        os.fchmod(fd, FILE_MODE)
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, slots, rows))
+            f.truncate(RingBufferLayout.get_file_size(slots, rows))
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def get_geometry(filename):
+    """Returns the (slots, rows) of a ring buffer file, or None if the file
+    does not exist or is not a ring buffer.
+    """
+    try:
+        with open(filename, "rb") as f:
+            header = f.read(HEADER.size)
+            size = os.fstat(f.fileno()).st_size
+    except OSError:
+        return None
+    if len(header) < HEADER.size:
+        return None
+    magic, version, slots, rows = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION or \
+            size != RingBufferLayout.get_file_size(slots, rows):
+        return None
+    return slots, rows
+
+
+def decode_name(name):
+    # Files written by older versions may have names cut in the middle of a
+    # character
+    return name.decode("utf-8", "replace")
+
+
+def get_row_time(layout, offset):
+    head = int(layout.counters[1])
+    if head == 0:
+        return None
+    return int(layout.times[(head + offset) % layout.rows])
+
+
+def get_ring_slices(start, stop, rows):
+    """Splits the logical row range [start, stop) into at most two
+    contiguous (start, stop) index ranges of the ring.
+
+    >>> get_ring_slices(8, 12, 10)
+    [(8, 10), (0, 2)]
+    >>> get_ring_slices(3, 5, 10)
+    [(3, 5)]
+    >>> get_ring_slices(5, 5, 10)
+    []
+    """
+    if start >= stop:
+        return []
+    first = start % rows
+    length = stop - start
+    if first + length <= rows:
+        return [(first, first + length)]
+    return [(first, rows), (0, first + length - rows)]
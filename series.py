@@ -0,0 +1,169 @@
+import collections
+import logging as log
+import math
+import threading
+import warnings
+import rrdtool
+import RRDtool
+import numpy
+import monitoring
+
+# Schemas of RRD files keyed by (filename, device, inode). RRAs and data
+# sources only change when the file is replaced, e.g. when data sources are
+# added, so the modification time does not need to be part of the key.
+rrd_schemas = {}
+rrd_schemas_lock = threading.Lock()
+
+
+def get_rrd_schema(rrd_filename):
+    signature = monitoring.get_file_signature(rrd_filename)
+    if signature is None:
+        raise FileNotFoundError(rrd_filename)
+    key = (rrd_filename,) + signature[:2]
+
+    with rrd_schemas_lock:
+        schema = rrd_schemas.get(key)
+    if schema is not None:
+        return schema
+
+    log.debug("Reading schema of '%s'", rrd_filename)
+    rrd_info = RRDtool.RRD(rrd_filename).info()
+    schema = {"step": rrd_info["step"],
+              "rras": monitoring.get_rras_from_info(rrd_info),
+              "data_source_names": monitoring.get_data_source_names_from_info(rrd_info)}
+    with rrd_schemas_lock:
+        for old_key in [k for k in rrd_schemas if k[0] == rrd_filename]:
+            del rrd_schemas[old_key]
+        rrd_schemas[key] = schema
+    return schema
+
+
+def get_data_source_files(rrd_filenames):
+    """Maps data source names to the RRD files storing them, using the cached
+    schemas of the files.
+    """
+    data_source_files = collections.OrderedDict()
+    for rrd_filename in rrd_filenames:
+        try:
+            schema = get_rrd_schema(rrd_filename)
+        except FileNotFoundError:
+            # Removed after it was listed
+            continue
+        for name in schema["data_source_names"]:
+            data_source_files.setdefault(name, rrd_filename)
+    return data_source_files
+
+
+def select_rra(schema, last_update, seconds, resolution, cf="AVERAGE"):
+    """Returns the coarsest RRA that covers the time range with at least the
+    given resolution.
+
+    If no RRA is fine enough the finest one covering the range is used, and
+    if none covers the whole range the one reaching furthest back.
+    """
+    start = last_update - seconds
+    covering = []
+    partial = []
+    for rra in schema["rras"]:
+        if rra["cf"] != cf:
+            continue
+        rra_resolution = schema["step"] * rra["pdp_per_row"]
+        rra_start = last_update - last_update % rra_resolution - rra_resolution * rra["rows"]
+        if rra_start <= start:
+            covering.append((rra_resolution, rra))
+        else:
+            partial.append((rra_resolution * rra["rows"], rra))
+
+    fine_enough = [c for c in covering if c[0] <= resolution]
+    if len(fine_enough) > 0:
+        return max(fine_enough, key=lambda c: c[0])[1]
+    if len(covering) > 0:
+        return min(covering, key=lambda c: c[0])[1]
+    if len(partial) > 0:
+        return max(partial, key=lambda c: c[0])[1]
+    raise ValueError("RRD has no %s RRAs" % cf)
+
+
+def get_last_update(rrd_filename):
+    return rrdtool.last(rrd_filename)
+
+
+def fetch_series(rrd_filename, name, seconds, points, cf="AVERAGE"):
+    """Returns the values of one data source over the last seconds seconds,
+    reduced to at most points buckets.
+    """
+    schema = get_rrd_schema(rrd_filename)
+    if name not in schema["data_source_names"]:
+        raise KeyError(name)
+
+    last_update = get_last_update(rrd_filename)
+    rra = select_rra(schema, last_update, seconds, seconds / points, cf)
+    resolution = schema["step"] * rra["pdp_per_row"]
+    end = last_update - last_update % resolution
+    start = end - (seconds // resolution) * resolution
+
+    log.debug("Fetching '%s' from RRA %d of '%s'", name, rra["index"], rrd_filename)
+    (fetch_start, fetch_end, step), names, rows = rrdtool.fetch(
+        rrd_filename, cf, "--resolution", str(resolution),
+        "--start", str(start), "--end", str(end))
+    index = names.index(name)
+    values = numpy.array([row[index] for row in rows], dtype=float)
+
+    bucket_size = get_bucket_size(len(values), points)
+    series = downsample(values, bucket_size)
+    known = numpy.flatnonzero(~numpy.isnan(values))
+    last = None
+    if len(known) > 0:
+        last = {"timestamp": fetch_start + step * (int(known[-1]) + 1),
+                "value": float(values[known[-1]])}
+
+    return {
+        "name": name,
+        "cf": cf,
+        "last_update": last_update,
+        "resolution": step,
+        "start": fetch_start,
+        "step": step * bucket_size,
+        "min": to_json_list(series["min"]),
+        "max": to_json_list(series["max"]),
+        "avg": to_json_list(series["avg"]),
+        "last": last,
+    }
+
+
+def get_bucket_size(count, points):
+    """Returns the smallest bucket size that fits count values into at most
+    points buckets.
+
+    >>> get_bucket_size(7, 3)
+    3
+    >>> get_bucket_size(2, 100)
+    1
+    """
+    return max(1, -(-count // points))
+
+
+def downsample(values, bucket_size):
+    """Splits values into buckets of bucket_size values and returns the
+    minimum, maximum and average of each bucket. Unknown (NaN) values are
+    ignored; a bucket with only unknown values is NaN.
+
+    >>> series = downsample(numpy.array([1, 3, numpy.nan, 4, 2, 6, 5]), 3)
+    >>> series["min"].tolist(), series["max"].tolist(), series["avg"].tolist()
+    ([1.0, 2.0, 5.0], [3.0, 6.0, 5.0], [2.0, 4.0, 5.0])
+    """
+    bucket_count = -(-len(values) // bucket_size)
+    padded = numpy.full(bucket_count * bucket_size, numpy.nan)
+    padded[:len(values)] = values
+    buckets = padded.reshape(bucket_count, bucket_size)
+
+    with warnings.catch_warnings():
+        # All NaN buckets are expected, they are returned as NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return {"min": numpy.nanmin(buckets, axis=1),
+                "max": numpy.nanmax(buckets, axis=1),
+                "avg": numpy.nanmean(buckets, axis=1)}
+
+
+def to_json_list(values):
+    return [None if math.isnan(v) else round(v, 3) for v in values.tolist()]
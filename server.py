@@ -1,37 +1,148 @@
 #!/usr/bin/env python3
 
+import os
 import os.path
 import time
 import ssl
+import argparse
+import urllib.parse
+import json
+import base64
+import tempfile
+import hmac
+import hashlib
+import threading
+import collections
 from passlib.hash import sha256_crypt
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+import jinja2
+import numpy
 from flask import Flask
 from flask import render_template
 from flask import request
 from flask import Response
 from flask import abort
+from flask import jsonify
+from flask import url_for
 from tornado.wsgi import WSGIContainer
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.ioloop import PeriodicCallback
+from tornado.iostream import StreamClosedError
+from tornado.locks import Condition
+from tornado import gen
+import tornado.web
+import RRDtool
+import monitoring
+import create_graphs
+import series
+import export
+import ring_buffer
+from graph_cache import RenderCache
 
 PORT = 12300
+AUTH_CACHE_TTL_SECONDS = 15 * 60
+AUTH_CACHE_MAX_ENTRIES = 32
+GRAPH_CACHE_MAX_BYTES = 32 * 1024 * 1024
+GRAPH_MIN_SIZE = 100
+GRAPH_MAX_SIZE = 2000
+SERIES_DEFAULT_POINTS = 200
+SERIES_MAX_POINTS = 5000
+SERIES_CONSOLIDATION_FUNCTIONS = ["AVERAGE", "MIN", "MAX", "LAST"]
+STATUS_CHECK_INTERVAL_MS = 1000
+# How long events wait for the graph daemon to render the new data
+GRAPH_RENDER_WAIT_SECONDS = 60
+EVENTS_KEEPALIVE_SECONDS = 30
+EXECUTOR_WORKERS = 4
+RECENT_DEFAULT_MINUTES = 60
+# Versioned graph URLs never change content, so they can be cached for long
+GRAPH_IMAGE_MAX_AGE_SECONDS = 365 * 24 * 60 * 60
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+STATIC_DIR = os.path.join(THIS_DIR, "static")
+IMAGES_DIR = os.path.join(STATIC_DIR, "images")
+PASSWORD_FILENAME = os.environ.get("MONITORING_PASSWORD_FILE",
+                                   os.path.join(THIS_DIR, "password"))
+CONFIG_FILENAME = os.environ.get("MONITORING_CONFIG_FILE",
+                                 os.path.join(THIS_DIR, "config.json"))
 app = Flask(__name__)
 
-# Set cache timeout for all static content.
-# Otherwise the dynamic image content does not work
-# correctly due to browser caching.
-app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 60
-
-with open(os.path.join(THIS_DIR, "password")) as f:
+with open(PASSWORD_FILENAME) as f:
     password_hash = f.read().strip()
 
 
+def load_config():
+    """Returns the monitoring configuration, or None if there is none.
+
+    Only the features that need to read the RRD directly use it.
+    """
+    try:
+        with open(CONFIG_FILENAME) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+config = load_config()
+graph_cache = RenderCache(GRAPH_CACHE_MAX_BYTES)
+ring = None
+if config is not None and "ring-buffer" in config:
+    ring = ring_buffer.RingBufferReader(config["ring-buffer"])
+
+# Content versions of generated graph images, keyed by path and mapped to
+# (file signature, version). Images are replaced as a whole when they are
+# rendered, so the signature changes whenever the content does.
+graph_versions = {}
+graph_versions_lock = threading.Lock()
+
+# Credentials that have passed the (deliberately slow) hash verification are
+# remembered as HMACs under a random per process key, mapped to their expiry
+# time. The cache never contains anything that reveals the password.
+auth_cache_key = os.urandom(32)
+verified_credentials = collections.OrderedDict()
+verified_credentials_lock = threading.Lock()
+
+
 def check_auth(username, password):
     """This function is called to check if a username /
     password combination is valid.
     """
-    return username == 'viewer' and sha256_crypt.verify(password, password_hash)
+    if username != 'viewer':
+        return False
+
+    digest = get_credential_digest(username, password)
+    if is_verified_credential(digest):
+        return True
+
+    if not sha256_crypt.verify(password, password_hash):
+        return False
+    remember_verified_credential(digest)
+    return True
+
+
+def get_credential_digest(username, password):
+    credentials = (username + ":" + password).encode("utf-8")
+    return hmac.new(auth_cache_key, credentials, hashlib.sha256).digest()
+
+
+def is_verified_credential(digest):
+    with verified_credentials_lock:
+        expires = verified_credentials.get(digest)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del verified_credentials[digest]
+            return False
+        verified_credentials.move_to_end(digest)
+        return True
+
+
+def remember_verified_credential(digest):
+    with verified_credentials_lock:
+        verified_credentials[digest] = time.monotonic() + AUTH_CACHE_TTL_SECONDS
+        verified_credentials.move_to_end(digest)
+        while len(verified_credentials) > AUTH_CACHE_MAX_ENTRIES:
+            verified_credentials.popitem(last=False)
 
 
 def authenticate():
@@ -68,8 +179,12 @@ def index():
 
 
 def get_update_time():
+    if ring is not None:
+        last_update = ring.get_last_update()
+        if last_update is not None:
+            return time.ctime(last_update)
     try:
-        image_file = os.path.join(THIS_DIR, "static/images/temperatures/hour.png")
+        image_file = os.path.join(IMAGES_DIR, "temperatures/hour.png")
         return time.ctime(os.path.getmtime(image_file))
     except OSError:
         return "Never"
@@ -81,11 +196,664 @@ def get_temperature_detailed(name=None):
     return render_template("detailed.html", variable="temperatures", name=name)
 
 
+@app.context_processor
+def inject_graph_url():
+    return {"graph_url": get_graph_url}
+
+
+def get_graph_url(filename, url_builder=url_for):
+    """Returns the URL of a generated graph image, including its current
+    content version.
+    """
+    filepath = get_image_path(filename)
+    version = None if filepath is None else get_graph_version(filepath)
+    if version is None:
+        return url_builder("get_graph_image", filename=filename)
+    return url_builder("get_graph_image", filename=filename, v=version)
+
+
+def get_image_path(filename):
+    filepath = os.path.realpath(os.path.join(IMAGES_DIR, filename))
+    if not filepath.startswith(IMAGES_DIR + os.sep):
+        return None
+    return filepath
+
+
+def get_graph_version(filepath):
+    file_signature = monitoring.get_file_signature(filepath)
+    if file_signature is None:
+        return None
+
+    with graph_versions_lock:
+        cached = graph_versions.get(filepath)
+    if cached is not None and cached[0] == file_signature:
+        return cached[1]
+
+    try:
+        with open(filepath, "rb") as f:
+            version = get_content_version(f.read())
+    except OSError:
+        return None
+    with graph_versions_lock:
+        graph_versions[filepath] = (file_signature, version)
+    return version
+
+
+def get_content_version(content):
+    return hashlib.md5(content).hexdigest()
+
+
+@app.route("/images/<path:filename>")
+@requires_auth
+def get_graph_image(filename):
+    filepath = get_image_path(filename)
+    if filepath is None:
+        abort(404)
+    version = get_graph_version(filepath)
+    if version is None:
+        abort(404)
+
+    if request.if_none_match.contains(version):
+        response = Response(status=304)
+    else:
+        try:
+            with open(filepath, "rb") as f:
+                image = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+        except OSError:
+            abort(404)
+        response = Response(image, mimetype="image/png")
+        response.last_modified = mtime
+    response.set_etag(version)
+    # The images need authentication, so shared caches must not keep them
+    response.cache_control.private = True
+    if request.args.get("v") == version:
+        response.cache_control.max_age = GRAPH_IMAGE_MAX_AGE_SECONDS
+    else:
+        response.cache_control.no_cache = True
+    if response.status_code == 304:
+        return response
+    return response.make_conditional(request)
+
+
+@app.route("/api/graph-versions")
+@requires_auth
+def get_graph_versions():
+    """Returns the current versioned URLs of the graphs given as path
+    parameters.
+    """
+    return jsonify({filename: get_graph_url(filename)
+                    for filename in request.args.getlist("path")})
+
+
+@app.route("/graph/<time_range>.png")
+@app.route("/graph/<name>/<time_range>.png")
+@requires_auth
+def get_graph(time_range, name=None):
+    try:
+        image, ttl = get_on_demand_graph(time_range, name, request.args)
+    except RequestError as e:
+        abort(e.status)
+
+    response = Response(image, mimetype="image/png")
+    response.cache_control.max_age = int(ttl)
+    return response
+
+
+class RequestError(Exception):
+    """Raised by the request helpers shared by the Flask routes and the
+    native Tornado handlers, carries the HTTP status to respond with.
+    """
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+def get_on_demand_graph(time_range, name, args):
+    """Returns the (cached) graph image for a request and the number of
+    seconds it stays valid.
+    """
+    start = create_graphs.IMAGE_NAMES_MAPPING.get(time_range + ".png")
+    if config is None or start is None:
+        raise RequestError(404)
+
+    try:
+        width = int(args.get("w", create_graphs.IMAGE_WIDTH))
+        height = int(args.get("h", create_graphs.IMAGE_HEIGHT))
+    except ValueError:
+        raise RequestError(400)
+    if not (GRAPH_MIN_SIZE <= width <= GRAPH_MAX_SIZE and
+            GRAPH_MIN_SIZE <= height <= GRAPH_MAX_SIZE):
+        raise RequestError(400)
+
+    rrd_filenames = monitoring.get_rrd_filenames(config)
+    try:
+        return graph_cache.get((name, time_range, width, height),
+                               lambda: render_graph(rrd_filenames, name, start,
+                                                    width, height))
+    except KeyError:
+        raise RequestError(404)
+
+
+def render_graph(rrd_filenames, name, start, width, height):
+    """Renders a graph of one data source, or of all of them if name is None.
+
+    Returns the PNG data and the number of seconds until the RRA the graph
+    is drawn from gets its next row.
+    """
+    rrd_files = series.get_data_source_files(rrd_filenames)
+    if name is not None:
+        rrd_files = create_graphs.select_data_sources(rrd_files, [name])
+    if len(rrd_files) == 0:
+        raise KeyError(name)
+
+    defs = create_graphs.get_defs(rrd_files)
+    lines = create_graphs.get_lines(rrd_files, create_graphs.COLORS)
+    texts = create_graphs.get_texts(rrd_files)
+    graph_filenames = create_graphs.get_rrd_filenames(rrd_files)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filepath = os.path.join(tmp_dir, "graph.png")
+        create_graphs.draw_graph(graph_filenames, filepath, start, create_graphs.UNIT_LABEL,
+                                 width, height, defs, lines, texts)
+        with open(filepath, "rb") as f:
+            image = f.read()
+
+    # The shards of a sharded layout share the same RRAs
+    rrd_info = RRDtool.RRD(graph_filenames[0]).info()
+    seconds = create_graphs.get_time_range_seconds(start)
+    rra = create_graphs.get_backing_rra(rrd_info, seconds, width)
+    resolution = rrd_info["step"] * rra["pdp_per_row"]
+    ttl = resolution - int(time.time()) % resolution
+    return image, ttl
+
+
+@app.route("/api/series/<name>")
+@requires_auth
+def get_series(name):
+    try:
+        etag = get_series_etag_for_request(name, request.args)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        data = get_series_data(name, request.args)
+    except RequestError as e:
+        abort(e.status)
+
+    response = jsonify(data)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def parse_series_request(args):
+    if config is None:
+        raise RequestError(404)
+
+    start = args.get("start", "-1d")
+    cf = args.get("cf", "AVERAGE")
+    try:
+        seconds = create_graphs.get_time_range_seconds(start)
+        points = int(args.get("points", SERIES_DEFAULT_POINTS))
+    except ValueError:
+        raise RequestError(400)
+    if not 1 <= points <= SERIES_MAX_POINTS or cf not in SERIES_CONSOLIDATION_FUNCTIONS:
+        raise RequestError(400)
+    return start, seconds, points, cf
+
+
+def get_series_etag_for_request(name, args):
+    start, seconds, points, cf = parse_series_request(args)
+    last_update = series.get_last_update(get_series_rrd_filename(name))
+    return get_series_etag(last_update, name, start, points, cf)
+
+
+def get_series_data(name, args):
+    start, seconds, points, cf = parse_series_request(args)
+    try:
+        return series.fetch_series(get_series_rrd_filename(name), name, seconds, points, cf)
+    except KeyError:
+        raise RequestError(404)
+    except ValueError:
+        # The RRD has no RRAs with the consolidation function
+        raise RequestError(404)
+
+
+def get_series_rrd_filename(name):
+    rrd_filenames = monitoring.get_rrd_filenames(config)
+    if len(rrd_filenames) == 1:
+        return rrd_filenames[0]
+    rrd_filename = series.get_data_source_files(rrd_filenames).get(name)
+    if rrd_filename is None:
+        raise RequestError(404)
+    return rrd_filename
+
+
+@app.route("/api/current")
+@requires_auth
+def get_current():
+    try:
+        data = get_current_data()
+    except RequestError as e:
+        abort(e.status)
+    response = jsonify(data)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/api/recent/<name>")
+@requires_auth
+def get_recent(name):
+    try:
+        data = get_recent_data(name, request.args)
+    except RequestError as e:
+        abort(e.status)
+    response = jsonify(data)
+    response.cache_control.no_cache = True
+    return response
+
+
+def get_current_data():
+    """Returns the newest readings from the ring buffer of monitoring.py."""
+    latest = None if ring is None else ring.get_latest()
+    if latest is None:
+        raise RequestError(404)
+    last_update, readings = latest
+    names = sorted(readings)
+    values = series.to_json_list(numpy.array([readings[name] for name in names]))
+    return {"last_update": last_update, "readings": dict(zip(names, values))}
+
+
+def get_recent_data(name, args):
+    """Returns the readings of one sensor over the last minutes from the ring
+    buffer of monitoring.py.
+    """
+    try:
+        minutes = float(args.get("minutes", RECENT_DEFAULT_MINUTES))
+    except ValueError:
+        raise RequestError(400)
+    if minutes <= 0:
+        raise RequestError(400)
+
+    recent = None if ring is None else ring.get_recent(name, int(minutes * 60))
+    if recent is None:
+        raise RequestError(404)
+    timestamps, values = recent
+    return {"name": name, "timestamps": timestamps.tolist(),
+            "values": series.to_json_list(values)}
+
+
+@app.route("/api/export")
+@requires_auth
+def get_export():
+    try:
+        plan, encoder = get_export_for_request(request.args)
+    except RequestError as e:
+        abort(e.status)
+    # Streamed by WSGI servers; WSGIContainer collects the whole body first
+    response = Response(export.iter_export(plan, encoder), content_type=encoder.content_type)
+    response.headers["Content-Disposition"] = get_export_disposition(encoder)
+    return response
+
+
+def get_export_for_request(args):
+    """Returns the export plan and encoder of a history export request."""
+    if config is None:
+        raise RequestError(404)
+    encoder_class = export.ENCODERS.get(args.get("format", "csv"))
+    if encoder_class is None:
+        raise RequestError(400)
+
+    names = args.get("names")
+    rrd_files = series.get_data_source_files(monitoring.get_rrd_filenames(config))
+    try:
+        plan = export.plan_export(rrd_files, None if names is None else names.split(","),
+                                  args.get("start", "-1d"), args.get("end", "last"),
+                                  args.get("cf", "AVERAGE"), int(args.get("resolution", 0)))
+    except KeyError:
+        raise RequestError(404)
+    except ValueError:
+        raise RequestError(400)
+    return plan, encoder_class(plan)
+
+
+def get_export_disposition(encoder):
+    return 'attachment; filename="temperatures.%s"' % encoder.extension
+
+
+def get_series_etag(last_update, *args):
+    key = ":".join(str(arg) for arg in (last_update,) + args)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class StatusWatcher:
+    """Watches the status file that monitoring.py replaces after every RRD
+    update and wakes up the event streams when it has changed.
+
+    If the graph daemon runs, the event streams are only woken up once it
+    has rendered the new data, so that dashboards do not fetch the graph
+    versions before they change. A daemon that takes longer than
+    GRAPH_RENDER_WAIT_SECONDS is not waited for.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.rendered_filename = create_graphs.get_rendered_filename(filename)
+        self.file_signature = None
+        self.status = None
+        self.pending = None
+        self.pending_time = None
+        self.changed = Condition()
+
+    def check(self):
+        file_signature = monitoring.get_file_signature(self.filename)
+        if file_signature is not None and file_signature != self.file_signature:
+            try:
+                with open(self.filename) as f:
+                    status = json.load(f)
+            except (OSError, ValueError):
+                return
+            self.file_signature = file_signature
+            self.pending = status
+            self.pending_time = time.monotonic()
+        if self.pending is None or not self.is_rendered(self.pending):
+            return
+        self.status = self.pending
+        self.pending = None
+        self.changed.notify_all()
+
+    def is_rendered(self, status):
+        rendered = create_graphs.read_status_last_update(self.rendered_filename)
+        if rendered is None:
+            # No graph daemon
+            return True
+        return rendered >= status.get("last_update", 0) or \
+            time.monotonic() - self.pending_time >= GRAPH_RENDER_WAIT_SECONDS
+
+
+class AuthenticationMixin:
+    """Basic authentication for the native Tornado handlers."""
+
+    @gen.coroutine
+    def prepare(self):
+        auth = get_basic_auth(self.request.headers.get("Authorization"))
+        authorized = False
+        if auth is not None:
+            authorized = yield check_auth_async(*auth)
+        if not authorized:
+            self.set_status(401)
+            self.set_header("WWW-Authenticate", 'Basic realm="Login Required"')
+            self.finish("Could not verify your access level for that URL.\n"
+                        "You have to login with proper credentials")
+
+
+@gen.coroutine
+def check_auth_async(username, password):
+    """Checks credentials without blocking the IOLoop: only credentials that
+    are not in the cache are verified, in the executor.
+    """
+    if username == 'viewer' and \
+            is_verified_credential(get_credential_digest(username, password)):
+        return True
+    result = yield executor.submit(check_auth, username, password)
+    return result
+
+
+class IndexHandler(AuthenticationMixin, tornado.web.RequestHandler):
+    def get(self):
+        self.write(render_native_template("index.html", last_update=get_update_time()))
+
+
+class DetailedHandler(AuthenticationMixin, tornado.web.RequestHandler):
+    def get(self, name):
+        self.write(render_native_template("detailed.html", variable="temperatures",
+                                          name=name))
+
+
+class AuthenticatedStaticFileHandler(AuthenticationMixin, tornado.web.StaticFileHandler):
+    pass
+
+
+class GraphImageHandler(AuthenticatedStaticFileHandler):
+    """Serves generated graph images, streamed and with range support.
+
+    The ETag is the content version used in graph URLs, and responses to
+    URLs with the current version can be cached for long.
+    """
+
+    @classmethod
+    def get_content_version(cls, abspath):
+        return get_graph_version(abspath)
+
+    def compute_etag(self):
+        version = get_graph_version(self.absolute_path)
+        if version is None:
+            return None
+        return '"%s"' % version
+
+    def get_cache_time(self, path, modified, mime_type):
+        if self.get_argument("v", None) == get_graph_version(self.absolute_path):
+            return GRAPH_IMAGE_MAX_AGE_SECONDS
+        return 0
+
+    def set_extra_headers(self, path):
+        # The images need authentication, so shared caches must not keep them
+        cache_time = self.get_cache_time(path, None, None)
+        if cache_time > 0:
+            self.set_header("Cache-Control", "private, max-age=%d" % cache_time)
+        else:
+            self.set_header("Cache-Control", "private, no-cache")
+
+
+class GraphVersionsHandler(AuthenticationMixin, tornado.web.RequestHandler):
+    def get(self):
+        self.write({filename: get_graph_url(filename, get_native_url)
+                    for filename in self.get_arguments("path")})
+
+
+class GraphHandler(AuthenticationMixin, tornado.web.RequestHandler):
+    @gen.coroutine
+    def get(self, name, time_range):
+        try:
+            image, ttl = yield executor.submit(get_on_demand_graph, time_range, name,
+                                               get_arguments(self))
+        except RequestError as e:
+            raise tornado.web.HTTPError(e.status)
+
+        self.set_header("Content-Type", "image/png")
+        self.set_header("Cache-Control", "max-age=%d" % ttl)
+        self.write(image)
+
+
+class SeriesHandler(AuthenticationMixin, tornado.web.RequestHandler):
+    @gen.coroutine
+    def get(self, name):
+        args = get_arguments(self)
+        try:
+            etag = yield executor.submit(get_series_etag_for_request, name, args)
+            self.set_header("Etag", '"%s"' % etag)
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+            data = yield executor.submit(get_series_data, name, args)
+        except RequestError as e:
+            raise tornado.web.HTTPError(e.status)
+
+        self.set_header("Cache-Control", "no-cache")
+        self.write(data)
+
+
+class CurrentHandler(AuthenticationMixin, tornado.web.RequestHandler):
+    def get(self):
+        try:
+            data = get_current_data()
+        except RequestError as e:
+            raise tornado.web.HTTPError(e.status)
+        self.set_header("Cache-Control", "no-cache")
+        self.write(data)
+
+
+class RecentHandler(AuthenticationMixin, tornado.web.RequestHandler):
+    def get(self, name):
+        try:
+            data = get_recent_data(name, get_arguments(self))
+        except RequestError as e:
+            raise tornado.web.HTTPError(e.status)
+        self.set_header("Cache-Control", "no-cache")
+        self.write(data)
+
+
+class ExportHandler(AuthenticationMixin, tornado.web.RequestHandler):
+    """Streams a history export with chunked encoding. Chunks are fetched in
+    the executor one at a time, the next one only after the previous one
+    has been sent, so memory use does not depend on the length of the range.
+    """
+
+    @gen.coroutine
+    def get(self):
+        try:
+            plan, encoder = yield executor.submit(get_export_for_request,
+                                                  get_arguments(self))
+        except RequestError as e:
+            raise tornado.web.HTTPError(e.status)
+
+        self.set_header("Content-Type", encoder.content_type)
+        self.set_header("Content-Disposition", get_export_disposition(encoder))
+        chunks = export.iter_export(plan, encoder)
+        try:
+            while True:
+                chunk = yield executor.submit(next, chunks, None)
+                if chunk is None:
+                    break
+                self.write(chunk)
+                yield self.flush()
+        except StreamClosedError:
+            pass
+        finally:
+            chunks.close()
+
+
+class EventsHandler(AuthenticationMixin, tornado.web.RequestHandler):
+    """Server-Sent Events stream of the status published by monitoring.py.
+
+    Runs natively on the IOLoop, as WSGIContainer can not stream responses.
+    """
+
+    def initialize(self, watcher):
+        self.watcher = watcher
+
+    @gen.coroutine
+    def get(self):
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        sent_status = None
+        try:
+            while True:
+                status = self.watcher.status
+                if status is not None and status is not sent_status:
+                    self.write("id: %s\ndata: %s\n\n" % (status["last_update"],
+                                                          json.dumps(status)))
+                    sent_status = status
+                else:
+                    self.write(": keepalive\n\n")
+                yield self.flush()
+                if self.watcher.status is not sent_status:
+                    continue
+                yield self.watcher.changed.wait(timeout=IOLoop.current().time() +
+                                                EVENTS_KEEPALIVE_SECONDS)
+        except StreamClosedError:
+            pass
+
+
+def get_arguments(handler):
+    return {name: handler.get_argument(name) for name in handler.request.arguments}
+
+
+def get_basic_auth(header):
+    """Returns the (username, password) of a basic authorization header.
+
+    >>> get_basic_auth("Basic dmlld2VyOnNlY3JldA==")
+    ('viewer', 'secret')
+    """
+    if header is None or not header.startswith("Basic "):
+        return None
+    try:
+        credentials = base64.b64decode(header[len("Basic "):]).decode("utf-8")
+    except ValueError:
+        return None
+    username, separator, password = credentials.partition(":")
+    if separator != ":":
+        return None
+    return username, password
+
+
+def get_native_url(endpoint, **values):
+    """url_for() replacement for templates rendered by the native handlers."""
+    prefixes = {"static": "/static/", "get_graph_image": "/images/"}
+    url = prefixes[endpoint] + urllib.parse.quote(values.pop("filename"))
+    if len(values) > 0:
+        url += "?" + urllib.parse.urlencode(values)
+    return url
+
+
+def render_native_template(template_name, **context):
+    return template_env.get_template(template_name).render(**context)
+
+
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+template_env = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(THIS_DIR,
+                                                                              "templates")),
+                                  autoescape=True)
+template_env.globals["url_for"] = get_native_url
+template_env.globals["graph_url"] = lambda filename: get_graph_url(filename, get_native_url)
+
+
+def create_application(native=True):
+    """Returns the Tornado application serving the site, either with native
+    handlers or with the Flask application in a WSGIContainer.
+    """
+    handlers = []
+    if config is not None and "status-file" in config:
+        watcher = StatusWatcher(config["status-file"])
+        PeriodicCallback(watcher.check, STATUS_CHECK_INTERVAL_MS).start()
+        handlers.append((r"/events", EventsHandler, {"watcher": watcher}))
+
+    if native:
+        handlers.extend([
+            (r"/", IndexHandler),
+            (r"/temperature/([^/]+)", DetailedHandler),
+            (r"/images/(.*)", GraphImageHandler, {"path": IMAGES_DIR}),
+            (r"/static/(.*)", AuthenticatedStaticFileHandler, {"path": STATIC_DIR}),
+            (r"/api/graph-versions", GraphVersionsHandler),
+            (r"/api/series/([^/]+)", SeriesHandler),
+            (r"/api/current", CurrentHandler),
+            (r"/api/recent/([^/]+)", RecentHandler),
+            (r"/api/export", ExportHandler),
+            (r"/graph/(?:([^/]+)/)?([^/]+)\.png", GraphHandler),
+        ])
+    else:
+        handlers.append((r".*", tornado.web.FallbackHandler,
+                         {"fallback": WSGIContainer(app)}))
+    # Graph images change, so their hashes must not be cached forever
+    return tornado.web.Application(handlers, static_hash_cache=False)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wsgi", dest="wsgi", action="store_true",
+                        help="Serve the Flask application through a WSGI container "
+                        "instead of the native Tornado handlers")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
     app.debug = False
     ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     ssl_context.load_cert_chain(os.path.join(THIS_DIR, "server.crt"),
                                 os.path.join(THIS_DIR, "server.key"))
-    http_server = HTTPServer(WSGIContainer(app), ssl_options=ssl_context)
+    http_server = HTTPServer(create_application(native=not args.wsgi),
+                             ssl_options=ssl_context)
     http_server.listen(PORT)
     IOLoop.instance().start()
@@ -1,10 +1,41 @@
 var image_refresh_interval = 60000;
 
-setInterval(function(){
-	$("img.refresh").each(function (){
-		var jqt = $(this);
-		var src = jqt.attr("src").split("?")[0];
-		src += "?_ts=" + new Date().getTime();
-		jqt.attr("src", src);
+// Asks the server for the current versioned URLs of the images and reloads
+// only the ones whose content has changed.
+function refresh_images() {
+	var images = $("img.refresh");
+	var paths = images.map(function (){
+		return $(this).data("graph");
+	}).get();
+	$.getJSON("/api/graph-versions", $.param({path: paths}, true), function (urls){
+		images.each(function (){
+			var jqt = $(this);
+			var url = urls[jqt.data("graph")];
+			if (url && jqt.attr("src") != url) {
+				jqt.attr("src", url);
+			}
+		});
 	});
-}, image_refresh_interval);
+}
+
+function poll_images() {
+	setInterval(refresh_images, image_refresh_interval);
+}
+
+// Refresh only when the monitoring server has written new data. Fall back to
+// polling if the browser or the server does not support events.
+if (window.EventSource) {
+	var events = new EventSource("/events");
+	events.onmessage = function (event) {
+		var status = JSON.parse(event.data);
+		refresh_images();
+		$("#last-update").text(new Date(status.last_update * 1000).toString());
+	};
+	events.onerror = function () {
+		if (events.readyState == EventSource.CLOSED) {
+			poll_images();
+		}
+	};
+} else {
+	poll_images();
+}
@@ -1,13 +1,201 @@
 #!/usr/bin/env python3
+"""Stub temperature server for development and load testing.
 
-from flask import Flask
-app = Flask(__name__)
+Serves any number of virtual sensor hosts from one process, either each on a
+port of its own or all on one port under /hosts/<index>/temperatures.
+Readings drift slowly around a daily cycle, and latency, hanging requests,
+HTTP errors and malformed JSON can be injected at configurable rates.
+"""
 
+import argparse
+import json
+import logging as log
+import math
+import random
+import time
+from tornado import gen
+from tornado.ioloop import IOLoop
+import tornado.web
 
-@app.route("/temperatures")
-def hello():
-    return """{"mytemp1":21.7,"mytemp2":21.0}"""
+DAY_SECONDS = 24 * 60 * 60
+ERROR_STATUSES = [500, 502, 503]
+
+
+class VirtualHost:
+    """Sensors of one virtual temperature server.
+
+    Each sensor follows a daily sine around its own base temperature plus a
+    mean reverting random walk, advanced whenever the host is read.
+    """
+
+    def __init__(self, index, sensor_names):
+        self.index = index
+        self.sensors = [{"name": name,
+                         "base": random.uniform(18, 24),
+                         "amplitude": random.uniform(0.5, 3),
+                         "phase": random.uniform(0, 2 * math.pi),
+                         "walk": 0.0}
+                        for name in sensor_names]
+        self.last_read = time.time()
+
+    def read(self):
+        now = time.time()
+        elapsed = now - self.last_read
+        self.last_read = now
+        readings = {}
+        for sensor in self.sensors:
+            sensor["walk"] = get_next_walk(sensor["walk"], elapsed)
+            daily = math.sin(2 * math.pi * (now % DAY_SECONDS) / DAY_SECONDS + sensor["phase"])
+            value = sensor["base"] + sensor["amplitude"] * daily + sensor["walk"]
+            readings[sensor["name"]] = round(value, 2)
+        return readings
+
+
+class TemperaturesHandler(tornado.web.RequestHandler):
+    def initialize(self, hosts, faults):
+        self.hosts = hosts
+        self.faults = faults
+
+    @gen.coroutine
+    def get(self, index="0"):
+        host = self.hosts.get(int(index))
+        if host is None:
+            raise tornado.web.HTTPError(404)
+
+        faults = self.faults
+        delay = max(0.0, random.gauss(faults["latency"], faults["jitter"]))
+        if random.random() < faults["timeout-rate"]:
+            delay = faults["hang-seconds"]
+        if delay > 0:
+            yield gen.sleep(delay)
+
+        if random.random() < faults["error-rate"]:
+            raise tornado.web.HTTPError(random.choice(ERROR_STATUSES))
+
+        body = json.dumps(host.read())
+        if random.random() < faults["malformed-rate"]:
+            body = body[:random.randint(0, len(body) - 1)]
+        self.set_header("Content-Type", "application/json")
+        self.finish(body)
+
+    def log_exception(self, typ, value, tb):
+        # Injected errors are expected, tracebacks would flood the output
+        if not isinstance(value, tornado.web.HTTPError):
+            super().log_exception(typ, value, tb)
+
+
+def main():
+    args = parse_args()
+    init_logging(args.log_level)
+    hosts = [VirtualHost(i, get_sensor_names(i, args.hosts, args.sensors))
+             for i in range(args.hosts)]
+    faults = {
+        "latency": args.latency_ms / 1000,
+        "jitter": args.jitter_ms / 1000,
+        "timeout-rate": args.timeout_rate,
+        "hang-seconds": args.hang_seconds,
+        "error-rate": args.error_rate,
+        "malformed-rate": args.malformed_rate,
+    }
+
+    servers = get_server_config(args.hostname, args.port, args.hosts, args.layout)
+    if args.print_servers:
+        print(json.dumps({"servers": servers}, indent=2))
+
+    if args.layout == "paths":
+        application = create_application({host.index: host for host in hosts}, faults)
+        application.listen(args.port, address=args.address)
+    else:
+        for host in hosts:
+            application = create_application({0: host}, faults)
+            application.listen(args.port + host.index, address=args.address)
+    log.info("Serving %d hosts with %d sensors each", args.hosts, args.sensors)
+    IOLoop.instance().start()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log-level", dest="log_level", default="WARNING",
+                        help="Log level (DEBUG, INFO, WARNING or ERROR)")
+    parser.add_argument("--address", dest="address", default="127.0.0.1",
+                        help="Address to listen on")
+    parser.add_argument("--hostname", dest="hostname", default="localhost",
+                        help="Hostname used in the printed server configuration")
+    parser.add_argument("--port", dest="port", type=int, default=5001,
+                        help="Port to listen on, or the first port with --layout ports")
+    parser.add_argument("--hosts", dest="hosts", type=int, default=1,
+                        help="Number of virtual temperature servers")
+    parser.add_argument("--sensors", dest="sensors", type=int, default=2,
+                        help="Number of sensors per virtual server")
+    parser.add_argument("--layout", dest="layout", choices=["ports", "paths"], default="ports",
+                        help="Serve each virtual server on a port of its own, or all "
+                        "on one port under /hosts/<index>/temperatures")
+    parser.add_argument("--latency-ms", dest="latency_ms", type=float, default=0,
+                        help="Mean response latency in milliseconds")
+    parser.add_argument("--jitter-ms", dest="jitter_ms", type=float, default=0,
+                        help="Standard deviation of the response latency in milliseconds")
+    parser.add_argument("--timeout-rate", dest="timeout_rate", type=float, default=0,
+                        help="Fraction of requests that hang for --hang-seconds")
+    parser.add_argument("--hang-seconds", dest="hang_seconds", type=float, default=60,
+                        help="How long hanging requests take to answer")
+    parser.add_argument("--error-rate", dest="error_rate", type=float, default=0,
+                        help="Fraction of requests answered with an HTTP error")
+    parser.add_argument("--malformed-rate", dest="malformed_rate", type=float, default=0,
+                        help="Fraction of requests answered with truncated JSON")
+    parser.add_argument("--print-servers", dest="print_servers", action="store_true",
+                        help="Print the matching \"servers\" configuration of the "
+                        "data collection server")
+    return parser.parse_args()
+
+
+def init_logging(log_level):
+    log.basicConfig(level=log_level,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+def create_application(hosts, faults):
+    arguments = {"hosts": hosts, "faults": faults}
+    return tornado.web.Application([
+        (r"/temperatures", TemperaturesHandler, arguments),
+        (r"/hosts/([0-9]+)/temperatures", TemperaturesHandler, arguments),
+    ])
+
+
+def get_sensor_names(host_index, host_count, sensor_count):
+    """Returns sensor names that are unique over all virtual hosts, as the
+    data collection server merges the readings of all servers.
+
+    >>> get_sensor_names(0, 1, 2)
+    ['mytemp1', 'mytemp2']
+    >>> get_sensor_names(3, 10, 2)
+    ['host3_temp1', 'host3_temp2']
+    """
+    if host_count == 1:
+        return ["mytemp%d" % (i + 1) for i in range(sensor_count)]
+    return ["host%d_temp%d" % (host_index, i + 1) for i in range(sensor_count)]
+
+
+def get_server_config(hostname, port, host_count, layout):
+    """
+    >>> get_server_config("localhost", 5001, 2, "ports")
+    [{'hostname': 'localhost', 'port': 5001}, {'hostname': 'localhost', 'port': 5002}]
+    >>> get_server_config("localhost", 5001, 1, "paths")
+    [{'hostname': 'localhost', 'port': 5001, 'path': '/hosts/0/temperatures'}]
+    """
+    if layout == "paths":
+        return [{"hostname": hostname, "port": port, "path": "/hosts/%d/temperatures" % i}
+                for i in range(host_count)]
+    return [{"hostname": hostname, "port": port + i} for i in range(host_count)]
+
+
+def get_next_walk(walk, elapsed):
+    """Advances a random walk that is pulled back towards zero, so that
+    readings wander but stay within a couple of degrees of the daily cycle.
+    """
+    elapsed = min(elapsed, DAY_SECONDS)
+    reversion = math.exp(-elapsed / 3600)
+    return walk * reversion + random.gauss(0, 0.05) * math.sqrt(elapsed / 60)
 
 
 if __name__ == "__main__":
-    app.run(port=5001)
+    main()
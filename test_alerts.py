@@ -0,0 +1,77 @@
+import unittest
+import alerts
+
+
+class RecordingNotifier:
+    def __init__(self):
+        self.events = []
+
+    def notify(self, event):
+        self.events.append(event)
+
+    def close(self):
+        pass
+
+
+class AlertEngineTest(unittest.TestCase):
+    def create_engine(self, *rules):
+        self.notifier = RecordingNotifier()
+        return alerts.AlertEngine(list(rules), self.notifier)
+
+    def get_states(self):
+        return [(event["data_source"], event["state"]) for event in self.notifier.events]
+
+    def test_threshold_clears_only_beyond_hysteresis(self):
+        engine = self.create_engine(alerts.ThresholdRule(
+            {"name": "freezer", "above": -15, "hysteresis": 2}))
+        for now, value in enumerate([-18, -14, -16, -14.5, -16.5, -17.5]):
+            engine.evaluate(now, {"freezer": value}, now)
+            if now == 1:
+                self.assertEqual(self.get_states(), [("freezer", "firing")])
+            if now == 4:
+                # -16 and -16.5 are below the limit but within the hysteresis
+                self.assertEqual(self.get_states(), [("freezer", "firing")])
+        self.assertEqual(self.get_states(), [("freezer", "firing"), ("freezer", "resolved")])
+
+    def test_threshold_waits_for_cycles(self):
+        engine = self.create_engine(alerts.ThresholdRule(
+            {"name": "hot", "above": 30, "for-cycles": 3}))
+        for now, value in enumerate([31, 32, 20, 31, 32]):
+            engine.evaluate(now, {"sauna": value}, now)
+        self.assertEqual(self.get_states(), [])
+        engine.evaluate(5, {"sauna": 33}, 5)
+        self.assertEqual(self.get_states(), [("sauna", "firing")])
+
+    def test_deviation_needs_min_samples(self):
+        engine = self.create_engine(alerts.DeviationRule(
+            {"name": "jump", "max-deviations": 3, "min-samples": 4,
+             "window-seconds": 3600}))
+        for now, value in enumerate([20.0, 20.0, 20.0]):
+            engine.evaluate(now * 60, {"garage": value}, now * 60)
+        # Only three values in the window, so even a large jump is not checked
+        engine.evaluate(180, {"garage": 40.0}, 180)
+        self.assertEqual(self.get_states(), [])
+
+        for now, value in enumerate([20.5, 19.5, 20.0, 20.5], start=4):
+            engine.evaluate(now * 60, {"garage": value}, now * 60)
+        self.assertEqual(self.get_states(), [])
+        engine.evaluate(480, {"garage": 80.0}, 480)
+        self.assertEqual(self.get_states(), [("garage", "firing")])
+
+    def test_stale_is_measured_against_wall_clock(self):
+        engine = self.create_engine(alerts.StaleRule(
+            {"name": "stale", "max-age-seconds": 600}))
+        engine.evaluate(1000, {"garage": 4.5, "attic": 10.0}, 1000)
+        # A push from the future must not make the others look stale
+        engine.evaluate(100000, {"attic": 11.0}, 1300)
+        engine.evaluate(1300, {}, 1300)
+        self.assertEqual(self.get_states(), [])
+
+        engine.evaluate(1700, {}, 1700)
+        self.assertEqual(self.get_states(), [("attic", "firing"), ("garage", "firing")])
+        engine.evaluate(1800, {"garage": 4.0}, 1800)
+        self.assertEqual(self.get_states()[-1], ("garage", "resolved"))
+
+
+if __name__ == "__main__":
+    unittest.main()
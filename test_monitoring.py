@@ -0,0 +1,195 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import unittest.mock
+from concurrent.futures import Future
+import monitoring
+
+
+class FailingDatabase:
+    """Database whose first failures update_many calls raise."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.datapoints = []
+        self.last_update = 0
+
+    def update_many(self, datapoints):
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("RRD is locked")
+        self.datapoints.extend(datapoints)
+        self.last_update = datapoints[-1][0]
+
+    def set_data_source_servers(self, server_datas):
+        pass
+
+
+class WriteBehindBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal_filename = os.path.join(self.directory, "journal")
+        self.retry_seconds = monitoring.WRITE_RETRY_MIN_SECONDS
+        monitoring.WRITE_RETRY_MIN_SECONDS = 0.05
+
+    def tearDown(self):
+        monitoring.WRITE_RETRY_MIN_SECONDS = self.retry_seconds
+        shutil.rmtree(self.directory)
+
+    def test_failed_batch_is_retried(self):
+        database = FailingDatabase(failures=3)
+        buffer = monitoring.WriteBehindBuffer(database,
+                                              journal_filename=self.journal_filename)
+        buffer.start()
+        buffer.add(monitoring.Sample(1000, time.monotonic(), {"a": 1.5}))
+        # Checked while a failure is still to come, so that the retry can
+        # not have written the sample yet
+        wait_for(lambda: database.failures == 1)
+        self.assertEqual(read_journal_timestamps(self.journal_filename), [1000])
+
+        buffer.add(monitoring.Sample(1010, time.monotonic(), {"a": 2.5}))
+        wait_for(lambda: len(database.datapoints) == 2)
+        buffer.close()
+        self.assertEqual(database.datapoints, [(1000, {"a": 1.5}), (1010, {"a": 2.5})])
+        self.assertEqual(read_journal_timestamps(self.journal_filename), [])
+
+    def test_unwritten_samples_stay_in_journal_on_close(self):
+        database = FailingDatabase(failures=100)
+        buffer = monitoring.WriteBehindBuffer(database,
+                                              journal_filename=self.journal_filename)
+        buffer.start()
+        buffer.add(monitoring.Sample(1000, time.monotonic(), {"a": 1.5}))
+        wait_for(lambda: database.failures < 100)
+        buffer.close()
+        self.assertEqual(database.datapoints, [])
+
+        database = FailingDatabase(failures=0)
+        buffer = monitoring.WriteBehindBuffer(database,
+                                              journal_filename=self.journal_filename)
+        buffer.start()
+        buffer.close()
+        self.assertEqual(database.datapoints, [(1000, {"a": 1.5})])
+
+    def test_journal_syncs_are_batched(self):
+        database = FailingDatabase(failures=0)
+        buffer = monitoring.WriteBehindBuffer(database, max_samples=10, max_age_seconds=60,
+                                              journal_filename=self.journal_filename,
+                                              journal_sync_seconds=60)
+        buffer.start()
+        with unittest.mock.patch("os.fsync") as fsync:
+            for timestamp in (1000, 1010, 1020):
+                buffer.add(monitoring.Sample(timestamp, time.monotonic(), {"a": 1.5}))
+            self.assertEqual(fsync.call_count, 0)
+            self.assertEqual(read_journal_timestamps(self.journal_filename),
+                             [1000, 1010, 1020])
+            buffer.close()
+            self.assertEqual(fsync.call_count, 1)
+        self.assertEqual(len(database.datapoints), 3)
+        self.assertEqual(read_journal_timestamps(self.journal_filename), [])
+
+    def test_journal_is_synced_on_every_add_without_interval(self):
+        database = FailingDatabase(failures=0)
+        buffer = monitoring.WriteBehindBuffer(database, max_samples=10, max_age_seconds=60,
+                                              journal_filename=self.journal_filename,
+                                              journal_sync_seconds=0)
+        buffer.start()
+        with unittest.mock.patch("os.fsync") as fsync:
+            buffer.add(monitoring.Sample(1000, time.monotonic(), {"a": 1.5}))
+            buffer.add(monitoring.Sample(1010, time.monotonic(), {"a": 2.5}))
+            self.assertEqual(fsync.call_count, 2)
+            buffer.close()
+
+
+class ImmediateExecutor:
+    """Runs submitted calls at once in the calling thread."""
+
+    def submit(self, function, *args):
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+
+class ServerHealthTest(unittest.TestCase):
+    def setUp(self):
+        self.health = monitoring.ServerHealth("localhost:5001", 10, failure_threshold=2,
+                                              max_backoff=60)
+
+    def test_failures_below_threshold_keep_polling(self):
+        self.health.record_poll(0, None)
+        self.assertFalse(self.health.is_circuit_open())
+        self.assertFalse(self.health.is_due(9))
+        self.assertTrue(self.health.is_due(10))
+
+    def test_circuit_opens_and_backs_off_up_to_max(self):
+        self.health.record_poll(0, None)
+        self.health.record_poll(10, None)
+        self.assertTrue(self.health.is_circuit_open())
+        self.assertFalse(self.health.is_due(29))
+        self.assertTrue(self.health.is_due(30))
+
+        # Failed probes double the backoff until it reaches max_backoff
+        now = 30
+        for backoff in (40, 60, 60):
+            self.health.record_poll(now, None)
+            self.assertFalse(self.health.is_due(now + backoff - 1))
+            self.assertTrue(self.health.is_due(now + backoff))
+            now += backoff
+
+    def test_successful_probe_closes_circuit(self):
+        self.health.record_poll(0, None)
+        self.health.record_poll(10, None)
+        self.health.record_poll(30, {"garage": 4.5})
+        self.assertFalse(self.health.is_circuit_open())
+        self.assertEqual(self.health.failures, 0)
+        self.assertTrue(self.health.is_due(40))
+
+        # It takes failure_threshold failures to open the circuit again
+        self.health.record_poll(40, None)
+        self.assertFalse(self.health.is_circuit_open())
+
+    def test_tolerance(self):
+        health = monitoring.ServerHealth("localhost:5001", 10, tolerance=1)
+        health.record_poll(0, {"garage": 4.5})
+        self.assertFalse(health.is_due(8.9))
+        self.assertTrue(health.is_due(9.5))
+
+    def test_open_circuit_is_not_polled(self):
+        config = {"polling-interval-seconds": 10, "circuit-breaker-failures": 1,
+                  "servers": [{"hostname": "localhost", "port": 5001}]}
+        healths = monitoring.create_server_healths(config)
+        polls = []
+
+        def poll(session, hostname, port, timeouts, path):
+            polls.append(clock[0])
+            return None
+
+        clock = [100.0]
+        with unittest.mock.patch("monitoring.poll_temperature_server", poll), \
+                unittest.mock.patch("time.monotonic", lambda: clock[0]):
+            for now in (100.0, 110.0, 120.0, 130.0):
+                clock[0] = now
+                server_datas = monitoring.poll_temperature_servers(config, None,
+                                                                   ImmediateExecutor(), healths)
+                self.assertEqual(server_datas, [("localhost:5001", {})])
+        # Opened after the first failure and probed again after 20 seconds
+        self.assertEqual(polls, [100.0, 120.0])
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.01)
+
+
+def read_journal_timestamps(filename):
+    with open(filename) as journal:
+        return [json.loads(line)["timestamp"] for line in journal]
+
+
+if __name__ == "__main__":
+    unittest.main()
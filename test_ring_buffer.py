@@ -0,0 +1,38 @@
+import os
+import shutil
+import tempfile
+import unittest
+import ring_buffer
+
+
+class RingBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "recent.ring")
+        self.writers = []
+
+    def tearDown(self):
+        for writer in self.writers:
+            writer.file.close()
+        shutil.rmtree(self.directory)
+
+    def create_writer(self):
+        writer = ring_buffer.RingBufferWriter(self.filename, slots=4, rows=8)
+        self.writers.append(writer)
+        return writer
+
+    def test_interrupted_write_is_finished_on_open(self):
+        writer = self.create_writer()
+        writer.append(1000, {"garage": 4.5})
+        # As if the writer had died between the two sequence updates
+        writer.layout.counters[0] += 1
+
+        writer = self.create_writer()
+        self.assertEqual(int(writer.layout.counters[0]) % 2, 0)
+        writer.append(1010, {"garage": 5.0})
+        reader = ring_buffer.RingBufferReader(self.filename)
+        self.assertEqual(reader.get_latest(), (1010, {"garage": 5.0}))
+
+
+if __name__ == "__main__":
+    unittest.main()